@@ -0,0 +1,51 @@
+"""
+Benchmark of the overhead of dispatching and retrieving many trivial
+tasks with Parallel.
+
+The tasks do nothing, so that the measured time is the time spent in
+the bookkeeping of Parallel and in the communication with the workers.
+Run with:
+
+    python benchmarks/bench_parallel_dispatch.py [n_tasks ...]
+"""
+import sys
+import time
+
+from joblib import Parallel, delayed
+
+
+def noop(x):
+    return x
+
+
+def bench(n_tasks, **kwargs):
+    parallel = Parallel(**kwargs)
+    t0 = time.time()
+    out = parallel(delayed(noop)(i) for i in range(n_tasks))
+    duration = time.time() - t0
+    assert len(out) == n_tasks
+    return duration
+
+
+def print_bench(n_tasks, **kwargs):
+    duration = bench(n_tasks, **kwargs)
+    options = ', '.join('%s=%r' % item for item in sorted(kwargs.items()))
+    print('%8d tasks  %-62s %7.2fs  %6.1fus/task'
+          % (n_tasks, options, duration, 1e6 * duration / n_tasks))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        task_counts = [int(float(n)) for n in sys.argv[1:]]
+    else:
+        task_counts = [int(1e5), int(1e6)]
+    for n_tasks in task_counts:
+        print_bench(n_tasks, n_jobs=1)
+        # One task per batch: stresses the queue of jobs
+        print_bench(n_tasks, n_jobs=2, backend='threading', batch_size=1)
+        print_bench(n_tasks, n_jobs=2, backend='threading', batch_size=1,
+                    pre_dispatch='2*n_jobs')
+        print_bench(n_tasks, n_jobs=2, backend='multiprocessing',
+                    batch_size='auto')
+        print_bench(n_tasks, n_jobs=2, backend='multiprocessing',
+                    batch_size='auto', pre_dispatch='2*n_jobs')
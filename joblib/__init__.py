@@ -114,3 +114,8 @@ from .numpy_pickle import load
 from .parallel import Parallel
 from .parallel import delayed
 from .parallel import cpu_count
+from .parallel import register_parallel_backend
+from .parallel import ParallelBackendBase
+from .parallel import parallel_backend
+from .parallel import get_worker_state
+from .parallel import run_worker_initializers
@@ -0,0 +1,30 @@
+"""
+Conditional import of multiprocessing, shared by the parallel module and
+its backends.
+"""
+# License: BSD 3 clause
+
+import os
+import warnings
+
+
+# Obtain possible configuration from the environment, assuming 1 (on)
+# by default, upon 0 set to None. Should instructively fail if some non
+# 0/1 value is set.
+multiprocessing = int(os.environ.get('JOBLIB_MULTIPROCESSING', 1)) or None
+if multiprocessing:
+    try:
+        import multiprocessing
+    except ImportError:
+        multiprocessing = None
+
+
+# 2nd stage: validate that locking is available on the system and
+#            issue a warning if not
+if multiprocessing:
+    try:
+        _sem = multiprocessing.Semaphore()
+        del _sem # cleanup
+    except (ImportError, OSError) as e:
+        multiprocessing = None
+        warnings.warn('%s.  joblib will operate in serial mode' % (e,))
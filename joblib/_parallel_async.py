@@ -0,0 +1,94 @@
+"""
+Asyncio support for Parallel.
+
+This module requires Python 3.7, and is only
+imported by Parallel.as_async.
+"""
+
+# License: BSD 3 clause
+
+import asyncio
+
+
+class AsyncReadyBatches(object):
+    """ Queue of the completed batches, fed by the callback thread of
+        the pool, and consumed in the event loop.
+    """
+    def __init__(self, loop):
+        self._loop = loop
+        self._queue = asyncio.Queue()
+
+    def put(self, callback):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, callback)
+
+    def get(self):
+        return self._queue.get()
+
+
+async def _iter_ready_jobs(parallel, ready_batches):
+    """ Asynchronous counterpart of Parallel._iter_ready_jobs
+    """
+    while parallel._n_retrieved_batches < parallel.n_dispatched_batches:
+        callback = await ready_batches.get()
+        parallel._n_retrieved_batches += 1
+        with parallel._lock:
+            # The job is set by dispatch while holding the lock
+            job = callback.job
+        callback.job = None
+        yield callback.start_index, callback.batch_size, job
+
+
+async def _iter_outputs(parallel, iterable):
+    """ Asynchronous generator of the outputs of the call
+    """
+    n_jobs = parallel._initialize_call()
+    if n_jobs == 1:
+        # No pool: the jobs are run by the synchronous code path
+        outputs = parallel._get_outputs(iterable, n_jobs)
+        next(outputs)
+        for output in outputs:
+            yield output
+        return
+
+    ready_batches = AsyncReadyBatches(asyncio.get_running_loop())
+    completed = False
+    try:
+        parallel._start(iterable, n_jobs, ready_batches)
+        async for start_index, n_tasks, job in _iter_ready_jobs(
+                parallel, ready_batches):
+            # The job is done: this does not block
+            outputs = parallel._get_job_outputs(start_index, job, n_tasks)
+            parallel._release_nbytes(start_index)
+            for output in parallel._collate(start_index, outputs):
+                yield output
+        parallel._print_finished()
+        completed = True
+    finally:
+        if not completed:
+            # Cancel the jobs left, also when the task awaiting the
+            # outputs is cancelled
+            parallel._abort()
+            # Wait for the batches left in the event loop, rather than
+            # in _finish_call, which would block it
+            async for _ in _iter_ready_jobs(parallel, ready_batches):
+                pass
+        parallel._finish_call()
+
+
+async def _gather(outputs):
+    return [output async for output in outputs]
+
+
+async def _gather_on_disk(parallel, outputs):
+    return parallel._make_disk_outputs(await _gather(outputs))
+
+
+def as_async(parallel, iterable):
+    """ Implementation of Parallel.as_async
+    """
+    outputs = _iter_outputs(parallel, iterable)
+    if parallel.return_as == 'generator':
+        return outputs
+    if parallel.return_as == 'disk':
+        return _gather_on_disk(parallel, outputs)
+    return _gather(outputs)
@@ -0,0 +1,441 @@
+"""
+Backends running the jobs of Parallel.
+"""
+# License: BSD 3 clause
+
+import os
+import warnings
+import threading
+
+from ._multiprocessing_helpers import multiprocessing
+from .my_exceptions import WorkerLostError, JobTimeoutError
+if multiprocessing:
+    from multiprocessing.pool import ThreadPool
+    from .pool import MemmapingPool, ResilientPool, dump_result
+    from .tcp_pool import TCPPool
+
+
+# Environment variables limiting the number of threads used by the native
+# libraries: OpenMP, the BLAS implementations, and numexpr
+INNER_THREADS_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                           'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                           'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def _limit_inner_threads(variables, max_num_threads):
+    """ Initializer of the worker processes, limiting the number of
+        threads of the native libraries
+    """
+    # For the libraries loaded from now on
+    os.environ.update(variables)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        # The libraries already loaded, for instance inherited from the
+        # parent process, keep their number of threads
+        return
+    threadpool_limits(max_num_threads)
+
+
+def _flag_worker():
+    """ Initializer of the worker processes, setting the guard against
+        recursive spawning. Also run by the workers that the pool starts
+        later, to replace the dead ones, which do not inherit the
+        environment in which the pool was created.
+    """
+    os.environ['__JOBLIB_SPAWNED_PARALLEL__'] = '1'
+
+
+###############################################################################
+# The state of the workers
+
+# Local to each worker: the main thread of a worker process, or a thread
+# of the threading backend
+_worker_local = threading.local()
+
+
+def get_worker_state():
+    """ Return the dict of the state of the current worker.
+
+        The initializer of Parallel stores there the resources set up
+        once for each worker, such as a database connection or a loaded
+        model, for the jobs that the worker runs to reuse them. With
+        n_jobs=1, the worker is the calling thread.
+    """
+    state = getattr(_worker_local, 'state', None)
+    if state is None:
+        state = _worker_local.state = dict()
+    return state
+
+
+def run_worker_initializers(initializers):
+    """ Initializer of the workers, calling the (initializer, initargs)
+        pairs given in order, such as the list returned by
+        Parallel.get_initializers. To be called by each worker of a
+        backend, before its first job.
+
+        Their error is raised by the jobs of the worker: raised here, it
+        would kill the worker process, which the pool would replace
+        endlessly.
+    """
+    # A forked worker process inherits the state of the parent thread
+    _worker_local.state = dict()
+    _worker_local.error = None
+    try:
+        for initializer, initargs in initializers:
+            initializer(*initargs)
+    except Exception as exception:
+        _worker_local.error = exception
+
+
+def _check_worker():
+    """ Raise the error of the initializer of the current worker, if any
+    """
+    error = getattr(_worker_local, 'error', None)
+    if error is not None:
+        raise error
+
+
+###############################################################################
+# Error callbacks for the pools of the standard library, which only
+# support them from Python 3.2
+
+class _Failure(object):
+    """ The exception of a job, returned as its output, for the pool to
+        pass it to the success callback
+    """
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class _CapturedCall(object):
+    """ Wraps a function to return its exception as a _Failure
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self):
+        try:
+            return self.func()
+        except Exception as exception:
+            return _Failure(exception)
+
+
+class _CallbackDispatcher(object):
+    """ The success callback of a _CapturedCall, calling the callback with
+        its output, or the error callback with its exception
+    """
+    def __init__(self, callback, error_callback):
+        self.callback = callback
+        self.error_callback = error_callback
+
+    def __call__(self, output):
+        if isinstance(output, _Failure):
+            if self.error_callback is not None:
+                self.error_callback(output.exception)
+        elif self.callback is not None:
+            self.callback(output)
+
+
+###############################################################################
+class ParallelBackendBase(object):
+    """ Interface of the execution backends of Parallel.
+
+        A backend starts workers, runs the batches of jobs submitted by
+        Parallel in them, and stops them. Parallel only uses a backend
+        with more than one job: with n_jobs=1, the jobs run in the
+        calling thread. A Parallel object has its own backend object,
+        unless it is given one: a backend object must then not be used
+        by several Parallel objects at the same time.
+
+        To run the jobs with another execution engine, such as a cluster
+        scheduler, subclass it, and register it with
+        register_parallel_backend.
+    """
+
+    # Whether the jobs are pickled to be sent to the workers: the
+    # functions of the jobs are then pickled once for all the jobs, and
+    # batch_size='auto' groups the short jobs to amortize the cost of
+    # communication
+    pickles_tasks = True
+
+    # Whether the workers can read the files written by the parent
+    # process
+    shares_filesystem = True
+
+    # Whether submit supports a timeout
+    supports_timeout = False
+
+    # A picklable function returning the pickle of an output of the jobs
+    # in a worker, as the worker sends it back: Parallel then pickles the
+    # output of each job itself, to measure the time spent. None if the
+    # outputs are not pickled, or the time is not measured.
+    result_pickler = None
+
+    # The exceptions, besides those of the jobs, that collect may raise,
+    # for instance when a worker dies
+    exceptions = []
+
+    def effective_n_jobs(self, n_jobs):
+        """ Return the number of jobs run at once for the n_jobs given to
+            Parallel, resolving None and the negative values
+        """
+        raise NotImplementedError
+
+    def start(self, n_jobs, parallel):
+        """ Start the workers to run n_jobs jobs at once, with the options
+            of the Parallel object, and return the number of jobs they
+            run at once: 1 if they cannot be started, for the jobs to run
+            in the calling thread.
+
+            Each worker must call run_worker_initializers with the
+            initializers of the Parallel object, as returned by
+            parallel.get_initializers(), before running its first job.
+        """
+        raise NotImplementedError
+
+    def submit(self, func, callback=None, error_callback=None,
+               timeout=None):
+        """ Schedule func to be called without arguments in a worker, and
+            return the job, to be passed to collect.
+
+            Once done, callback is called with the output, or
+            error_callback with the exception. They may be called from
+            any thread, but not concurrently, and must be called before
+            the job is seen as done by collect. timeout, in seconds, is
+            only given if supports_timeout is True.
+        """
+        raise NotImplementedError
+
+    def collect(self, job):
+        """ Wait for the job, and return its output, or raise its error
+        """
+        return job.get()
+
+    def abort(self):
+        """ Stop the jobs running, for a call of Parallel that is aborted:
+            their workers may be terminated, and replaced, and the jobs
+            fail. By default, the jobs run to completion.
+        """
+
+    def end_call(self):
+        """ Release the resources of a call of Parallel, when the workers
+            are kept for the next calls
+        """
+
+    def terminate(self, wait=True):
+        """ Stop the workers, once they have run the jobs submitted, or,
+            if wait is False, right away, dropping the jobs left
+        """
+        raise NotImplementedError
+
+
+class PoolBackend(ParallelBackendBase):
+    """ Base of the backends running the jobs with the interface of
+        multiprocessing.pool.Pool
+    """
+
+    _pool = None
+
+    def effective_n_jobs(self, n_jobs):
+        if n_jobs is None or multiprocessing is None:
+            return 1
+        if n_jobs < 0:
+            n_jobs = max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+        return n_jobs
+
+    def submit(self, func, callback=None, error_callback=None,
+               timeout=None):
+        # The pools of joblib call the error callback themselves
+        kwargs = dict()
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        return self._pool.apply_async(func, callback=callback,
+                                      error_callback=error_callback,
+                                      **kwargs)
+
+    def terminate(self, wait=True):
+        pool = self._pool
+        if pool is None:
+            return
+        self._pool = None
+        if wait:
+            pool.close()
+            pool.join()
+        pool.terminate()
+
+
+class ThreadingBackend(PoolBackend):
+    """ Runs the jobs in a pool of threads of the current process: the
+        arguments and outputs are passed without any copy, but the jobs
+        only run concurrently if they release the GIL
+    """
+
+    pickles_tasks = False
+
+    def start(self, n_jobs, parallel):
+        # Threads share the memory of the current process: no need to
+        # guard against recursive spawning or to pickle anything
+        initializers = parallel.get_initializers()
+        if initializers:
+            self._pool = ThreadPool(n_jobs,
+                                    initializer=run_worker_initializers,
+                                    initargs=(initializers,))
+        else:
+            self._pool = ThreadPool(n_jobs)
+        return n_jobs
+
+    def submit(self, func, callback=None, error_callback=None,
+               timeout=None):
+        # The error of the job goes through the success callback
+        return self._pool.apply_async(
+            _CapturedCall(func),
+            callback=_CallbackDispatcher(callback, error_callback))
+
+    def collect(self, job):
+        output = job.get()
+        if isinstance(output, _Failure):
+            raise output.exception
+        return output
+
+
+class MultiprocessingBackend(PoolBackend):
+    """ Runs the jobs in worker processes of the current host, sending
+        the large numpy arrays as memory maps if Parallel has max_nbytes
+        set
+    """
+
+    supports_timeout = True
+    exceptions = [WorkerLostError, JobTimeoutError]
+    if multiprocessing:
+        result_pickler = staticmethod(dump_result)
+
+    def start(self, n_jobs, parallel):
+        if multiprocessing.current_process().daemon:
+            # Daemonic processes cannot have children
+            warnings.warn(
+                'Parallel loops cannot be nested, setting n_jobs=1',
+                stacklevel=4)
+            return 1
+        already_forked = int(os.environ.get('__JOBLIB_SPAWNED_PARALLEL__', 0))
+        if already_forked:
+            raise ImportError('[joblib] Attempting to do parallel computing'
+                    'without protecting your import on a system that does '
+                    'not support forking. To use parallel-computing in a '
+                    'script, you must protect you main loop using "if '
+                    "__name__ == '__main__'"
+                    '". Please see the joblib documentation on Parallel '
+                    'for more information'
+                )
+
+        # Set an environment variable to avoid infinite loops: it is
+        # inherited by the workers started with the pool, as are the
+        # limits on the number of threads. They are removed right away,
+        # as the pool may be kept alive while other Parallel calls are
+        # made in this process: the initializer of the workers sets the
+        # guard again, for the workers started later.
+        environ = dict()
+        pool_args = dict()
+        initializers = parallel.get_initializers()
+        initializers.insert(0, (_flag_worker, ()))
+        max_num_threads = self._inner_max_num_threads(
+            parallel.inner_max_num_threads, n_jobs)
+        if max_num_threads is not None:
+            environ = dict((name, str(max_num_threads))
+                           for name in INNER_THREADS_VARIABLES)
+            # Before the initializer of the user, which may load the
+            # native libraries
+            initializers.insert(1, (_limit_inner_threads,
+                                    (dict(environ), max_num_threads)))
+        pool_args['initializer'] = run_worker_initializers
+        pool_args['initargs'] = (initializers,)
+        environ['__JOBLIB_SPAWNED_PARALLEL__'] = '1'
+        old_environ = dict((name, os.environ.get(name))
+                           for name in environ)
+        os.environ.update(environ)
+        try:
+            if parallel.max_nbytes is None:
+                self._pool = ResilientPool(n_jobs, **pool_args)
+            else:
+                self._pool = MemmapingPool(
+                    n_jobs, temp_folder=parallel.temp_folder,
+                    max_nbytes=parallel.max_nbytes,
+                    mmap_mode=parallel.mmap_mode,
+                    verbose=max(0, parallel.verbose - 50), **pool_args)
+        finally:
+            for name, value in old_environ.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+        return n_jobs
+
+    def _inner_max_num_threads(self, max_num_threads, n_jobs):
+        """ Return the maximum number of threads of the native libraries
+            in each worker, or None for no limit
+        """
+        if max_num_threads != 'auto':
+            return max_num_threads
+        if any(name in os.environ for name in INNER_THREADS_VARIABLES):
+            # The user has chosen the limits
+            return None
+        return max(multiprocessing.cpu_count() // n_jobs, 1)
+
+    def abort(self):
+        if self._pool is not None:
+            self._pool.cancel_running_tasks()
+
+    def end_call(self):
+        if isinstance(self._pool, MemmapingPool):
+            self._pool.clear_temporary_folder()
+
+
+class TCPBackend(PoolBackend):
+    """ Runs the jobs in worker processes on other hosts, with a TCPPool.
+
+        The addresses of the worker servers, as 'host:port', default to
+        the comma-separated list of the JOBLIB_TCP_WORKERS environment
+        variable, and the key authenticating the connections to
+        JOBLIB_TCP_AUTHKEY. The n_jobs connections are spread over the
+        servers, and a negative n_jobs counts from their number.
+    """
+
+    shares_filesystem = False
+    exceptions = [WorkerLostError]
+
+    def __init__(self, addresses=None, authkey=None):
+        self.addresses = addresses
+        self.authkey = authkey
+
+    def _get_addresses(self):
+        addresses = self.addresses
+        if addresses is None:
+            addresses = [address.strip() for address in
+                         os.environ.get('JOBLIB_TCP_WORKERS', '').split(',')
+                         if address.strip()]
+        if not addresses:
+            raise ValueError("The 'tcp' backend requires the addresses of "
+                             "the worker servers, as 'host:port', in the "
+                             "JOBLIB_TCP_WORKERS environment variable")
+        return addresses
+
+    def effective_n_jobs(self, n_jobs):
+        if n_jobs is None or multiprocessing is None:
+            return 1
+        if n_jobs < 0:
+            n_jobs = max(len(self._get_addresses()) + 1 + n_jobs, 1)
+        return n_jobs
+
+    def start(self, n_jobs, parallel):
+        authkey = self.authkey
+        if authkey is None:
+            authkey = os.environ.get('JOBLIB_TCP_AUTHKEY')
+        initializers = parallel.get_initializers()
+        if initializers:
+            pool_args = dict(initializer=run_worker_initializers,
+                             initargs=(initializers,))
+        else:
+            pool_args = dict()
+        self._pool = TCPPool(n_jobs, self._get_addresses(), authkey,
+                             **pool_args)
+        return n_jobs
@@ -8,6 +8,7 @@ Disk management utilities.
 # License: BSD Style, 3 clauses.
 
 
+import atexit
 import errno
 import os
 import shutil
@@ -57,6 +58,18 @@ def mkdirp(d):
             raise
 
 
+# The temporary folders of Parallel and of the pools, deleted at the exit
+# of the process if they are still there
+_temporary_folders = set()
+
+
+def _delete_temporary_folders():
+    for folder in list(_temporary_folders):
+        shutil.rmtree(folder, ignore_errors=True)
+
+atexit.register(_delete_temporary_folders)
+
+
 # if a rmtree operation fails in rm_subdirs, wait for this much time (in secs),
 # then retry once. if it still fails, raise the exception
 RM_SUBDIRS_RETRY_TIME = 0.1
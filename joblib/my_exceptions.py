@@ -43,6 +43,18 @@ class TransportableException(JoblibException):
         return self.__class__, (self.message, self.etype), {}
 
 
+class WorkerLostError(JoblibException):
+    """ Raised for a task whose worker process died while running it,
+        for instance killed by a segmentation fault or by the
+        out-of-memory killer.
+    """
+
+
+class JobTimeoutError(JoblibException):
+    """ Raised for a task running longer than its timeout
+    """
+
+
 _exception_mapping = dict()
 
 
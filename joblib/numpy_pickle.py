@@ -10,6 +10,7 @@ import pickle
 import traceback
 import sys
 import os
+import re
 import zlib
 import warnings
 
@@ -92,6 +93,14 @@ def write_zfile(file_handle, data, compress=1):
 ###############################################################################
 # Utility objects for persistence.
 
+def _numpy_version(np):
+    """ The (major, minor) version of numpy, as integers, to compare it
+        numerically: as strings, '1.10' is before '1.3'
+    """
+    return tuple(int(part) for part in
+                 re.match(r'(\d+)\.(\d+)', np.__version__).groups())
+
+
 class NDArrayWrapper(object):
     """ An object to be persisted instead of numpy arrays.
 
@@ -107,7 +116,7 @@ class NDArrayWrapper(object):
         "Reconstruct the array"
         filename = os.path.join(unpickler._dirname, self.filename)
         # Load the array from the disk
-        if unpickler.np.__version__ >= '1.3':
+        if _numpy_version(unpickler.np) >= (1, 3):
             array = unpickler.np.load(filename,
                             mmap_mode=unpickler.mmap_mode)
         else:
@@ -7,41 +7,70 @@ Helpers for embarrassingly parallel code.
 
 import os
 import sys
+import shutil
+import hashlib
+import tempfile
 import warnings
 from math import sqrt
 import functools
 import time
+import uuid
 import threading
 import itertools
+from collections import deque
+from contextlib import contextmanager
 try:
     import cPickle as pickle
 except:
     import pickle
+try:
+    # Optional: to pickle lambdas and closures by value
+    import cloudpickle
+except ImportError:
+    cloudpickle = None
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
-# Obtain possible configuration from the environment, assuming 1 (on)
-# by default, upon 0 set to None. Should instructively fail if some non
-# 0/1 value is set.
-multiprocessing = int(os.environ.get('JOBLIB_MULTIPROCESSING', 1)) or None
+from ._multiprocessing_helpers import multiprocessing
+from .format_stack import format_exc, format_outer_frames
+from .logger import Logger, short_format_time
+from .my_exceptions import TransportableException, JobTimeoutError, \
+    _mk_exception
+from .disk import memstr_to_kbytes, _temporary_folders
+from .numpy_pickle import dump, load
+from ._compat import _basestring
+from ._parallel_backends import ParallelBackendBase, \
+    MultiprocessingBackend, ThreadingBackend, TCPBackend, \
+    get_worker_state, run_worker_initializers, _check_worker
 if multiprocessing:
-    try:
-        import multiprocessing
-    except ImportError:
-        multiprocessing = None
+    from .pool import delete_folder
 
+# Bounds on the duration of the processing of a batch of tasks, used to
+# tune the size of the batches when batch_size='auto'
+MIN_IDEAL_BATCH_DURATION = .2
+MAX_IDEAL_BATCH_DURATION = 2
 
-# 2nd stage: validate that locking is available on the system and
-#            issue a warning if not
-if multiprocessing:
-    try:
-        _sem = multiprocessing.Semaphore()
-        del _sem # cleanup
-    except (ImportError, OSError) as e:
-        multiprocessing = None
-        warnings.warn('%s.  joblib will operate in serial mode' % (e,))
+# Minimum interval, in seconds, between two calls of the progress
+# callback, besides the last one
+MIN_PROGRESS_INTERVAL = .1
 
-from .format_stack import format_exc, format_outer_frames
-from .logger import Logger, short_format_time
-from .my_exceptions import TransportableException, _mk_exception
+# Size of the pickle of a function above which it is sent once to each
+# worker, through a file, rather than with every batch
+MIN_BROADCAST_NBYTES = 10000
+
+# The backends of Parallel, by name
+BACKENDS = {
+    'multiprocessing': MultiprocessingBackend,
+    'threading': ThreadingBackend,
+    'tcp': TCPBackend,
+}
+
+DEFAULT_BACKEND = 'multiprocessing'
+
+# The (backend, backend_args) set by parallel_backend in each thread
+_backend = threading.local()
 
 
 ###############################################################################
@@ -75,6 +104,84 @@ def _verbosity_filter(index, verbose):
     return (int(next_scale) == int(scale))
 
 
+###############################################################################
+# The choice of the backend
+
+def register_parallel_backend(name, factory, make_default=False):
+    """ Register a backend of Parallel, to select it by name.
+
+        Parameters
+        -----------
+        name: str
+            The name of the backend, to be given as the backend argument
+            of Parallel or parallel_backend.
+        factory: callable
+            Called, with the keyword arguments given to parallel_backend,
+            to create the ParallelBackendBase object of each Parallel
+            object using the backend. Usually a subclass of
+            ParallelBackendBase.
+        make_default: boolean, optional
+            If True, the backend is used by the Parallel objects created
+            without a backend, outside of the parallel_backend blocks.
+    """
+    global DEFAULT_BACKEND
+    BACKENDS[name] = factory
+    if make_default:
+        DEFAULT_BACKEND = name
+
+
+@contextmanager
+def parallel_backend(backend, **backend_args):
+    """ Change the backend used by the Parallel objects created without a
+        backend within a with block.
+
+        backend is the name of a registered backend, the factory of
+        which is called with the keyword arguments given, for each
+        Parallel object, or a ParallelBackendBase object. The setting
+        only applies to the current thread.
+
+        Example
+        -------
+
+        >>> from math import sqrt
+        >>> from joblib import Parallel, delayed, parallel_backend
+        >>> with parallel_backend('threading'):
+        ...     Parallel(n_jobs=2)(delayed(sqrt)(i ** 2) for i in range(3))
+        [0.0, 1.0, 2.0]
+    """
+    if isinstance(backend, _basestring):
+        _check_backend_name(backend)
+    elif backend_args:
+        raise ValueError('Arguments can only be given for a backend '
+                         'selected by name')
+    old_default = getattr(_backend, 'default', None)
+    _backend.default = (backend, backend_args)
+    try:
+        yield
+    finally:
+        _backend.default = old_default
+
+
+def _check_backend_name(name):
+    if name not in BACKENDS:
+        raise ValueError("Invalid backend: %r, expected one of %r"
+                         % (name, sorted(BACKENDS)))
+
+
+def _get_backend(backend):
+    """ Return the ParallelBackendBase object for the backend argument of
+        Parallel
+    """
+    backend_args = dict()
+    if backend is None:
+        backend, backend_args = (getattr(_backend, 'default', None)
+                                 or (DEFAULT_BACKEND, backend_args))
+    if isinstance(backend, ParallelBackendBase):
+        return backend
+    _check_backend_name(backend)
+    return BACKENDS[backend](**backend_args)
+
+
 ###############################################################################
 class WorkerInterrupt(Exception):
     """ An exception that is not KeyboardInterrupt to allow subprocesses
@@ -95,6 +202,7 @@ class SafeFunction(object):
 
     def __call__(self, *args, **kwargs):
         try:
+            _check_worker()
             return self.func(*args, **kwargs)
         except KeyboardInterrupt:
             # We capture the KeyboardInterrupt and reraise it as
@@ -108,13 +216,274 @@ class SafeFunction(object):
             raise TransportableException(text, e_type)
 
 
+###############################################################################
+def _estimate_nbytes(obj, depth=3):
+    """ Rough estimate of the memory used by obj: the buffers of the
+        arrays it contains, such as numpy arrays, except memory maps, or
+        else the shallow size of the objects, looking into the
+        containers up to the given depth.
+    """
+    if isinstance(obj, (list, tuple, set, frozenset, dict)):
+        if isinstance(obj, dict):
+            items = itertools.chain(obj.keys(), obj.values())
+        else:
+            items = obj
+        nbytes = sys.getsizeof(obj)
+        if depth > 0:
+            nbytes += sum(_estimate_nbytes(item, depth - 1)
+                          for item in items)
+        return nbytes
+    nbytes = getattr(obj, 'nbytes', None)
+    if isinstance(nbytes, int):
+        if getattr(obj, 'filename', None) is not None:
+            # A numpy.memmap: its data is backed by a file
+            return 0
+        return nbytes
+    return sys.getsizeof(obj)
+
+
+###############################################################################
+class TimedCall(object):
+    """ Wraps a function to return, with its output, when and by which
+        worker it was run, and, if the function runs the given
+        BatchedCalls, the timings of its tasks.
+    """
+    def __init__(self, func, batch=None):
+        self.func = func
+        self.batch = batch
+        self.dispatch_time = time.time()
+
+    def __call__(self, *args, **kwargs):
+        start_time = time.time()
+        output = self.func(*args, **kwargs)
+        timing = dict(worker=(os.getpid(), threading.current_thread().name),
+                      dispatch_time=self.dispatch_time,
+                      start_time=start_time, end_time=time.time())
+        if self.batch is not None:
+            timing.update(self.batch.timings)
+        return output, timing
+
+
+###############################################################################
+class CancelFlag(object):
+    """ Flag set when a call is aborted, for the workers to skip the
+        batches of the call that they have not started yet.
+
+        The threads of the threading backend share the flag. The copy
+        sent with a batch to a worker process is set if the flag was set
+        when the batch was pickled, or else once the file of the flag
+        exists, if a filename is given.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._is_set = False
+
+    def set(self):
+        self._is_set = True
+        if self.filename is not None:
+            try:
+                open(self.filename, 'wb').close()
+            except (IOError, OSError):
+                # The batches sent from now on are still skipped
+                pass
+
+    def is_set(self):
+        if not self._is_set and self.filename is not None:
+            self._is_set = os.path.exists(self.filename)
+        return self._is_set
+
+    def delete(self):
+        """ Delete the file of the flag, once the workers are done with
+            the batches of the call
+        """
+        if self.filename is not None and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+###############################################################################
+# Marks the absence of output, as None is a valid one
+_NO_OUTPUT = object()
+
+
+class PickledOutput(object):
+    """ An output pickled in the worker: it is unpickled with the message
+        carrying it in the parent process.
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce__(self):
+        return pickle.loads, (self.data,)
+
+
+class BatchedCalls(object):
+    """ Wraps a sequence of (func, args, kwargs) tuples as a single callable,
+        so that several tasks can be sent to a worker in one call.
+
+        If combine is given, the outputs of the tasks are combined in the
+        worker, and the batch only returns the result. If filenames is
+        set, the output of each task is dumped to its file, and the batch
+        returns the filenames. Else, if result_pickler, a function
+        returning the pickle of an object, is set, the outputs are
+        pickled in the worker, for the time spent to be measured. If
+        cancel_flag, a CancelFlag, is set when the batch starts, its tasks
+        are skipped, and it returns no output.
+
+        Once called, the timings attribute holds the start_time,
+        end_time, result_nbytes and result_dump_time of each of its
+        tasks, as tasks, and the total result_dump_time, the seconds
+        spent dumping the outputs, or None if they are not.
+    """
+    def __init__(self, iterator_slice, combine=None):
+        self.items = list(iterator_slice)
+        self._size = len(self.items)
+        self.combine = combine
+        self.filenames = None
+        self.result_pickler = None
+        self.cancel_flag = None
+        self.timings = None
+
+    def __call__(self):
+        self.timings = dict(tasks=list(), result_dump_time=None)
+        if self.cancel_flag is not None and self.cancel_flag.is_set():
+            # The call was aborted
+            return []
+        if self.filenames is not None:
+            for item, filename in zip(self.items, self.filenames):
+                self._dump(self._run(*item), filename)
+            return self.filenames
+        if self.combine is None:
+            return [self._dump(self._run(*item)) for item in self.items]
+        # Without keeping the outputs of the tasks
+        result = _NO_OUTPUT
+        for item in self.items:
+            output = self._run(*item)
+            if result is _NO_OUTPUT:
+                result = output
+            else:
+                result = self.combine(result, output)
+        # The pickle of the result is not split between the tasks
+        return [self._dump(result, task_timing=dict())]
+
+    def _run(self, func, args, kwargs):
+        """ Run a task, recording when it started and ended
+        """
+        start_time = time.time()
+        output = func(*args, **kwargs)
+        self.timings['tasks'].append(dict(
+            start_time=start_time, end_time=time.time(),
+            result_nbytes=None, result_dump_time=None))
+        return output
+
+    def _dump(self, output, filename=None, task_timing=None):
+        """ Dump the output of the task run last to its file, if given,
+            or else with the result_pickler, if any, recording the size of
+            the pickle and the time spent
+        """
+        if filename is None and self.result_pickler is None:
+            return output
+        if task_timing is None:
+            task_timing = self.timings['tasks'][-1]
+        start_time = time.time()
+        if filename is not None:
+            dump(output, filename)
+        else:
+            output = PickledOutput(self.result_pickler(output))
+            task_timing['result_nbytes'] = len(output.data)
+        dump_time = time.time() - start_time
+        task_timing['result_dump_time'] = dump_time
+        self.timings['result_dump_time'] = (
+            (self.timings['result_dump_time'] or 0.) + dump_time)
+        return output
+
+    def __len__(self):
+        return self._size
+
+
+###############################################################################
+# Cache of the functions unpickled in a worker, by pickle or by filename
+_loaded_functions = dict()
+
+
+def _load_function(pickled_function, filename=None):
+    """ Unpickle a function in a worker, from the pickle given, or else
+        from the file, unless it was already unpickled
+    """
+    key = pickled_function if filename is None else filename
+    function = _loaded_functions.get(key)
+    if function is None:
+        if filename is not None:
+            with open(filename, 'rb') as f:
+                pickled_function = f.read()
+        function = pickle.loads(pickled_function)
+        if len(_loaded_functions) >= 100:
+            _loaded_functions.clear()
+        _loaded_functions[key] = function
+    return function
+
+
+class PickledFunction(object):
+    """ A function pickled once in the parent process, and unpickled once
+        by each worker.
+
+        The pickle is sent with the batches, or, if a filename is given,
+        written to this file, that the workers read the first time they
+        meet the function. Large callables, such as the bound methods of
+        large objects, then cross the process boundary once per worker,
+        rather than with every batch.
+    """
+    def __init__(self, pickled_function, filename=None):
+        if filename is not None:
+            if not os.path.exists(filename):
+                # Else, it was written by a previous call
+                with open(filename, 'wb') as f:
+                    f.write(pickled_function)
+            pickled_function = None
+        self._pickled_function = pickled_function
+        self._filename = filename
+
+    def __reduce__(self):
+        return _load_function, (self._pickled_function, self._filename)
+
+
+def _pickle_function(function):
+    """ Return the pickle of the function, by reference, or else by value
+        with cloudpickle, and whether it is by reference. The pickle is
+        None if the function cannot be pickled.
+    """
+    try:
+        return pickle.dumps(function, pickle.HIGHEST_PROTOCOL), True
+    except Exception:
+        pass
+    if cloudpickle is not None:
+        try:
+            return cloudpickle.dumps(function), False
+        except Exception:
+            pass
+    return None, True
+
+
+def _function_key(function):
+    """ Key identifying a function during a call. A bound method is
+        created at each attribute lookup: it is identified by its
+        instance and function.
+    """
+    instance = getattr(function, '__self__', None)
+    func = getattr(function, '__func__', None)
+    if instance is None or func is None:
+        return id(function)
+    return id(instance), id(func)
+
+
 ###############################################################################
 def delayed(function):
     """ Decorator used to capture the arguments of a function.
     """
-    # Try to pickle the input function, to catch the problems early when
-    # using with multiprocessing
-    pickle.dumps(function)
+    if cloudpickle is None:
+        # Try to pickle the input function, to catch the problems early
+        # when using with multiprocessing. With cloudpickle, functions
+        # are pickled by value when they are dispatched.
+        pickle.dumps(function)
 
     def delayed_function(*args, **kwargs):
         return function, args, kwargs
@@ -129,28 +498,330 @@ def delayed(function):
 class ImmediateApply(object):
     """ A non-delayed apply function.
     """
-    def __init__(self, func, args, kwargs):
+    def __init__(self, batch):
         # Don't delay the application, to avoid keeping the input
         # arguments in memory
-        self.results = func(*args, **kwargs)
+        self.results = batch()
 
     def get(self):
         return self.results
 
 
+class RetriedJob(object):
+    """ The job of a batch that is submitted again when it fails with an
+        error to retry: done once the last attempt is
+    """
+    def __init__(self, lock):
+        # The lock under which the job of each attempt is set
+        self._lock = lock
+        self._done = threading.Event()
+        self.job = None
+
+    def wait(self):
+        """ Wait for the last attempt, and return its job
+        """
+        self._done.wait()
+        with self._lock:
+            return self.job
+
+
 ###############################################################################
 class CallBack(object):
-    """ Callback used by parallel: it is used for progress reporting, and
-        to add data to be processed
+    """ Callback used by parallel: it is used for progress reporting, for
+        tuning the size of the batches, and to add data to be processed
     """
-    def __init__(self, index, parallel):
+    def __init__(self, dispatch_timestamp, batch_size, start_index,
+                 parallel):
+        self.dispatch_timestamp = dispatch_timestamp
+        self.batch_size = batch_size
+        # The index in the input of the first task of the batch
+        self.start_index = start_index
         self.parallel = parallel
-        self.index = index
+        # The job is set once the batch is dispatched
+        self.job = None
+        # With retries, the batch, to submit it again, and the job of its
+        # last attempt
+        self.batch = None
+        self.retried_job = None
+        self.attempt = 0
 
     def __call__(self, out):
-        self.parallel.print_progress(self.index)
-        if self.parallel._iterable:
-            self.parallel.dispatch_next()
+        parallel = self.parallel
+        if parallel._aborting:
+            # The batch was cancelled, or its outputs are not needed
+            self._done()
+            return
+        if parallel._nbytes_budget is not None:
+            # The arguments of the batch are replaced by its outputs
+            parallel._complete_batch_nbytes(self.start_index,
+                                            self.batch_size,
+                                            _estimate_nbytes(out[0]))
+        parallel.n_completed_tasks += self.batch_size
+        this_batch_duration = time.time() - self.dispatch_timestamp
+        if (parallel.batch_size == 'auto'
+                and self.batch_size == parallel._effective_batch_size):
+            # Update the exponentially weighted average of the duration
+            # of the batches of the current effective size
+            old_duration = parallel._smoothed_batch_duration
+            if old_duration == 0:
+                new_duration = this_batch_duration
+            else:
+                new_duration = .8 * old_duration + .2 * this_batch_duration
+            parallel._smoothed_batch_duration = new_duration
+        parallel.print_progress()
+        if parallel._iterable:
+            parallel.dispatch_next()
+        self._done()
+
+    def error(self, exception):
+        """ Called instead of the callback when the batch failed
+        """
+        parallel = self.parallel
+        if parallel._aborting:
+            # The failure may come from the cancellation of the call
+            self._done()
+            return
+        if (self.retried_job is not None
+                and parallel._should_retry(exception, self.attempt)):
+            # The batch is still running, as far as the accounting goes
+            parallel._schedule_retry(self, exception)
+            return
+        if parallel._nbytes_budget is not None:
+            parallel._complete_batch_nbytes(self.start_index,
+                                            self.batch_size)
+        if (isinstance(exception, JobTimeoutError)
+                and parallel.on_timeout == 'return'):
+            # The computation goes on
+            parallel.n_completed_tasks += self.batch_size
+            parallel.print_progress()
+            if parallel._iterable:
+                parallel.dispatch_next()
+        self._done()
+
+    def _done(self):
+        """ Flag the last attempt of the batch as done, and queue the
+            batch for retrieval when the batches are retrieved as they
+            complete
+        """
+        if self.retried_job is not None:
+            self.retried_job._done.set()
+        if self.parallel._ready_batches is not None:
+            self.parallel._ready_batches.put(self)
+
+
+###############################################################################
+class DiskOutputs(object):
+    """ Lazy sequence of the outputs of a call of Parallel with
+        return_as='disk', each dumped to a file of a temporary folder.
+
+        The outputs are loaded on access, with numpy_pickle.load: the
+        numpy arrays are memory-mapped with the given mmap_mode, unless
+        it is None. The DiskOutputs owns the folder: it is deleted by the
+        delete method, or at the end of a with block, or else at the exit
+        of the process. The outputs to keep must be copied before.
+
+        Attributes
+        ----------
+        folder: str
+            The folder of the files of the outputs.
+        filenames: list of str
+            The file of each output, in the order of the input.
+    """
+    def __init__(self, folder, filenames, mmap_mode='r'):
+        self.folder = folder
+        self.filenames = filenames
+        self.mmap_mode = mmap_mode
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return load(self.filenames[index], mmap_mode=self.mmap_mode)
+
+    def __iter__(self):
+        for filename in self.filenames:
+            yield load(filename, mmap_mode=self.mmap_mode)
+
+    def delete(self):
+        """ Delete the folder of the outputs
+        """
+        shutil.rmtree(self.folder, ignore_errors=True)
+        _temporary_folders.discard(self.folder)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.delete()
+
+    def __repr__(self):
+        return '%s(%d outputs in %r)' % (self.__class__.__name__,
+                                          len(self), self.folder)
+
+
+###############################################################################
+class ParallelStats(object):
+    """ Statistics on how the time of a call to Parallel was spent, to
+        tune n_jobs, pre_dispatch and batch_size.
+
+        Attributes
+        ----------
+        n_jobs: int
+            The effective number of workers.
+        batches: list of dict
+            The batches of tasks completed, in the order of their
+            retrieval, with the keys:
+
+            - n_tasks: the number of tasks of the batch
+            - worker: the (pid, thread name) of the worker that ran it
+            - dispatch_time: the time.time() of its dispatch
+            - queue_wait: the seconds from its dispatch to the start of
+              its computation by the worker
+            - compute_time: the seconds spent running its tasks
+            - total_time: the seconds from its dispatch to its outputs
+              being received by the parent process
+            - args_nbytes, args_pickle_time: the size of the pickle of
+              the tasks sent to the worker, and the seconds spent
+              pickling them. None without worker processes.
+            - result_dump_time: the seconds spent by the worker pickling
+              the outputs, or dumping them to files with
+              return_as='disk'. None if the backend does not report it,
+              as without worker processes.
+            - result_nbytes, result_unpickle_time: the size of the pickle
+              of the outputs, and the seconds spent unpickling them in
+              the parent process. None without worker processes.
+        tasks: list of dict
+            The tasks of the batches, in the same order, with the keys:
+
+            - index: the position of the task in the input
+            - worker: the worker that ran it
+            - queue_wait: the seconds from the dispatch of its batch to
+              its start, including the tasks of the batch before it
+            - compute_time: the seconds spent running it
+            - result_nbytes, result_dump_time: the size of the pickle of
+              its output, and the seconds spent by the worker pickling it
+              or dumping it to a file. None if the batch does not report
+              them, and, when the outputs are combined in the workers,
+              only given for the batch.
+        wall_time: float
+            The seconds elapsed since the start of the call, until its
+            end.
+    """
+    def __init__(self, n_jobs):
+        self.n_jobs = n_jobs
+        self.batches = list()
+        self.tasks = list()
+        self._start_time = time.time()
+        self._end_time = None
+
+    def _add_batch(self, start_index, n_tasks, timing, transfer_stats=None):
+        """ Record a completed batch, whose first task is the
+            start_index-th of the input, from the timing given by
+            TimedCall, and the transfer statistics recorded by the pool,
+            if any
+        """
+        if transfer_stats is None:
+            transfer_stats = dict()
+        received_time = transfer_stats.get('received_time',
+                                           timing['end_time'])
+        dispatch_time = timing['dispatch_time']
+        result_dump_time = timing.get('result_dump_time')
+        # The time spent dumping the outputs is not computing
+        compute_time = (timing['end_time'] - timing['start_time']
+                        - (result_dump_time or 0.))
+        batch = dict(n_tasks=n_tasks, worker=timing['worker'],
+                     dispatch_time=dispatch_time,
+                     queue_wait=timing['start_time'] - dispatch_time,
+                     compute_time=compute_time,
+                     total_time=received_time - dispatch_time,
+                     result_dump_time=result_dump_time)
+        for key in ('args_nbytes', 'args_pickle_time', 'result_nbytes',
+                    'result_unpickle_time'):
+            batch[key] = transfer_stats.get(key)
+        self.batches.append(batch)
+        for index, task in enumerate(timing.get('tasks', ()), start_index):
+            self.tasks.append(dict(
+                index=index, worker=timing['worker'],
+                queue_wait=task['start_time'] - dispatch_time,
+                compute_time=task['end_time'] - task['start_time'],
+                result_nbytes=task['result_nbytes'],
+                result_dump_time=task['result_dump_time']))
+
+    def _finish(self):
+        self._end_time = time.time()
+
+    @property
+    def wall_time(self):
+        end_time = self._end_time
+        if end_time is None:
+            end_time = time.time()
+        return end_time - self._start_time
+
+    @property
+    def n_tasks(self):
+        """ The number of tasks completed """
+        return sum(batch['n_tasks'] for batch in self.batches)
+
+    @property
+    def throughput(self):
+        """ The number of tasks completed per second """
+        wall_time = self.wall_time
+        return self.n_tasks / wall_time if wall_time > 0 else 0.
+
+    @property
+    def workers(self):
+        """ The n_batches, n_tasks, busy_time, in seconds, and utilization,
+            the fraction of the wall time spent computing, of each worker
+        """
+        workers = dict()
+        for batch in self.batches:
+            worker = workers.setdefault(batch['worker'], dict(
+                n_batches=0, n_tasks=0, busy_time=0.))
+            worker['n_batches'] += 1
+            worker['n_tasks'] += batch['n_tasks']
+            worker['busy_time'] += batch['compute_time']
+        wall_time = self.wall_time
+        for worker in workers.values():
+            worker['utilization'] = (worker['busy_time'] / wall_time
+                                     if wall_time > 0 else 0.)
+        return workers
+
+    @property
+    def utilization(self):
+        """ The fraction of the time of the n_jobs workers spent
+            computing
+        """
+        busy_time = sum(batch['compute_time'] for batch in self.batches)
+        wall_time = self.wall_time
+        if wall_time <= 0:
+            return 0.
+        return busy_time / (self.n_jobs * wall_time)
+
+    def _mean(self, key):
+        values = [batch[key] for batch in self.batches
+                  if batch[key] is not None]
+        return sum(values) / float(len(values)) if values else None
+
+    def __repr__(self):
+        description = ('%s(n_jobs=%d, n_tasks=%d, n_batches=%d, '
+                       'wall_time=%.3fs, throughput=%.1f tasks/s, '
+                       'utilization=%.0f%%'
+                       % (self.__class__.__name__, self.n_jobs,
+                          self.n_tasks, len(self.batches),
+                          self.wall_time,
+                          self.throughput, 100 * self.utilization))
+        for key in ('queue_wait', 'compute_time', 'result_dump_time',
+                    'args_nbytes', 'result_nbytes'):
+            mean = self._mean(key)
+            if mean is None:
+                continue
+            if key.endswith('nbytes'):
+                description += ', mean %s=%d' % (key, mean)
+            else:
+                description += ', mean %s=%.3fs' % (key, mean)
+        return description + ')'
 
 
 ###############################################################################
@@ -174,6 +845,157 @@ class Parallel(Logger):
             The amount of jobs to be pre-dispatched. Default is 'all',
             but it may be memory consuming, for instance if each job
             involves a lot of a data.
+        pre_dispatch_nbytes: int, str or None, optional
+            Memory budget, in bytes, or as a string such as '500M', for
+            the arguments of the jobs dispatched and not completed, and
+            the outputs of the jobs completed and not yet retrieved. Once
+            it is exceeded, the dispatching pauses until outputs are
+            retrieved, so that a producer/consumer pipeline stays within
+            a bounded memory, also when the size of the jobs varies. The
+            sizes are rough estimates: the buffers of the numpy arrays,
+            except memory maps, and the shallow size of the other objects.
+            The size of the outputs of the jobs pending is extrapolated
+            from the outputs seen, and until the first one is, at most
+            2 * n_jobs batches are dispatched. Combines with pre_dispatch,
+            and the batch dispatched last may exceed the budget. Ignored
+            with n_jobs=1.
+        batch_size: int or 'auto', optional
+            The number of consecutive jobs sent at once to a worker.
+            Dispatching many very fast jobs one by one to the workers is
+            slower than running them sequentially, because of the
+            communication overhead; grouping them in batches amortizes
+            this overhead. With 'auto', the default, the batch size is
+            tuned on the fly from the measured duration of the batches.
+            Batching does not change the order of the outputs, and the
+            progress messages still count individual jobs.
+        backend: str, ParallelBackendBase or None, optional
+            The execution backend: the name of a backend registered with
+            register_parallel_backend, or a ParallelBackendBase object.
+            None, the default, selects the backend set with
+            parallel_backend, or else 'multiprocessing'.
+            'multiprocessing' runs the jobs in worker processes, which
+            requires pickling the functions, their arguments and their
+            results. 'threading' runs them in a pool of threads of the
+            current process: arguments and results are passed without
+            any copy, but the jobs only run concurrently if they release
+            the GIL, as numpy or BLAS operations, or I/O, do. 'tcp' runs
+            them in worker processes on other hosts, started with
+            `python -m joblib.tcp_pool host:port`: their addresses are
+            read from the JOBLIB_TCP_WORKERS environment variable, as a
+            comma-separated list of 'host:port', and the key
+            authenticating the connections from JOBLIB_TCP_AUTHKEY. The
+            n_jobs connections are spread over the addresses, and a
+            negative n_jobs counts from their number.
+        temp_folder: str, optional
+            Folder used to dump the large arrays passed to the workers
+            (see max_nbytes). If None, the JOBLIB_TEMP_FOLDER environment
+            variable is used, or else the default temporary folder of the
+            system. On Linux, '/dev/shm' is a good choice if it is large
+            enough, as it is backed by memory.
+        max_nbytes: int, str, or None, optional
+            Threshold on the size of the numpy arrays passed to the
+            workers above which they are dumped once to temp_folder and
+            sent to the workers as memory maps, rather than pickled for
+            each job. Identical arrays are only dumped once, and the
+            files are deleted at the end of the call. The arrays returned
+            by the jobs above this size are also dumped, by the workers,
+            and the outputs are memory maps on these files, rather than
+            copies sent through a pipe. Can be a number of
+            bytes, or a human-readable string, e.g., '1M' for 1
+            megabyte. None, the default, disables this memory mapping.
+            Only used by the 'multiprocessing' backend.
+        mmap_mode: {'r+', 'r', 'w+', 'c'}, optional
+            Memory-mapping mode of the arrays dumped to temp_folder, see
+            numpy.memmap. The default, 'r', gives read-only arrays to the
+            workers, and, with return_as='disk', in the outputs. None
+            loads the outputs in memory.
+        return_as: {'list', 'generator', 'disk'}, optional
+            With 'generator', the call returns a generator yielding the
+            outputs as soon as they are available, rather than a list of
+            all the outputs. With 'disk', each output is dumped to a file
+            of a temporary folder, in temp_folder, as soon as it is
+            computed, by the worker if it shares the filesystem, and the
+            call returns a DiskOutputs, a lazy sequence loading the
+            outputs on access, with mmap_mode, in the order of the input
+            also with ordered=False, for the outputs larger than the
+            memory.
+        ordered: boolean, optional
+            If False, the outputs are given in the order in which the jobs
+            complete, as (index, output) pairs, index being the position
+            of the job in the input.
+        cost: callable, optional
+            Estimate of the duration of the jobs, called with the
+            arguments of each job. If given, the input is consumed
+            entirely to dispatch the most costly jobs first, so that a
+            long job does not end up running alone at the end of the
+            computation. The outputs are still given in the order of the
+            input.
+        inner_max_num_threads: int, 'auto' or None, optional
+            Maximum number of threads used by the native libraries, such
+            as OpenMP or the BLAS called by numpy, in each worker process.
+            Without a limit, each of the n_jobs workers starts as many
+            threads as there are CPUs, which oversubscribes the machine.
+            With 'auto', the default, the CPUs are shared between the
+            workers, unless the corresponding environment variables, e.g.
+            OMP_NUM_THREADS, are already set. None leaves the libraries
+            unconstrained. The limits are set with environment variables,
+            and also with threadpoolctl, if installed, for the libraries
+            already loaded. Only used by the 'multiprocessing' backend.
+        timeout: float, optional
+            Maximum duration of a job, in seconds. The worker process
+            running a job for longer is terminated, and replaced, and the
+            job fails with a JobTimeoutError. With batch_size='auto', the
+            jobs are then not batched; with an integer batch_size, the
+            jobs batched together share a timeout of timeout * batch_size.
+            Only supported by the 'multiprocessing' backend, and ignored
+            with n_jobs=1.
+        on_timeout: {'raise', 'return'}, optional
+            With 'raise', the default, the JobTimeoutError of a job is
+            raised, and the computation is aborted. With 'return', the
+            computation goes on, and the error is the output of the jobs
+            of the batch that timed out.
+        progress_callback: callable, optional
+            Called as progress_callback(n_completed, n_total, elapsed,
+            remaining) as the jobs complete, with the number of jobs
+            completed, the total number of jobs, or None while it is
+            unknown, and the elapsed and estimated remaining times in
+            seconds, or None. The calls are at least MIN_PROGRESS_INTERVAL
+            seconds apart, except for the last one, when all the jobs are
+            done. The callback may be called from a thread of the pool:
+            it should be fast, and thread-safe.
+        initializer: callable, optional
+            Called as initializer(*initargs) once in each worker, before
+            its first job, to set up what the jobs of the worker share,
+            such as a database connection or a loaded model, in the dict
+            returned by get_worker_state(). The workers, and their state,
+            are reused by all the calls made in a with block (see
+            below); else they only last one call. With n_jobs=1, the
+            initializer is called in the calling thread. The error of an
+            initializer is raised by the jobs of its worker.
+        initargs: tuple, optional
+            The arguments of the initializer.
+        retries: int, optional
+            Number of times a batch of jobs failing with an error
+            matching retry_on is run again, in the pool, before its error
+            is raised, for instance for transient I/O errors. The jobs
+            batched together are retried together, and, with n_jobs > 1,
+            the arguments of the batches are kept until their outputs
+            are retrieved. 0, the default, disables the retries.
+        retry_delay: float, optional
+            Delay, in seconds, before the first retry of a batch.
+        retry_backoff: float, optional
+            Factor by which the delay grows at each retry of a batch.
+        retry_on: exception class or tuple of exception classes, optional
+            The errors to retry, matched against the exception raised by
+            the job, or WorkerLostError if its worker died, or
+            JobTimeoutError if it timed out. Defaults to Exception.
+
+        Attributes
+        ----------
+        stats_: ParallelStats
+            Statistics on the last call: the queue wait, compute time,
+            and size of the pickles sent and received of each batch of
+            tasks, and of each task, and the utilization of each worker.
 
         Notes
         -----
@@ -197,6 +1019,10 @@ class Parallel(Logger):
 
             * Interruption of multiprocesses jobs with 'Ctrl-C'
 
+            * A worker process dying while running a job, for instance
+              from a segmentation fault, raises a WorkerLostError
+              instead of hanging the computation
+
         Examples
         --------
 
@@ -262,6 +1088,17 @@ class Parallel(Logger):
          ___________________________________________________________________________
 
 
+        Using the Parallel object as a context manager, the same pool of
+        workers is reused across successive calls, which saves the cost of
+        starting the workers, and keeps their state, such as the imported
+        modules, warm::
+
+         >>> from math import sqrt
+         >>> from joblib import Parallel, delayed
+         >>> with Parallel(n_jobs=2) as parallel:
+         ...     for n in range(3):
+         ...         out = parallel(delayed(sqrt)(i ** 2) for i in range(n))
+
         Using pre_dispatch in a producer/consumer situation, where the
         data is generated on the fly. Note how the producer is first
         called a 3 times before the parallel loop is initiated, and then
@@ -291,65 +1128,420 @@ class Parallel(Logger):
          [Parallel(n_jobs=2)]: Done   5 out of   6 | elapsed:    0.0s remaining:    0.0s
          [Parallel(n_jobs=2)]: Done   6 out of   6 | elapsed:    0.0s finished
     '''
-    def __init__(self, n_jobs=1, verbose=0, pre_dispatch='all'):
+    def __init__(self, n_jobs=1, verbose=0, pre_dispatch='all',
+                 batch_size='auto', backend=None,
+                 temp_folder=None, max_nbytes=None, mmap_mode='r',
+                 return_as='list', ordered=True, cost=None,
+                 inner_max_num_threads='auto', timeout=None,
+                 on_timeout='raise', progress_callback=None,
+                 pre_dispatch_nbytes=None, initializer=None, initargs=(),
+                 retries=0, retry_delay=.1, retry_backoff=2.,
+                 retry_on=Exception):
+        self.backend = backend
+        self._backend = _get_backend(backend)
         self.verbose = verbose
         self.n_jobs = n_jobs
         self.pre_dispatch = pre_dispatch
+        if (batch_size != 'auto'
+                and not (isinstance(batch_size, int) and batch_size > 0)):
+            raise ValueError(
+                "batch_size must be 'auto' or a positive integer, got: %r"
+                % batch_size)
+        self.batch_size = batch_size
+        self.temp_folder = temp_folder
+        if isinstance(max_nbytes, _basestring):
+            max_nbytes = 1024 * memstr_to_kbytes(max_nbytes)
+        self.max_nbytes = max_nbytes
+        self.mmap_mode = mmap_mode
+        if return_as not in ('list', 'generator', 'disk'):
+            raise ValueError("return_as must be 'list', 'generator' or "
+                             "'disk', got: %r" % return_as)
+        self.return_as = return_as
+        self.ordered = ordered
+        self.cost = cost
+        if (inner_max_num_threads not in ('auto', None)
+                and not (isinstance(inner_max_num_threads, int)
+                         and inner_max_num_threads > 0)):
+            raise ValueError(
+                "inner_max_num_threads must be 'auto', None or a positive "
+                "integer, got: %r" % inner_max_num_threads)
+        self.inner_max_num_threads = inner_max_num_threads
+        if timeout is not None and timeout <= 0:
+            raise ValueError('timeout must be positive, got: %r' % timeout)
+        if timeout is not None and not self._backend.supports_timeout:
+            raise ValueError('The %s backend does not support timeouts'
+                             % self._backend.__class__.__name__)
+        self.timeout = timeout
+        if on_timeout not in ('raise', 'return'):
+            raise ValueError("on_timeout must be 'raise' or 'return', "
+                             "got: %r" % on_timeout)
+        self.on_timeout = on_timeout
+        self.progress_callback = progress_callback
+        if isinstance(pre_dispatch_nbytes, _basestring):
+            pre_dispatch_nbytes = 1024 * memstr_to_kbytes(pre_dispatch_nbytes)
+        self.pre_dispatch_nbytes = pre_dispatch_nbytes
+        if initializer is not None and not callable(initializer):
+            raise ValueError('initializer must be callable, got: %r'
+                             % (initializer,))
+        self.initializer = initializer
+        self.initargs = tuple(initargs)
+        if not (isinstance(retries, int) and retries >= 0):
+            raise ValueError('retries must be a non-negative integer, '
+                             'got: %r' % (retries,))
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.retry_backoff = retry_backoff
+        self.retry_on = retry_on
+        # The timers of the retries to come
+        self._retry_timers = set()
+        self._nbytes_budget = None
         self._pool = None
         # Not starting the pool in the __init__ is a design decision, to be
         # able to close it ASAP, and not burden the user with closing it.
+        # When used as a context manager, the pool is started in __enter__
+        # and reused by all the calls until __exit__.
+        self._managed_pool = False
+        self._pool_n_jobs = None
+        # The queue of completed batches, when retrieving the outputs
+        # in the order of completion
+        self._ready_batches = None
+        # The jobs in the order of dispatch: a deque is used, as the jobs
+        # are appended and popped at opposite ends
+        self._jobs = deque()
+        # The (function, wrapper) pairs of the functions of the call, by
+        # function key, when using a process pool
+        self._function_wrappers = None
+        # The folder of the large functions sent to the workers of the
+        # pool
+        self._function_folder = None
+        # The outputs gathered by the deprecated retrieve method
         self._output = None
-        self._jobs = list()
+        # The statistics of the last call
+        self.stats_ = None
+        # The function combining the outputs, during a call of reduce
+        self._combine = None
+        # The folder of the outputs of the call, with return_as='disk'
+        self._output_folder = None
+        self._dump_in_workers = False
+        # The lock protects the consumption of the input iterator and the
+        # dispatching of the jobs, which the callback thread also does
+        self._lock = threading.Lock()
         # A flag used to abort the dispatching of jobs in case an
         # exception is found
         self._aborting = False
+        # The flag cancelling the batches dispatched, during a call
+        self._cancel_flag = None
 
-    def dispatch(self, func, args, kwargs):
-        """ Queue the function for computing, with or without multiprocessing
+    def dispatch(self, batch):
+        """ Queue the batch for computing, with or without multiprocessing
+
+            The caller is expected to hold self._lock.
         """
+        if self._dump_in_workers:
+            batch.filenames = [
+                self._get_output_filename(position) for position in
+                range(self.n_dispatched_tasks,
+                      self.n_dispatched_tasks + len(batch))]
         if self._pool is None:
-            job = ImmediateApply(func, args, kwargs)
-            index = len(self._jobs)
-            if not _verbosity_filter(index, self.verbose):
+            attempt = 0
+            while True:
+                try:
+                    job = ImmediateApply(TimedCall(batch, batch))
+                    break
+                except Exception as exception:
+                    if not self._should_retry(exception, attempt):
+                        raise
+                    time.sleep(self._get_retry_delay(attempt))
+                    attempt += 1
+            self._jobs.append((self.n_dispatched_tasks, len(batch), job))
+            self.n_dispatched_batches += 1
+            self.n_dispatched_tasks += len(batch)
+            self.n_completed_tasks += len(batch)
+            if self.progress_callback is not None:
+                self._report_progress()
+            if not _verbosity_filter(self.n_dispatched_batches - 1,
+                                     self.verbose):
                 self._print('Done %3i jobs       | elapsed: %s',
-                        (index + 1,
+                        (self.n_completed_tasks,
                             short_format_time(time.time() - self._start_time)
                         ))
-            self._jobs.append(job)
-            self.n_dispatched += 1
         else:
             # If job.get() catches an exception, it closes the queue:
             if self._aborting:
                 return
             try:
-                self._lock.acquire()
-                job = self._pool.apply_async(SafeFunction(func), args,
-                            kwargs, callback=CallBack(self.n_dispatched, self))
-                self._jobs.append(job)
-                self.n_dispatched += 1
+                if self._function_wrappers is not None:
+                    batch.items = [(self._wrap_function(func), args, kwargs)
+                                   for func, args, kwargs in batch.items]
+                    if batch.combine is not None:
+                        batch.combine = self._wrap_function(batch.combine)
+                batch.cancel_flag = self._cancel_flag
+                if not self._dump_in_workers:
+                    batch.result_pickler = self._backend.result_pickler
+                callback = CallBack(time.time(), len(batch),
+                                    self.n_dispatched_tasks, self)
+                if self._nbytes_budget is not None:
+                    nbytes = _estimate_nbytes(batch.items)
+                    self._batch_nbytes[callback.start_index] = nbytes
+                    self._pending_nbytes += nbytes
+                    self._n_running_tasks += len(batch)
+                if self.retries:
+                    # Before the submission, as the job may fail before
+                    # it returns
+                    callback.batch = batch
+                    callback.retried_job = RetriedJob(self._lock)
+                job = self._submit(batch, callback)
+                if callback.retried_job is not None:
+                    callback.retried_job.job = job
+                    job = callback.retried_job
+                callback.job = job
+                if self._ready_batches is None:
+                    # The jobs retrieved in order are queued here. Else
+                    # the callbacks queue them as they are done.
+                    self._jobs.append((callback.start_index, len(batch),
+                                       job))
+                self.n_dispatched_batches += 1
+                self.n_dispatched_tasks += len(batch)
             except AssertionError:
                 print('[Parallel] Pool seems closed')
-            finally:
-                self._lock.release()
+
+    def _submit(self, batch, callback):
+        """ Submit the batch to the backend, and return its job
+        """
+        timeout = None
+        if self.timeout is not None:
+            timeout = self.timeout * len(batch)
+        return self._pool.submit(
+            TimedCall(SafeFunction(batch), batch), callback=callback,
+            error_callback=callback.error, timeout=timeout)
+
+    def _should_retry(self, exception, attempt):
+        """ Whether a batch failing with the exception on the given
+            attempt, counted from 0, is to be submitted again
+        """
+        if attempt >= self.retries:
+            return False
+        if isinstance(exception, TransportableException):
+            # Raised by the job in the worker
+            exception_type = exception.etype
+        else:
+            exception_type = type(exception)
+        return (issubclass(exception_type, self.retry_on)
+                and not issubclass(exception_type,
+                                   (KeyboardInterrupt, WorkerInterrupt)))
+
+    def _get_retry_delay(self, attempt):
+        return self.retry_delay * self.retry_backoff ** attempt
+
+    def _schedule_retry(self, callback, exception):
+        """ Submit the batch of the callback again, after the delay of its
+            attempt, from a timer thread
+        """
+        if self._aborting:
+            callback._done()
+            return
+        if self.verbose:
+            exception_type = getattr(exception, 'etype', type(exception))
+            self._print('Retrying %i jobs after a %s',
+                        (callback.batch_size, exception_type.__name__))
+        timer = threading.Timer(self._get_retry_delay(callback.attempt),
+                                self._retry, args=(callback,))
+        timer.daemon = True
+        with self._lock:
+            self._retry_timers.add(timer)
+            timer.start()
+
+    def _retry(self, callback):
+        with self._lock:
+            timer = threading.current_thread()
+            if timer not in self._retry_timers:
+                # Cancelled by _abort, which flagged the batch as done
+                return
+            self._retry_timers.discard(timer)
+            if self._aborting or self._pool is None:
+                # The failed job is left as the last attempt
+                callback._done()
+                return
+            callback.attempt += 1
+            callback.dispatch_timestamp = time.time()
+            callback.retried_job.job = self._submit(callback.batch, callback)
+
+    def _wrap_function(self, function):
+        """ Return what to send to the workers for the function: the
+            function itself, if it is small and can be pickled by
+            reference, else a PickledFunction, shared by all the tasks of
+            the call
+        """
+        key = _function_key(function)
+        try:
+            return self._function_wrappers[key][1]
+        except KeyError:
+            pass
+        pickled_function, by_reference = _pickle_function(function)
+        if pickled_function is None:
+            # The pool reports the error for the jobs
+            wrapper = function
+        elif (len(pickled_function) > MIN_BROADCAST_NBYTES
+                # Else the workers cannot read the file
+                and self._backend.shares_filesystem):
+            wrapper = PickledFunction(
+                pickled_function, self._get_function_filename(
+                    pickled_function))
+        elif by_reference:
+            wrapper = function
+        else:
+            wrapper = PickledFunction(pickled_function)
+        # A reference to the function is kept, so that its key is not
+        # reused during the call
+        self._function_wrappers[key] = (function, wrapper)
+        return wrapper
+
+    def _get_function_filename(self, pickled_function):
+        """ Return the file in which the workers find the large function
+            pickled: its name is the hash of the pickle, so that the
+            function is only written once for the pool
+        """
+        if self._function_folder is None:
+            self._function_folder = tempfile.mkdtemp(
+                prefix='joblib_functions_', dir=self._get_temp_folder())
+            _temporary_folders.add(self._function_folder)
+        return os.path.join(self._function_folder, '%s.pkl'
+                            % hashlib.md5(pickled_function).hexdigest())
+
+    def _get_temp_folder(self):
+        """ Return the folder of the temporary files, None for the default
+            temporary folder of the system
+        """
+        if self.temp_folder is not None:
+            return self.temp_folder
+        return os.environ.get('JOBLIB_TEMP_FOLDER', None)
+
+    def _delete_function_folder(self):
+        if self._function_folder is not None:
+            delete_folder(self._function_folder)
+            _temporary_folders.discard(self._function_folder)
+            self._function_folder = None
+
+    def _get_batch_size(self):
+        """ Return the size of the next batch, tuning it if batch_size is
+            'auto'
+        """
+        if self.batch_size != 'auto':
+            return self.batch_size
+        if self._pool is None or not self._backend.pickles_tasks:
+            # No communication overhead to amortize
+            return 1
+        if self.timeout is not None:
+            # The jobs batched together share a timeout: each job gets
+            # its own
+            return 1
+        old_batch_size = self._effective_batch_size
+        batch_duration = self._smoothed_batch_duration
+        if 0 < batch_duration < MIN_IDEAL_BATCH_DURATION:
+            # The batches are too short to hide the dispatching
+            # overhead. We multiply by two to limit oscillations.
+            ideal_batch_size = int(old_batch_size
+                                   * MIN_IDEAL_BATCH_DURATION
+                                   / batch_duration)
+            batch_size = max(2 * ideal_batch_size, 1)
+            if self.verbose >= 10 and batch_size != old_batch_size:
+                self._print('Batch computation too fast (%.4fs.) '
+                            'Setting batch_size=%d.',
+                            (batch_duration, batch_size))
+        elif (batch_duration > MAX_IDEAL_BATCH_DURATION
+                and old_batch_size >= 2):
+            # Overly long batches risk leaving CPUs idle at the end of
+            # the computation, waiting on a few stragglers
+            batch_size = old_batch_size // 2
+            if self.verbose >= 10:
+                self._print('Batch computation too slow (%.2fs.) '
+                            'Setting batch_size=%d.',
+                            (batch_duration, batch_size))
+        else:
+            batch_size = old_batch_size
+        if batch_size != old_batch_size:
+            # The duration estimate is only valid for a given batch size
+            self._effective_batch_size = batch_size
+            self._smoothed_batch_duration = 0
+        return batch_size
+
+    def dispatch_one_batch(self, iterator):
+        """ Dispatch the next batch of tasks taken from the iterator.
+
+            Returns False if the iterator is exhausted. The consumption
+            of the iterator and the dispatching are done under the same
+            lock, so that batches are queued in the order of the input.
+        """
+        batch_size = self._get_batch_size()
+        with self._lock:
+            if self._aborting:
+                return False
+            batch = BatchedCalls(itertools.islice(iterator, batch_size),
+                                 combine=self._combine)
+            if not len(batch):
+                return False
+            self.dispatch(batch)
+            return True
 
     def dispatch_next(self):
         """ Dispatch more data for parallel processing
         """
-        self._dispatch_amount += 1
-        while self._dispatch_amount:
-            try:
-                # XXX: possible race condition shuffling the order of
-                # dispatches in the next two lines.
-                func, args, kwargs = next(self._iterable)
-                self.dispatch(func, args, kwargs)
-                self._dispatch_amount -= 1
-            except ValueError:
-                """ Race condition in accessing a generator, we skip,
-                    the dispatch will be done later.
-                """
-            except StopIteration:
-                self._iterable = None
-                return
+        iterable = self._iterable
+        if iterable is None or self._over_nbytes_budget():
+            # When over the budget, the dispatching is resumed as the
+            # outputs are retrieved
+            return
+        if not self.dispatch_one_batch(iterable):
+            self._iterable = None
+            self._n_total_tasks = self.n_dispatched_tasks
+
+    def _over_nbytes_budget(self):
+        """ Whether the memory budget of the jobs dispatched is exceeded.
+            It never is without jobs pending, so that the computation
+            progresses.
+        """
+        budget = self._nbytes_budget
+        if budget is None:
+            return False
+        if not self._n_output_tasks:
+            # The size of the outputs is not known yet
+            return len(self._batch_nbytes) >= self._max_unsized_batches
+        # The outputs of the tasks running are expected to be as large as
+        # the outputs seen so far
+        nbytes = self._pending_nbytes + (
+            self._output_nbytes * self._n_running_tasks
+            // self._n_output_tasks)
+        return nbytes > 0 and nbytes >= budget
+
+    def _complete_batch_nbytes(self, start_index, n_tasks, nbytes=None):
+        """ Account for the memory of the outputs of the batch starting at
+            start_index, instead of its arguments, once completed. nbytes
+            is None if the batch failed.
+        """
+        with self._lock:
+            self._pending_nbytes += (
+                (nbytes or 0) - self._batch_nbytes.get(start_index, 0))
+            self._batch_nbytes[start_index] = nbytes or 0
+            self._n_running_tasks -= n_tasks
+            if nbytes is not None:
+                self._output_nbytes += nbytes
+                self._n_output_tasks += n_tasks
+
+    def _release_nbytes(self, start_index):
+        """ Release the memory accounted for a batch whose outputs are
+            retrieved, and resume the dispatching paused by the budget
+        """
+        if self._nbytes_budget is None:
+            return
+        with self._lock:
+            self._pending_nbytes -= self._batch_nbytes.pop(start_index, 0)
+        while (self._iterable is not None
+                and not self._over_nbytes_budget()
+                and not self._aborting
+                and (not self._pre_dispatch_amount
+                     or self.n_dispatched_tasks - self.n_completed_tasks
+                     < self._pre_dispatch_amount)):
+            self.dispatch_next()
 
     def _print(self, msg, msg_args):
         """ Display the message on stout or stderr depending on verbosity
@@ -365,13 +1557,41 @@ class Parallel(Logger):
         msg = msg % msg_args
         writer('[%s]: %s\n' % (self, msg))
 
-    def print_progress(self, index):
+    def _report_progress(self, finished=False):
+        """ Call the progress callback, unless it was called less than
+            MIN_PROGRESS_INTERVAL seconds ago, and the call is not
+            finished
+        """
+        now = time.time()
+        if (not finished and
+                now - self._last_progress_time < MIN_PROGRESS_INTERVAL):
+            return
+        self._last_progress_time = now
+        n_completed = self.n_completed_tasks
+        n_total = self._n_total_tasks
+        elapsed_time = now - self._start_time
+        remaining_time = None
+        if n_total is not None and n_completed:
+            remaining_time = (elapsed_time / n_completed
+                              * (n_total - n_completed))
+        try:
+            self.progress_callback(n_completed, n_total, elapsed_time,
+                                   remaining_time)
+        except Exception as exception:
+            # Raising in the callback thread of the pool would hang it
+            warnings.warn('Error in the progress callback: %r' % exception)
+
+    def print_progress(self):
         """Display the process of the parallel execution only a fraction
-           of time, controlled by self.verbose.
+           of time, controlled by self.verbose, and report it to the
+           progress callback.
         """
+        if self.progress_callback is not None:
+            self._report_progress()
         if not self.verbose:
             return
         elapsed_time = time.time() - self._start_time
+        index = self.n_completed_tasks - 1
 
         # This is heuristic code to print only 'verbose' times a messages
         # The challenge is that we may not know the queue length
@@ -384,7 +1604,7 @@ class Parallel(Logger):
                         ))
         else:
             # We are finished dispatching
-            queue_length = self.n_dispatched
+            queue_length = self.n_dispatched_tasks
             # We always display the first loop
             if not index == 0:
                 # Display depending on the number of remaining items
@@ -396,7 +1616,7 @@ class Parallel(Logger):
                 if (is_last_item or cursor % frequency):
                     return
             remaining_time = (elapsed_time / (index + 1) *
-                        (self.n_dispatched - index - 1.))
+                        (self.n_dispatched_tasks - index - 1.))
             self._print('Done %3i out of %3i | elapsed: %s remaining: %s',
                         (index + 1,
                          queue_length,
@@ -405,132 +1625,525 @@ class Parallel(Logger):
                         ))
 
     def retrieve(self):
-        self._output = list()
-        while self._jobs:
-            # We need to be careful: the job queue can be filling up as
-            # we empty it
-            if hasattr(self, '_lock'):
-                self._lock.acquire()
-            job = self._jobs.pop(0)
-            if hasattr(self, '_lock'):
-                self._lock.release()
-            try:
-                self._output.append(job.get())
-            except tuple(self.exceptions) as exception:
-                try:
-                    self._aborting = True
-                    self._lock.acquire()
-                    if isinstance(exception,
-                            (KeyboardInterrupt, WorkerInterrupt)):
-                        # We have captured a user interruption, clean up
-                        # everything
-                        if hasattr(self, '_pool'):
-                            self._pool.close()
-                            self._pool.terminate()
-                            # We can now allow subprocesses again
-                            os.environ.pop('__JOBLIB_SPAWNED_PARALLEL__', 0)
-                        raise exception
-                    elif isinstance(exception, TransportableException):
-                        # Capture exception to add information on the local
-                        # stack in addition to the distant stack
-                        this_report = format_outer_frames(context=10,
-                                                        stack_start=1)
-                        report = """Multiprocessing exception:
+        """ Retrieve the outputs of the jobs dispatched in self._output.
+
+            Deprecated: the call of the Parallel object returns the
+            outputs, or, with return_as='generator', yields them as they
+            are available.
+        """
+        warnings.warn('Parallel.retrieve is deprecated and will be '
+                      'removed in a future version: the outputs are '
+                      'returned by the call of the Parallel object',
+                      DeprecationWarning, stacklevel=2)
+        self._output = list(self._retrieve())
+
+    def _retrieve(self):
+        """ Generator of the outputs of the jobs, in the order of the input,
+            or as (index, output) pairs in the order of completion if
+            self.ordered is False
+        """
+        if self._ready_batches is not None:
+            jobs = self._iter_ready_jobs()
+        else:
+            jobs = self._iter_ordered_jobs()
+        for start_index, n_tasks, job in jobs:
+            outputs = self._get_job_outputs(start_index, job, n_tasks)
+            self._release_nbytes(start_index)
+            for output in self._collate(start_index, outputs):
+                yield output
+
+    def _get_job_outputs(self, start_index, job, n_tasks):
+        """ Return the list of outputs of a batch of n_tasks tasks, the
+            first of which was the start_index-th dispatched, or raise
+            its error. With return_as='disk', the outputs are the files
+            they are dumped to.
+        """
+        if isinstance(job, RetriedJob):
+            job = job.wait()
+        try:
+            if isinstance(job, ImmediateApply):
+                outputs, timing = job.get()
+            else:
+                outputs, timing = self._backend.collect(job)
+        except JobTimeoutError as exception:
+            if self.on_timeout == 'return' and self._combine is None:
+                return self._dump_outputs(start_index,
+                                          [exception] * n_tasks)
+            self._raise_error(exception)
+        except tuple(self.exceptions) as exception:
+            self._raise_error(exception)
+        # Recorded by the process pools
+        transfer_stats = getattr(job, '_transfer_stats', None)
+        self.stats_._add_batch(start_index, n_tasks, timing, transfer_stats)
+        if not self._dump_in_workers:
+            outputs = self._dump_outputs(start_index, outputs)
+        return outputs
+
+    def _get_output_filename(self, position):
+        return os.path.join(self._output_folder, 'output_%d.pkl' % position)
+
+    def _dump_outputs(self, start_index, outputs):
+        """ Dump the outputs of a batch, with return_as='disk', and return
+            their files
+        """
+        if self._output_folder is None:
+            return outputs
+        filenames = list()
+        for position, output in enumerate(outputs, start_index):
+            filename = self._get_output_filename(position)
+            dump(output, filename)
+            filenames.append(filename)
+        return filenames
+
+    def _make_disk_outputs(self, outputs):
+        """ Return the DiskOutputs of the call, from the files of the
+            outputs retrieved
+        """
+        if not self.ordered:
+            outputs = [filename for _, filename in sorted(outputs)]
+        disk_outputs = DiskOutputs(self._output_folder, outputs,
+                                   mmap_mode=self.mmap_mode)
+        # The folder now belongs to the DiskOutputs
+        self._output_folder = None
+        return disk_outputs
+
+    def _collate(self, start_index, outputs):
+        """ Return what to yield for the outputs of a batch, the first
+            task of which was the start_index-th dispatched: the outputs
+            that are next in the order of the input, or (index, output)
+            pairs if self.ordered is False
+        """
+        if self._combine is not None or (self.ordered
+                                         and self._ready_batches is None):
+            # The batches are retrieved in the order of the input, or
+            # reduced: their outputs are combined in the order of
+            # retrieval
+            return outputs
+        order = self._dispatch_order
+        pending = self._pending_outputs
+        items = list()
+        for position, output in enumerate(outputs, start_index):
+            index = position if order is None else order[position]
+            if self.ordered:
+                pending[index] = output
+            else:
+                items.append((index, output))
+        while self._n_collated_tasks in pending:
+            items.append(pending.pop(self._n_collated_tasks))
+            self._n_collated_tasks += 1
+        return items
+
+    def _raise_error(self, exception):
+        """ Abort the computation, and raise the exception caught when
+            retrieving the output of a job, adding the local stack to
+            the traceback of the worker
+        """
+        # Whether a job failed or the user interrupted the computation,
+        # the other jobs are useless
+        self._abort()
+        if isinstance(exception, (KeyboardInterrupt, WorkerInterrupt)):
+            # We have captured a user interruption, clean up everything:
+            # the pool is started again by the next call
+            self._terminate_pool(wait=False)
+        if isinstance(exception, TransportableException):
+            # Capture exception to add information on the local
+            # stack in addition to the distant stack
+            this_report = format_outer_frames(context=10,
+                                            stack_start=2)
+            report = """Multiprocessing exception:
     %s
     ---------------------------------------------------------------------------
     Sub-process traceback:
     ---------------------------------------------------------------------------
     %s""" % (
-                                this_report,
-                                exception.message,
-                            )
-                        # Convert this to a JoblibException
-                        exception_type = _mk_exception(exception.etype)[0]
-                        raise exception_type(report)
-                    raise exception
-                finally:
-                    self._lock.release()
-
-    def __call__(self, iterable):
-        if self._jobs:
-            raise ValueError('This Parallel instance is already running')
-        n_jobs = self.n_jobs
-        if n_jobs < 0 and multiprocessing is not None:
-            n_jobs = max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
-
+                    this_report,
+                    exception.message,
+                )
+            # Convert this to a JoblibException
+            exception_type = _mk_exception(exception.etype)[0]
+            exception = exception_type(report)
+            # The constructor of the original exception does not set the
+            # message of the repr under Python 3
+            exception.message = report
+        raise exception
+
+    def _abort(self):
+        """ Stop dispatching jobs, and cancel the jobs already dispatched:
+            the workers skip the batches that they have not started, and
+            the backend stops those running, terminating the worker
+            processes running them, which are replaced.
+        """
+        self._aborting = True
+        with self._lock:
+            # Wait for a dispatch in progress: no job is dispatched from
+            # now on
+            if self._cancel_flag is not None:
+                self._cancel_flag.set()
+            for timer in self._retry_timers:
+                timer.cancel()
+                # The batch is left with its failed attempt
+                timer.args[0]._done()
+            self._retry_timers.clear()
+        if self._pool is not None:
+            # The failed jobs call back without the lock
+            self._pool.abort()
+
+    def _iter_ordered_jobs(self):
+        """ Generator of the (start_index, n_tasks, job) of the batches,
+            in the order of dispatch
+        """
+        while True:
+            if self._pool is None and not self._jobs:
+                # Lazy sequential mode: compute the next batch on demand
+                self.dispatch_next()
+            # We need to be careful: the job queue can be filling up as
+            # we empty it. No lock is needed: the jobs are appended in
+            # order under the lock, and deque.popleft is atomic. The
+            # queue is only empty once all the jobs are dispatched, as
+            # the callback of a job dispatches the next one before the
+            # job is flagged as done.
+            try:
+                job = self._jobs.popleft()
+            except IndexError:
+                break
+            yield job
+
+    def _iter_ready_jobs(self):
+        """ Generator of the (start_index, n_tasks, job) of the batches,
+            in the order of completion
+        """
+        # The callbacks dispatch the next batches before queuing their
+        # own: once all the batches dispatched are retrieved, the
+        # iteration is over.
+        while self._n_retrieved_batches < self.n_dispatched_batches:
+            callback = self._ready_batches.get()
+            self._n_retrieved_batches += 1
+            with self._lock:
+                # The job is set by dispatch while holding the lock
+                job = callback.job
+            callback.job = None
+            yield callback.start_index, callback.batch_size, job
+
+
+    def __enter__(self):
+        self._managed_pool = True
+        self._initialize_pool()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._terminate_pool()
+        self._managed_pool = False
+
+    def _initialize_pool(self):
+        """ Start the workers of the backend, and return the effective
+            number of jobs
+        """
+        n_jobs = self._backend.effective_n_jobs(self.n_jobs)
         # The list of exceptions that we will capture
         self.exceptions = [TransportableException]
-        if n_jobs is None or multiprocessing is None or n_jobs == 1:
-            n_jobs = 1
+        self._pool = None
+        if n_jobs > 1:
+            # The backend may fall back to running the jobs sequentially
+            n_jobs = self._backend.start(n_jobs, self)
+        if n_jobs > 1:
+            self._pool = self._backend
+            # We also want to capture KeyboardInterrupts, and the errors
+            # of the backend, such as the death of the workers
+            self.exceptions.extend([KeyboardInterrupt, WorkerInterrupt])
+            self.exceptions.extend(self._backend.exceptions)
+        elif self.initializer is not None:
+            # The calling thread is the only worker
+            self.initializer(*self.initargs)
+        self._pool_n_jobs = n_jobs
+        return n_jobs
+
+    def get_initializers(self):
+        """ Return the list of the (initializer, initargs) pairs that
+            each worker of the backend calls, with
+            run_worker_initializers, before its first job
+        """
+        if self.initializer is None:
+            return []
+        return [(self.initializer, self.initargs)]
+
+    def _terminate_pool(self, wait=True):
+        """ Stop the workers, waiting for them to finish their jobs,
+            unless wait is False
+        """
+        if self._pool is not None:
+            self._pool.terminate(wait=wait)
             self._pool = None
+        self._delete_function_folder()
+
+    def _initialize_call(self):
+        """ Check that no call is running, make sure that the pool is
+            started, and return the effective number of jobs
+        """
+        if self._jobs:
+            raise ValueError('This Parallel instance is already running')
+        if not self._managed_pool:
+            n_jobs = self._initialize_pool()
         else:
-            if multiprocessing.current_process()._daemonic:
-                # Daemonic processes cannot have children
-                n_jobs = 1
-                self._pool = None
-                warnings.warn(
-                    'Parallel loops cannot be nested, setting n_jobs=1',
-                    stacklevel=2)
-            else:
-                already_forked = int(os.environ.get('__JOBLIB_SPAWNED_PARALLEL__', 0))
-                if already_forked:
-                    raise ImportError('[joblib] Attempting to do parallel computing'
-                            'without protecting your import on a system that does '
-                            'not support forking. To use parallel-computing in a '
-                            'script, you must protect you main loop using "if '
-                            "__name__ == '__main__'"
-                            '". Please see the joblib documentation on Parallel '
-                            'for more information'
-                        )
-
-                # Set an environment variable to avoid infinite loops
-                os.environ['__JOBLIB_SPAWNED_PARALLEL__'] = '1'
-                self._pool = multiprocessing.Pool(n_jobs)
-                self._lock = threading.Lock()
-                # We are using multiprocessing, we also want to capture
-                # KeyboardInterrupts
-                self.exceptions.extend([KeyboardInterrupt, WorkerInterrupt])
+            n_jobs = self._pool_n_jobs
+            if n_jobs > 1 and self._pool is None:
+                # The pool was terminated after an interruption
+                n_jobs = self._initialize_pool()
+        return n_jobs
+
+    def __call__(self, iterable):
+        n_jobs = self._initialize_call()
+        output = self._get_outputs(iterable, n_jobs)
+        # Start the computation, and dispatch the first batches, right away
+        next(output)
+        if self.return_as == 'generator':
+            return output
+        if self.return_as == 'disk':
+            return self._make_disk_outputs(list(output))
+        return list(output)
+
+    def reduce(self, combine, iterable, initial=_NO_OUTPUT):
+        """ Run the jobs, and return the reduction of their outputs with
+            combine, as functools.reduce, without keeping all the outputs.
+
+            The outputs of the jobs of a batch are combined in the worker,
+            and the results of the batches are combined as they are
+            retrieved. Thus, only the results of the batches pending are
+            held at once, and the larger the batches, the more of the
+            reduction is done in the workers.
+
+            combine(a, b) must be associative. With ordered=True, the
+            outputs are combined in the order of the input, else, or if
+            cost is given, in the order of completion of the batches,
+            and combine must also be commutative. on_timeout and
+            return_as are ignored: the timeouts raise an error, and a
+            single value is returned.
+
+            Example
+            -------
+
+            >>> from operator import add
+            >>> from joblib import Parallel, delayed
+            >>> Parallel(n_jobs=2).reduce(add, (delayed(abs)(-i)
+            ...                                 for i in range(10)))
+            45
+        """
+        n_jobs = self._initialize_call()
+        self._combine = combine
+        outputs = self._get_outputs(iterable, n_jobs)
+        result = initial
+        try:
+            next(outputs)
+            for output in outputs:
+                if result is _NO_OUTPUT:
+                    result = output
+                else:
+                    result = combine(result, output)
+        finally:
+            # Releases the resources of the call on an error
+            outputs.close()
+            self._combine = None
+        if result is _NO_OUTPUT:
+            raise TypeError('reduce of an empty input with no initial '
+                            'value')
+        return result
+
+    def as_async(self, iterable):
+        """ Asynchronous version of the call, for use with asyncio.
+
+            Returns an awaitable giving the same output as calling the
+            Parallel object, or, if return_as is 'generator', an
+            asynchronous iterator over the outputs. The jobs are
+            dispatched to the same pool, and their outputs are handed to
+            the event loop by the callbacks of the pool, without blocking
+            the loop. With n_jobs=1, the jobs run in the thread of the
+            event loop.
+
+            Requires Python 3.7 or later.
+        """
+        from ._parallel_async import as_async
+        return as_async(self, iterable)
+
+    def _start(self, iterable, n_jobs, ready_batches=None):
+        """ Reset the state of the call and dispatch the first batches.
 
+            ready_batches is the queue on which the callbacks put the
+            completed batches, if the outputs are retrieved in the order
+            of completion.
+        """
         pre_dispatch = self.pre_dispatch
+        # The position in the input of the tasks, in the order of
+        # dispatch, if it differs
+        self._dispatch_order = None
+        if self.cost is not None and n_jobs > 1:
+            # Longest processing time first scheduling: the most costly
+            # tasks are dispatched first, and the cheap ones fill the
+            # gaps at the end
+            iterable = list(iterable)
+            costs = [self.cost(*args, **kwargs)
+                     for _, args, kwargs in iterable]
+            # The sort is stable: ties are dispatched in the input order
+            self._dispatch_order = order = sorted(
+                range(len(iterable)), key=costs.__getitem__, reverse=True)
+            iterable = [iterable[i] for i in order]
         if isinstance(iterable, list):
             # We are given a list. No need to be lazy
             pre_dispatch = 'all'
-
-        if pre_dispatch == 'all' or n_jobs == 1:
+        # The number of tasks, while known
+        self._n_total_tasks = (len(iterable) if hasattr(iterable, '__len__')
+                               else None)
+        self._last_progress_time = 0
+        if n_jobs == 1:
+            # In sequential mode, generators are consumed as the outputs
+            # are retrieved
+            pre_dispatch = ('all' if self.return_as == 'list'
+                            and self._combine is None else 0)
+
+        # The memory budget, and the memory accounted for each batch
+        # pending, by start index: its arguments while running, then its
+        # outputs, until retrieved. Until the size of the outputs is
+        # known, the batches pending are limited in number.
+        self._nbytes_budget = self.pre_dispatch_nbytes if n_jobs > 1 else None
+        self._batch_nbytes = dict()
+        self._pending_nbytes = 0
+        self._n_running_tasks = 0
+        self._output_nbytes = 0
+        self._n_output_tasks = 0
+        self._max_unsized_batches = 2 * n_jobs
+
+        if pre_dispatch == 'all' and self._nbytes_budget is not None:
+            # The input is consumed lazily, within the budget
+            self._iterable = iterable = iter(iterable)
+            self._pre_dispatch_amount = 0
+        elif pre_dispatch == 'all':
             self._iterable = None
             self._pre_dispatch_amount = 0
         else:
-            self._iterable = iterable
-            self._dispatch_amount = 0
+            self._iterable = iter(iterable)
             if hasattr(pre_dispatch, 'endswith'):
                 pre_dispatch = eval(pre_dispatch)
             self._pre_dispatch_amount = pre_dispatch = int(pre_dispatch)
-            iterable = itertools.islice(iterable, pre_dispatch)
+            iterable = itertools.islice(self._iterable, pre_dispatch)
+
+        # With return_as='disk', the outputs are dumped to files, by the
+        # workers if the parent process can read them
+        self._output_folder = None
+        self._dump_in_workers = False
+        if self.return_as == 'disk' and self._combine is None:
+            self._output_folder = tempfile.mkdtemp(
+                prefix='joblib_outputs_', dir=self._get_temp_folder())
+            _temporary_folders.add(self._output_folder)
+            self._dump_in_workers = (self._pool is None
+                                     or self._backend.shares_filesystem)
 
         self._start_time = time.time()
-        self.n_dispatched = 0
+        self.stats_ = ParallelStats(n_jobs)
+        self.n_dispatched_batches = 0
+        self.n_dispatched_tasks = 0
+        self.n_completed_tasks = 0
+        self._effective_batch_size = 1
+        self._smoothed_batch_duration = 0
+        self._aborting = False
+        self._cancel_flag = None
+        if self._pool is not None:
+            filename = None
+            if (self._backend.pickles_tasks
+                    and self._backend.shares_filesystem):
+                # For the worker processes to see the flag set after
+                # they receive the batches
+                filename = os.path.join(
+                    self._get_temp_folder() or tempfile.gettempdir(),
+                    'joblib_cancelled_%s' % uuid.uuid4().hex)
+            self._cancel_flag = CancelFlag(filename)
+        self._ready_batches = ready_batches
+        self._n_retrieved_batches = 0
+        if self._pool is not None and self._backend.pickles_tasks:
+            self._function_wrappers = dict()
+        # The outputs retrieved ahead of their turn, when the batches
+        # are reordered
+        self._pending_outputs = dict()
+        self._n_collated_tasks = 0
+
+        iterable = iter(iterable)
+        while not self._over_nbytes_budget():
+            if not self.dispatch_one_batch(iterable):
+                if iterable is self._iterable:
+                    # The input is exhausted
+                    self._iterable = None
+                break
+        if self._iterable is None:
+            self._n_total_tasks = self.n_dispatched_tasks
+
+    def _print_finished(self):
+        """ Make sure that we get a last message telling us we are done
+        """
+        if self.progress_callback is not None:
+            self._report_progress(finished=True)
+        elapsed_time = time.time() - self._start_time
+        self._print('Done %3i out of %3i | elapsed: %s finished',
+                    (self.n_completed_tasks,
+                     self.n_completed_tasks,
+                        short_format_time(elapsed_time)
+                    ))
+
+    def _finish_call(self):
+        """ Release the resources of the call: close the pool, or, if it
+            is reused, wait for the jobs still running
+        """
+        if not self._managed_pool:
+            self._terminate_pool()
+        elif self._pool is not None:
+            # Wait for the jobs left in the pool after an error, so
+            # that their callbacks do not interfere with the next call
+            for _, _, job in self._jobs:
+                try:
+                    if isinstance(job, RetriedJob):
+                        job = job.wait()
+                    self._pool.collect(job)
+                except Exception:
+                    pass
+            if self._ready_batches is not None:
+                for _ in self._iter_ready_jobs():
+                    pass
+            self._pool.end_call()
+        self._jobs = deque()
+        self._ready_batches = None
+        self._function_wrappers = None
+        if self._cancel_flag is not None:
+            self._cancel_flag.delete()
+            self._cancel_flag = None
+        if self._aborting and self._output_folder is not None:
+            # Once the workers are done writing to it
+            shutil.rmtree(self._output_folder, ignore_errors=True)
+            _temporary_folders.discard(self._output_folder)
+            self._output_folder = None
+        if self.stats_ is not None:
+            self.stats_._finish()
+
+    def _get_outputs(self, iterable, n_jobs):
+        """ Generator dispatching the jobs and yielding their outputs.
+
+            The first value yielded is None, once the first batches are
+            dispatched.
+        """
+        if (not self.ordered or self.cost is not None) and n_jobs > 1:
+            # The batches are retrieved as they complete
+            ready_batches = queue.Queue()
+        else:
+            ready_batches = None
         try:
-            for function, args, kwargs in iterable:
-                self.dispatch(function, args, kwargs)
-
-            self.retrieve()
-            # Make sure that we get a last message telling us we are done
-            elapsed_time = time.time() - self._start_time
-            self._print('Done %3i out of %3i | elapsed: %s finished',
-                        (len(self._output),
-                         len(self._output),
-                            short_format_time(elapsed_time)
-                        ))
-
+            self._start(iterable, n_jobs, ready_batches)
+            yield
+
+            for output in self._retrieve():
+                yield output
+            self._print_finished()
+        except GeneratorExit:
+            # The generator of outputs was discarded before its end: the
+            # jobs left are useless
+            self._abort()
+            raise
         finally:
-            if n_jobs > 1:
-                self._pool.close()
-                self._pool.join()
-                os.environ.pop('__JOBLIB_SPAWNED_PARALLEL__', 0)
-            self._jobs = list()
-        output = self._output
-        self._output = None
-        return output
+            self._finish_call()
 
     def __repr__(self):
         return '%s(n_jobs=%s)' % (self.__class__.__name__, self.n_jobs)
@@ -0,0 +1,932 @@
+"""
+Custom implementation of multiprocessing.Pool with custom pickler
+
+This module provides efficient ways of working with data stored in
+shared memory with numpy.memmap arrays without inducing any memory copy
+between the parent and child processes.
+
+This module should not be imported if multiprocessing is not
+available, as it implements subclasses of multiprocessing Pool.
+"""
+
+# License: BSD 3 clause
+
+from mmap import mmap
+import os
+import sys
+import itertools
+import threading
+import multiprocessing
+import tempfile
+import time
+import uuid
+import shutil
+import warnings
+try:
+    # Python 2 compat
+    from cPickle import loads
+    from cPickle import dumps
+except ImportError:
+    from pickle import loads
+    from pickle import dumps
+    import copyreg
+
+# Customizable pure Python pickler in Python 2
+# customizable C-optimized pickler under Python 3.3+
+from pickle import Pickler
+
+from pickle import HIGHEST_PROTOCOL
+from io import BytesIO
+
+from multiprocessing.pool import Pool, RUN, CLOSE
+try:
+    from multiprocessing.reduction import ForkingPickler
+    _dumps_task = ForkingPickler.dumps
+except (ImportError, AttributeError):
+    # Python 2
+    def _dumps_task(obj):
+        return dumps(obj, HIGHEST_PROTOCOL)
+
+try:
+    import numpy as np
+    from numpy.lib.stride_tricks import as_strided
+    try:
+        from numpy.lib.array_utils import byte_bounds
+    except ImportError:
+        # numpy < 2.0
+        byte_bounds = np.byte_bounds
+except ImportError:
+    np = None
+
+from .numpy_pickle import load
+from .numpy_pickle import dump
+from .hashing import hash
+from .disk import mkdirp, _temporary_folders
+from .my_exceptions import WorkerLostError, JobTimeoutError
+
+
+###############################################################################
+# Support for efficient transient pickling of numpy data structures
+
+def _get_backing_memmap(a):
+    """Recursively look up the original np.memmap instance base if any"""
+    b = getattr(a, 'base', None)
+    if b is None:
+        # a nor its descendants do not have a memmap base
+        return None
+
+    elif isinstance(b, mmap):
+        # a is already a real memmap instance.
+        return a
+
+    else:
+        # Recursive exploration of the base ancestry
+        return _get_backing_memmap(b)
+
+
+def has_shareable_memory(a):
+    """Return True if a is backed by some mmap buffer directly or not"""
+    return _get_backing_memmap(a) is not None
+
+
+def _strided_from_memmap(filename, dtype, mode, offset, order, shape, strides,
+                         total_buffer_len):
+    """Reconstruct an array view on a memmory mapped file"""
+    if mode == 'w+':
+        # Do not zero the original data when unpickling
+        mode = 'r+'
+
+    if strides is None:
+        # Simple, contiguous memmap
+        return np.memmap(filename, dtype=dtype, shape=shape, mode=mode,
+                         offset=offset, order=order)
+    else:
+        # For non-contiguous data, memmap the total enclosing buffer and then
+        # extract the non-contiguous view with the stride-tricks API
+        base = np.memmap(filename, dtype=dtype, shape=total_buffer_len,
+                         mode=mode, offset=offset, order=order)
+        return as_strided(base, shape=shape, strides=strides)
+
+
+def _reduce_memmap_backed(a, m):
+    """Pickling reduction for memmap backed arrays
+
+    a is expected to be an instance of np.ndarray (or np.memmap)
+    m is expected to be an instance of np.memmap on the top of the ``base``
+    attribute ancestry of a. ``m.base`` should be the real python mmap object.
+    """
+    # offset that comes from the striding differences between a and m
+    a_start, a_end = byte_bounds(a)
+    m_start = byte_bounds(m)[0]
+    offset = a_start - m_start
+
+    # offset from the backing memmap
+    offset += m.offset
+
+    if a.flags['C_CONTIGUOUS'] or a.flags['F_CONTIGUOUS']:
+        # If the array is a contiguous view, no need to pass the strides,
+        # only its memory layout, that can differ from the one of m, as
+        # for a transposed view
+        order = 'C' if a.flags['C_CONTIGUOUS'] else 'F'
+        strides = None
+        total_buffer_len = None
+    else:
+        # Compute the total number of items to map from which the strided
+        # view will be extracted: the enclosing buffer is one-dimensional
+        order = 'C'
+        strides = a.strides
+        total_buffer_len = (a_end - a_start) // a.itemsize
+    return (_strided_from_memmap,
+            (m.filename, a.dtype, m.mode, offset, order, a.shape, strides,
+             total_buffer_len))
+
+
+def _can_reduce_as_memmap(a, m):
+    """Views with negative strides cannot be rebuilt from the lowest
+    address of their buffer, nor can memmaps without a backing file, or
+    whose file was deleted, as the results of a finished computation"""
+    return (m is not None and getattr(m, 'filename', None) is not None
+            and os.path.exists(m.filename)
+            and all(s >= 0 for s in a.strides))
+
+
+def reduce_memmap(a):
+    """Pickle the descriptors of a memmap instance to reopen on same file"""
+    m = _get_backing_memmap(a)
+    if _can_reduce_as_memmap(a, m):
+        # m is a real mmap backed memmap instance, reduce a preserving striding
+        # information
+        return _reduce_memmap_backed(a, m)
+    else:
+        # This memmap instance is actually backed by a regular in-memory
+        # buffer: this can happen when using binary operators on numpy.memmap
+        # instances
+        return (loads, (dumps(np.asarray(a), protocol=HIGHEST_PROTOCOL),))
+
+
+class ArrayMemmapReducer(object):
+    """Reducer callable to dump large arrays to memmap files.
+
+    Parameters
+    ----------
+    max_nbytes: int
+        Threshold to trigger memmaping of large arrays to files created
+        a folder.
+    temp_folder: str
+        Path of a folder where files for backing memmaped arrays are created.
+    mmap_mode: 'r', 'r+' or 'c'
+        Mode for the created memmap datastructure. See the documentation of
+        numpy.memmap for more details. Note: 'w+' is coerced to 'r+'
+        automatically to avoid zeroing the data on unpickling.
+    verbose: int, optional, 0 by default
+        If verbose > 0, memmap creations are logged.
+        If verbose > 1, both memmap creations, reuse and array pickling are
+        logged.
+    """
+
+    def __init__(self, max_nbytes, temp_folder, mmap_mode, verbose=0):
+        self._max_nbytes = max_nbytes
+        self._temp_folder = temp_folder
+        self._mmap_mode = mmap_mode
+        self.verbose = int(verbose)
+        # Arrays already dumped in the temp folder, indexed by id, to
+        # avoid hashing again the same array sent to several tasks. A
+        # reference to the array is kept so that its id is not reused.
+        self._dumped = dict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_dumped'] = dict()
+        return state
+
+    def __call__(self, a):
+        m = _get_backing_memmap(a)
+        if _can_reduce_as_memmap(a, m):
+            # a is already backed by a memmap file, let's reuse it directly
+            return _reduce_memmap_backed(a, m)
+
+        if (not a.dtype.hasobject
+                and self._max_nbytes is not None
+                and a.nbytes > self._max_nbytes):
+            filename = self._dump(a)
+            mmap_mode = self._mmap_mode
+            if mmap_mode == 'w+':
+                # Do not truncate the file dumped when unpickling
+                mmap_mode = 'r+'
+            # Let's use the memmap reducer
+            return (load, (filename, mmap_mode))
+        else:
+            # do not convert a into memmap, let pickler do its usual copy with
+            # the default system pickler
+            if self.verbose > 1:
+                print("[ArrayMemmapReducer] Pickling array (shape=%r, dtype=%s)."
+                      % (a.shape, a.dtype))
+            return (loads, (dumps(a, protocol=HIGHEST_PROTOCOL),))
+
+    def _dump(self, a):
+        """ Dump the array in the temporary folder, unless an identical
+            array was already dumped there, and return the filename
+        """
+        key = id(a)
+        if key in self._dumped and self._dumped[key][0] is a:
+            filename = self._dumped[key][1]
+            if os.path.exists(filename):
+                return filename
+        # Identical arrays are stored in the same file
+        basename = "%s.pkl" % hash(a)
+        filename = os.path.join(self._temp_folder, basename)
+        if not os.path.exists(filename):
+            mkdirp(self._temp_folder)
+            if self.verbose > 0:
+                print("[ArrayMemmapReducer] Memmaping (shape=%r, dtype=%s)"
+                      " to new file %s" % (a.shape, a.dtype, filename))
+            dump(a, filename)
+        elif self.verbose > 1:
+            print("[ArrayMemmapReducer] Reusing existing file %s"
+                  % filename)
+        self._dumped[key] = (a, filename)
+        return filename
+
+    def clear(self):
+        """ Forget about the arrays dumped so far
+        """
+        self._dumped.clear()
+
+
+class ResultMemmapReducer(ArrayMemmapReducer):
+    """Reducer used by the workers to dump the large arrays they return.
+
+    The parent process then gets a memmap on the file, rather than a
+    copy of the array sent through the result pipe. Unlike the arguments
+    of the tasks, the results are not expected to be identical: each of
+    them is dumped to a new file, without hashing it, and the reducer
+    keeps no reference to it.
+    """
+
+    def _dump(self, a):
+        mkdirp(self._temp_folder)
+        filename = os.path.join(self._temp_folder, "result_%d_%s.pkl" % (
+            os.getpid(), uuid.uuid4().hex))
+        if self.verbose > 0:
+            print("[ResultMemmapReducer] Memmaping (shape=%r, dtype=%s)"
+                  " to new file %s" % (a.shape, a.dtype, filename))
+        dump(a, filename)
+        return filename
+
+
+###############################################################################
+# Enable custom pickling in Pool queues
+
+class CustomizablePickler(Pickler):
+    """Pickler that accepts custom reducers.
+
+    HIGHEST_PROTOCOL is selected by default as this pickler is used
+    to pickle ephemeral datastructures for interprocess communication
+    hence no backward compatibility is required.
+
+    `reducers` is expected expected to be a dictionary with key/values
+    being `(type, callable)` pairs where `callable` is a function that
+    give an instance of `type` will return a tuple `(constructor,
+    tuple_of_objects)` to rebuild an instance out of the pickled
+    `tuple_of_objects` as would return a `__reduce__` method. See the
+    standard library documentation on pickling for more details.
+
+    """
+
+    # We override the pure Python pickler as its the only way to be able to
+    # customize the dispatch table without side effects in Python 2.6
+    # to 3.2. For Python 3.3+ leverage the new dispatch_table
+    # feature from http://bugs.python.org/issue14166 that makes it possible
+    # to use the C implementation of the Pickler which is faster.
+
+    def __init__(self, writer, reducers=None, protocol=HIGHEST_PROTOCOL):
+        Pickler.__init__(self, writer, protocol=protocol)
+        if reducers is None:
+            reducers = {}
+        if hasattr(Pickler, 'dispatch'):
+            # Make the dispatch registry an instance level attribute instead of
+            # a reference to the class dictionary under Python 2
+            self.dispatch = Pickler.dispatch.copy()
+        else:
+            # Under Python 3 initialize the dispatch table with a copy of the
+            # default registry
+            self.dispatch_table = copyreg.dispatch_table.copy()
+        for type, reduce_func in reducers.items():
+            self.register(type, reduce_func)
+
+    def register(self, type, reduce_func):
+        if hasattr(Pickler, 'dispatch'):
+            # Python 2 pickler dispatching is not explicitly customizable.
+            # Let us use a closure to workaround this limitation.
+            def dispatcher(self, obj):
+                reduced = reduce_func(obj)
+                self.save_reduce(obj=obj, *reduced)
+            self.dispatch[type] = dispatcher
+        else:
+            self.dispatch_table[type] = reduce_func
+
+
+class CustomizablePicklingQueue(object):
+    """Locked Pipe implementation that uses a customizable pickler.
+
+    This class is an alternative to the multiprocessing implementation
+    of SimpleQueue in order to make it possible to pass custom
+    pickling reducers, for instance to avoid memory copy when passing
+    memmory mapped datastructures.
+
+    `reducers` is expected expected to be a dictionary with key/values
+    being `(type, callable)` pairs where `callable` is a function that
+    give an instance of `type` will return a tuple `(constructor,
+    tuple_of_objects)` to rebuild an instance out of the pickled
+    `tuple_of_objects` as would return a `__reduce__` method. See the
+    standard library documentation on pickling for more details.
+    """
+
+    def __init__(self, context, reducers=None):
+        self._reducers = reducers
+        self._reader, self._writer = context.Pipe(duplex=False)
+        self._rlock = context.Lock()
+        if sys.platform == 'win32':
+            self._wlock = None
+        else:
+            self._wlock = context.Lock()
+        self._make_methods()
+
+    def __getstate__(self):
+        return (self._reader, self._writer, self._rlock, self._wlock,
+                self._reducers)
+
+    def __setstate__(self, state):
+        (self._reader, self._writer, self._rlock, self._wlock,
+         self._reducers) = state
+        self._make_methods()
+
+    def empty(self):
+        return not self._reader.poll()
+
+    def _make_methods(self):
+        self._recv = recv = self._reader.recv
+        racquire, rrelease = self._rlock.acquire, self._rlock.release
+
+        def get():
+            racquire()
+            try:
+                return recv()
+            finally:
+                rrelease()
+
+        self.get = get
+
+        if self._reducers:
+            def send(obj):
+                buffer = BytesIO()
+                CustomizablePickler(buffer, self._reducers).dump(obj)
+                self._writer.send_bytes(buffer.getvalue())
+            self._send = send
+        else:
+            self._send = send = self._writer.send
+        if self._wlock is None:
+            # writes to a message oriented win32 pipe are atomic
+            self.put = send
+        else:
+            wlock_acquire, wlock_release = (
+                self._wlock.acquire, self._wlock.release)
+
+            def put(obj):
+                wlock_acquire()
+                try:
+                    return send(obj)
+                finally:
+                    wlock_release()
+
+            self.put = put
+
+
+###############################################################################
+# Detection of the workers that die, or get stuck, while running a task
+
+# Queue on which a worker reports the tasks it starts and ends, lock
+# under which it reports their end, and reducers with which it pickles
+# the results, set by the initializer of the worker process
+_started_tasks = None
+_finish_lock = None
+_result_reducers = None
+
+
+def _initialize_worker(started_tasks, finish_lock, result_reducers=None,
+                       initializer=None, initargs=()):
+    global _started_tasks, _finish_lock, _result_reducers
+    _started_tasks = started_tasks
+    _finish_lock = finish_lock
+    _result_reducers = result_reducers
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def dump_result(obj):
+    """Pickle obj in a worker as the pool pickles the results, with its
+    backward reducers, if any: unpickling the bytes returned gives what
+    the parent process would have received"""
+    if not _result_reducers:
+        return bytes(_dumps_task(obj))
+    buffer = BytesIO()
+    CustomizablePickler(buffer, _result_reducers).dump(obj)
+    return buffer.getvalue()
+
+
+class _TrackedCall(object):
+    """Wraps a function to report its start, with the pid of the worker,
+    before calling it, and its end"""
+
+    def __init__(self, func, task_id):
+        self.func = func
+        self.task_id = task_id
+
+    def __call__(self, *args, **kwargs):
+        pid = os.getpid()
+        # The pool holds the lock while it terminates the workers
+        # running a task: the start and end of the tasks are reported
+        # under the lock, for a worker not to be terminated while it
+        # holds the lock of the queue. Once the end of its task is
+        # reported, the worker may be sending the result, and is not
+        # terminated.
+        self._report(pid, time.time())
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            self._report(pid, None)
+
+    def _report(self, pid, start_time):
+        _finish_lock.acquire()
+        try:
+            _started_tasks.put((pid, self.task_id, start_time))
+        finally:
+            _finish_lock.release()
+
+
+class ResilientPool(Pool):
+    """Pool implementation that survives the death of its workers.
+
+    With `multiprocessing.pool.Pool`, when a worker process dies while
+    running a task, for instance from a segmentation fault in a C
+    extension or killed by the out-of-memory killer, the worker is
+    replaced but the result of the task never comes: waiting on it hangs
+    forever.
+
+    The tasks submitted with apply_async to this pool report to the
+    parent process which worker runs them. A thread monitors the
+    workers, and the task of a worker exiting with a non-zero exit code
+    fails with a WorkerLostError. The worker is replaced as usual, and
+    the pool remains usable for the other tasks.
+
+    A task can also be given a timeout, in seconds, when submitted with
+    apply_async. If it runs longer, it fails with a JobTimeoutError, and
+    its worker is terminated, and replaced. A worker whose task has
+    returned is not terminated, as it may be sending the result.
+
+    apply_async also accepts an error_callback, called with the
+    exception of a task that fails, also under Python 2, where
+    multiprocessing.pool.Pool does not support it.
+
+    The size of the pickles of the task and of its result, and the time
+    spent pickling the task and unpickling its result, are recorded in
+    the `_transfer_stats` dict of the job, as args_nbytes,
+    args_pickle_time, result_nbytes and result_unpickle_time, with the
+    received_time of the result.
+
+    The time spent pickling the results in the workers is not: a task
+    can pickle its result itself with dump_result, and time it, the
+    pool then sending the bytes with little extra work.
+
+    The tasks running can be cancelled with cancel_running_tasks: their
+    workers are terminated, and replaced.
+
+    A worker killed while waiting for a task can still leave the pool
+    stuck, as it may hold the lock of the task queue.
+    """
+
+    # Period, in seconds, of the checks of the workers
+    _monitor_period = .1
+
+    # The reducers pickling the results in the workers
+    _backward_reducers = None
+
+    def __init__(self, processes=None, initializer=None, initargs=(),
+                 **kwargs):
+        context = kwargs.get('context', None) or multiprocessing
+        if hasattr(context, 'SimpleQueue'):
+            self._started_tasks = context.SimpleQueue()
+        else:
+            # Python 2
+            from multiprocessing.queues import SimpleQueue
+            self._started_tasks = SimpleQueue()
+        self._finish_lock = context.Lock()
+        # The jobs submitted and their timeout, by task id, and the task
+        # id run by each worker, its start time, and whether it ended, by
+        # pid
+        self._tasks = dict()
+        self._worker_tasks = dict()
+        # The error callbacks of the jobs pending, by job id
+        self._error_callbacks = dict()
+        self._task_counter = itertools.count()
+        self._tasks_lock = threading.Lock()
+        # All the worker processes started, including those already
+        # replaced, which the pool forgets as soon as they have exited
+        self._workers = list()
+        make_process = self.Process
+
+        def Process(*args, **kwargs):
+            worker = make_process(*args, **kwargs)
+            self._workers.append(worker)
+            return worker
+
+        self.Process = Process
+        super(ResilientPool, self).__init__(
+            processes=processes, initializer=_initialize_worker,
+            initargs=(self._started_tasks, self._finish_lock,
+                      self._backward_reducers, initializer, initargs),
+            **kwargs)
+        self._monitor = threading.Thread(target=self._monitor_workers)
+        self._monitor.daemon = True
+        self._monitor.start()
+
+    def _setup_queues(self):
+        super(ResilientPool, self)._setup_queues()
+        self._quick_put = self._put_task
+        self._quick_get = self._get_result
+
+    def _dumps(self, obj):
+        return _dumps_task(obj)
+
+    def _put_task(self, task):
+        """Send a task to the workers, recording the size of its pickle,
+        and the time spent pickling it"""
+        start_time = time.time()
+        try:
+            data = self._dumps(task)
+        except Exception as exception:
+            # The task handler fails the job
+            if task is not None:
+                self._call_error_callback(task[0], exception)
+            raise
+        if task is not None:
+            job = self._cache.get(task[0])
+            if job is not None:
+                job._transfer_stats = dict(
+                    args_nbytes=len(data),
+                    args_pickle_time=time.time() - start_time)
+        self._inqueue._writer.send_bytes(data)
+
+    def _get_result(self):
+        """Receive a result from the workers, recording the size of its
+        pickle, and the time spent unpickling it"""
+        data = self._outqueue._reader.recv_bytes()
+        start_time = time.time()
+        result = loads(data)
+        if result is not None:
+            success, value = result[2]
+            if success:
+                self._pop_error_callback(result[0])
+            else:
+                # Before the result handler flags the job as done
+                self._call_error_callback(result[0], value)
+            job = self._cache.get(result[0])
+            if job is not None:
+                now = time.time()
+                transfer_stats = getattr(job, '_transfer_stats', dict())
+                transfer_stats.update(result_nbytes=len(data),
+                                      result_unpickle_time=now - start_time,
+                                      received_time=now)
+                job._transfer_stats = transfer_stats
+        return result
+
+    def apply_async(self, func, args=(), kwds={}, callback=None,
+                    error_callback=None, timeout=None):
+        if timeout is not None and timeout <= 0:
+            raise ValueError('timeout must be positive, got: %r' % timeout)
+        with self._tasks_lock:
+            task_id = next(self._task_counter)
+            # The error callback is handled by the pool: the result
+            # handler does not call it under Python 2
+            job = super(ResilientPool, self).apply_async(
+                _TrackedCall(func, task_id), args, kwds, callback)
+            self._tasks[task_id] = (job, timeout)
+            if error_callback is not None:
+                self._error_callbacks[job._job] = error_callback
+        return job
+
+    def _pop_error_callback(self, job_id):
+        with self._tasks_lock:
+            return self._error_callbacks.pop(job_id, None)
+
+    def _call_error_callback(self, job_id, exception):
+        """Call the error callback of the job, if any, once: it is called
+        without holding the lock, as it may submit new tasks"""
+        error_callback = self._pop_error_callback(job_id)
+        if error_callback is not None:
+            error_callback(exception)
+
+    def _monitor_workers(self):
+        while self._state == RUN or (self._state == CLOSE and self._cache):
+            time.sleep(self._monitor_period)
+            with self._tasks_lock:
+                failures = self._check_workers()
+            self._fail_jobs(failures)
+
+    def _fail_jobs(self, failures):
+        """Fail the jobs of the (job, exception) pairs given"""
+        # The callbacks of the jobs may submit new tasks: they are
+        # called without holding the lock
+        for job, exception in failures:
+            self._call_error_callback(job._job, exception)
+            try:
+                job._set(0, (False, exception))
+            except KeyError:
+                # The result of the task arrived in the meantime
+                pass
+
+    def _collect_started_tasks(self):
+        """Record the tasks that the workers started and ended"""
+        while not self._started_tasks.empty():
+            pid, task_id, start_time = self._started_tasks.get()
+            if start_time is None:
+                # The task is kept until the next one, for the death of
+                # the worker before its result is sent
+                if self._worker_tasks.get(pid, (None,))[0] == task_id:
+                    self._worker_tasks[pid] = (
+                        task_id, self._worker_tasks[pid][1], True)
+                continue
+            # A worker runs one task at a time: its previous task is over
+            self._tasks.pop(self._worker_tasks.get(pid, (None,))[0], None)
+            self._worker_tasks[pid] = (task_id, start_time, False)
+
+    def _terminate_running(self, worker):
+        """Terminate the worker running a task, unless the task ended
+        meanwhile, and return whether it was terminated"""
+        # The worker reports the end of its task under the lock: while it
+        # is held, a worker that did not report it is still running its
+        # task, and does not hold the locks of the queues of the pool
+        if not self._finish_lock.acquire(True, self._monitor_period):
+            # Retried by the next check
+            return False
+        try:
+            self._collect_started_tasks()
+            if self._worker_tasks[worker.pid][2]:
+                return False
+            worker.terminate()
+            # Dead before it can take the lock
+            worker.join()
+            return True
+        finally:
+            self._finish_lock.release()
+
+    def _check_workers(self):
+        """Return the (job, exception) of the tasks that failed, and
+        terminate the workers that exceeded the timeout of their task"""
+        # The tasks must be collected before the exit codes: a worker
+        # reports a task before running it
+        self._collect_started_tasks()
+        now = time.time()
+        failures = list()
+        for worker in list(self._workers):
+            pid = worker.pid
+            task_id, start_time, ended = self._worker_tasks.get(
+                pid, (None, None, None))
+            job, timeout = self._tasks.get(task_id, (None, None))
+            exitcode = worker.exitcode
+            if exitcode is None:
+                if (timeout is not None and not ended
+                        and now - start_time > timeout and not job.ready()
+                        and self._terminate_running(worker)):
+                    failures.append((job, JobTimeoutError(
+                        'The task did not complete within its timeout of '
+                        '%.1fs: the worker process running it (pid %d) '
+                        'was terminated.' % (timeout, pid))))
+                    # The task is forgotten: the death of the worker is
+                    # not reported again
+                    self._worker_tasks.pop(pid)
+                    self._tasks.pop(task_id)
+                continue
+            self._workers.remove(worker)
+            self._worker_tasks.pop(pid, None)
+            self._tasks.pop(task_id, None)
+            if exitcode != 0 and job is not None and not job.ready():
+                failures.append((job, WorkerLostError(
+                    'The worker process (pid %d) running this task died '
+                    'unexpectedly, with exit code %d. It may have been '
+                    'killed by a segmentation fault or by the '
+                    'out-of-memory killer.' % (pid, exitcode))))
+        return failures
+
+
+    def cancel_running_tasks(self):
+        """Terminate the workers running a task, which fails with a
+        WorkerLostError: they are replaced as the workers that die. The
+        tasks that did not start are left in the queue."""
+        failures = list()
+        with self._tasks_lock:
+            self._collect_started_tasks()
+            for worker in list(self._workers):
+                pid = worker.pid
+                task_id, _, ended = self._worker_tasks.get(
+                    pid, (None, None, True))
+                job, _ = self._tasks.get(task_id, (None, None))
+                if (job is not None and not ended and not job.ready()
+                        and worker.exitcode is None
+                        and self._terminate_running(worker)):
+                    failures.append((job, WorkerLostError(
+                        'The worker process (pid %d) running this task '
+                        'was terminated, as the task was cancelled.'
+                        % pid)))
+                    self._worker_tasks.pop(pid)
+                    self._tasks.pop(task_id)
+        self._fail_jobs(failures)
+
+
+class PicklingPool(ResilientPool):
+    """Pool implementation with customizable pickling reducers.
+
+    This is useful to control how data is shipped between processes
+    and makes it possible to use shared memory without useless
+    copies induces by the default pickling methods of the original
+    objects passed as arguments to dispatch.
+
+    `forward_reducers` and `backward_reducers` are expected to be
+    dictionaries with key/values being `(type, callable)` pairs where
+    `callable` is a function that give an instance of `type` will return
+    a tuple `(constructor, tuple_of_objects)` to rebuild an instance out
+    of the pickled `tuple_of_objects` as would return a `__reduce__`
+    method. See the standard library documentation on pickling for more
+    details.
+
+    """
+
+    def __init__(self, processes=None, forward_reducers=None,
+                 backward_reducers=None, **kwargs):
+        if forward_reducers is None:
+            forward_reducers = dict()
+        if backward_reducers is None:
+            backward_reducers = dict()
+        self._forward_reducers = forward_reducers
+        self._backward_reducers = backward_reducers
+        poolargs = dict(processes=processes)
+        poolargs.update(kwargs)
+        super(PicklingPool, self).__init__(**poolargs)
+
+    def _setup_queues(self):
+        context = getattr(self, '_ctx', None)
+        if context is None:
+            # Python 2 does not have the context API
+            import multiprocessing as context
+        self._inqueue = CustomizablePicklingQueue(context,
+                                                  self._forward_reducers)
+        self._outqueue = CustomizablePicklingQueue(context,
+                                                   self._backward_reducers)
+        self._quick_put = self._put_task
+        self._quick_get = self._get_result
+
+    def _dumps(self, obj):
+        buffer = BytesIO()
+        CustomizablePickler(buffer, self._forward_reducers).dump(obj)
+        return buffer.getvalue()
+
+
+def delete_folder(folder_path):
+    """Utility function to cleanup a temporary folder if still existing"""
+    try:
+        if os.path.exists(folder_path):
+            shutil.rmtree(folder_path)
+    except OSError:
+        # Under Windows, files still memory mapped cannot be deleted
+        warnings.warn("Failed to clean temporary folder: %s" % folder_path)
+
+
+class MemmapingPool(PicklingPool):
+    """Process pool that shares large arrays to avoid memory copy.
+
+    This drop-in replacement for `multiprocessing.pool.Pool` makes
+    it possible to work efficiently with shared memory in a numpy
+    context.
+
+    Existing instances of numpy.memmap are preserved: the child
+    suprocesses will have access to the same shared memory in the
+    original mode except for the 'w+' mode that is automatically
+    transformed as 'r+' to avoid zeroing the original data upon
+    instantiation.
+
+    Furthermore large arrays from the parent process are automatically
+    dumped to a temporary folder on the filesystem such as child
+    processes to access their content via memmaping (file system
+    backed shared memory). Identical arrays are dumped only once.
+    Likewise, the large arrays returned by the workers are dumped to the
+    temporary folder, and received as memmaps by the parent process.
+
+    Note: it is important to call the terminate method to collect
+    the temporary folder used by the pool.
+
+    Parameters
+    ----------
+    processes: int, optional
+        Number of worker processes running concurrently in the pool.
+    initializer: callable, optional
+        Callable executed on worker process creation.
+    initargs: tuple, optional
+        Arguments passed to the initializer callable.
+    temp_folder: str, optional
+        Folder to be used by the pool for memmaping large arrays
+        for sharing memory with worker processes. If None, this will use
+        the JOBLIB_TEMP_FOLDER environment variable, or the default
+        temporary folder of the system.
+    max_nbytes int or None, optional, 1e6 by default
+        Threshold on the size of arrays passed to the workers, or
+        returned by them, that triggers automated memmory mapping in
+        temp_folder. Use None to disable memmaping of large arrays.
+    forward_reducers: dictionary, optional
+        Reducers used to pickle objects passed from master to worker
+        processes: see below.
+    backward_reducers: dictionary, optional
+        Reducers used to pickle return values from workers back to the
+        master process.
+    verbose: int, optional
+        Make it possible to monitor how the communication of numpy arrays
+        with the subprocess is handled (pickling or memmaping)
+
+    `forward_reducers` and `backward_reducers` are expected to be
+    dictionaries with key/values being `(type, callable)` pairs where
+    `callable` is a function that give an instance of `type` will return
+    a tuple `(constructor, tuple_of_objects)` to rebuild an instance out
+    of of the pickled `tuple_of_objects` as would return a `__reduce__`
+    method. See the standard library documentation about pickling for
+    more details.
+
+    """
+
+    def __init__(self, processes=None, temp_folder=None, max_nbytes=1e6,
+                 mmap_mode='r', forward_reducers=None, backward_reducers=None,
+                 verbose=0, **kwargs):
+        if forward_reducers is None:
+            forward_reducers = dict()
+        if backward_reducers is None:
+            backward_reducers = dict()
+
+        # Prepare a sub-folder name for the serialization of this particular
+        # pool instance (do not create in advance to spare FS write access if
+        # no array is to be dumped):
+        if temp_folder is None:
+            temp_folder = os.environ.get('JOBLIB_TEMP_FOLDER', None)
+        if temp_folder is None:
+            temp_folder = tempfile.gettempdir()
+        temp_folder = os.path.abspath(os.path.expanduser(temp_folder))
+        self._temp_folder = os.path.join(
+            temp_folder, "joblib_memmaping_pool_%d_%d" % (
+                os.getpid(), id(self)))
+
+        # Deleted at program exit in case caller forgets to call terminate
+        # explicitly: only the name of the folder is kept, which does not
+        # prevent garbage collection of the pool instance and related file
+        # handler resources such as POSIX semaphores and pipes
+        _temporary_folders.add(self._temp_folder)
+
+        self._array_reducers = list()
+        if np is not None:
+            # Register smart numpy.ndarray reducers that detects memmap backed
+            # arrays and that is else able to dump to memmap large in-memory
+            # arrays over the max_nbytes threshold
+            forward_reduce_ndarray = ArrayMemmapReducer(
+                max_nbytes, self._temp_folder, mmap_mode, verbose)
+            forward_reducers[np.ndarray] = forward_reduce_ndarray
+            forward_reducers[np.memmap] = reduce_memmap
+            self._array_reducers.append(forward_reduce_ndarray)
+
+            # The large arrays returned by the workers are also dumped to
+            # the temporary folder. They are opened in 'r+' mode, to give
+            # writable arrays to the caller: copy-on-write memmaps would
+            # hide the changes from the workers they are sent to later.
+            # The files can be deleted with the folder while the parent
+            # still uses them, except under Windows.
+            backward_reduce_ndarray = ResultMemmapReducer(
+                max_nbytes, self._temp_folder, 'r+', verbose)
+            backward_reducers[np.ndarray] = backward_reduce_ndarray
+            backward_reducers[np.memmap] = reduce_memmap
+
+        poolargs = dict(
+            processes=processes,
+            forward_reducers=forward_reducers,
+            backward_reducers=backward_reducers)
+        poolargs.update(kwargs)
+        super(MemmapingPool, self).__init__(**poolargs)
+
+    def clear_temporary_folder(self):
+        """Delete the arrays dumped so far in the temporary folder
+
+        This is meant to be called between successive computations on
+        the same pool, when the workers are not using the arrays anymore.
+        """
+        for reducer in self._array_reducers:
+            reducer.clear()
+        delete_folder(self._temp_folder)
+
+    def terminate(self):
+        super(MemmapingPool, self).terminate()
+        delete_folder(self._temp_folder)
+        _temporary_folders.discard(self._temp_folder)
@@ -0,0 +1,506 @@
+"""
+Pool of worker processes running on other hosts, reached over TCP
+
+A worker server is started on each host, listening on a TCP address::
+
+    JOBLIB_TCP_AUTHKEY=secret python -m joblib.tcp_pool host:port
+
+Each connection made to the server gets a dedicated worker process,
+once authenticated, which runs the tasks sent on this connection one
+after the other. The connections are authenticated with the shared
+key, with the HMAC
+challenge of multiprocessing.connection: the key itself never goes on
+the wire, but the data exchanged is not encrypted.
+
+This module should not be imported if multiprocessing is not
+available.
+"""
+
+# License: BSD 3 clause
+
+import os
+import sys
+import time
+import socket
+import threading
+import itertools
+import multiprocessing
+from multiprocessing.connection import answer_challenge, deliver_challenge
+try:
+    from multiprocessing.connection import Connection
+except ImportError:
+    # Python 2
+    from _multiprocessing import Connection
+try:
+    # Python 2 compat
+    from cPickle import loads, dumps, HIGHEST_PROTOCOL
+except ImportError:
+    from pickle import loads, dumps, HIGHEST_PROTOCOL
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from ._compat import _basestring
+from .my_exceptions import WorkerLostError
+
+# The states of the pool
+RUN, CLOSE, TERMINATE = 0, 1, 2
+
+# Seconds given to the other end of a connection to authenticate, after
+# which the connection is closed, by the worker server as by the client
+HANDSHAKE_TIMEOUT = 10
+
+# Maximum number of clients the worker server authenticates at once:
+# the connections beyond wait to be accepted
+MAX_PENDING_HANDSHAKES = 16
+
+
+def parse_address(address):
+    """Return the (host, port) of an address given as 'host:port'"""
+    if isinstance(address, _basestring):
+        host, _, port = address.rpartition(':')
+        return host, int(port)
+    host, port = address
+    return host, int(port)
+
+
+def _make_connection(sock):
+    """Return a Connection on a duplicate of the socket, the socket itself
+    being kept to shut the connection down"""
+    if hasattr(sock, 'detach'):
+        return Connection(sock.dup().detach())
+    # Python 2
+    return Connection(os.dup(sock.fileno()))
+
+
+def _shutdown(sock):
+    """Shut the socket down, which unblocks the threads reading from the
+    connections on it"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        # The socket is closed
+        pass
+
+
+def _authenticate(sock, authkey, server):
+    """Return a connection on the socket, once both ends are
+    authenticated with the key, from the side of the worker server if
+    server is True, or else of the client"""
+    # The other end stalling during the handshake is disconnected,
+    # rather than blocking this one forever
+    timed_out = threading.Event()
+
+    def disconnect():
+        timed_out.set()
+        _shutdown(sock)
+
+    timer = threading.Timer(HANDSHAKE_TIMEOUT, disconnect)
+    timer.daemon = True
+    timer.start()
+    connection = _make_connection(sock)
+    try:
+        if server:
+            deliver_challenge(connection, authkey)
+            answer_challenge(connection, authkey)
+        else:
+            answer_challenge(connection, authkey)
+            deliver_challenge(connection, authkey)
+    except Exception:
+        connection.close()
+        if not timed_out.is_set():
+            raise
+    finally:
+        timer.cancel()
+        timer.join()
+    if timed_out.is_set():
+        # Also if shut down once the handshake was over
+        connection.close()
+        raise socket.timeout('The authentication did not complete within '
+                             '%ds' % HANDSHAKE_TIMEOUT)
+    return connection
+
+
+def _as_bytes(authkey):
+    if authkey is None:
+        raise ValueError('An authentication key is required for the '
+                         'connections with the workers')
+    if not isinstance(authkey, bytes):
+        authkey = authkey.encode('utf-8')
+    return authkey
+
+
+###############################################################################
+# Worker side
+
+def _work(connection):
+    """Run the tasks received on the connection, and send back their
+    results, until the connection is closed"""
+    while True:
+        try:
+            data = connection.recv_bytes()
+        except (EOFError, IOError, OSError):
+            break
+        try:
+            func, args, kwds = loads(data)
+            result = (True, func(*args, **kwds))
+        except Exception as e:
+            result = (False, e)
+        try:
+            data = dumps(result, HIGHEST_PROTOCOL)
+        except Exception as e:
+            data = dumps((False, ValueError(
+                'Error sending the result of the task: %r' % e)),
+                HIGHEST_PROTOCOL)
+        try:
+            connection.send_bytes(data)
+        except (EOFError, IOError, OSError):
+            break
+    connection.close()
+
+
+def _accept_client(sock, authkey, pending, verbose=0):
+    """Authenticate the client of the socket, and start a worker process
+    to run its tasks, releasing the pending semaphore once the handshake
+    is over"""
+    try:
+        connection = _authenticate(sock, authkey, server=True)
+    except (multiprocessing.AuthenticationError, EOFError, IOError,
+            OSError) as e:
+        if verbose:
+            print('[joblib] Refused a connection: %r' % e)
+        # Also closes the copies of the socket that the worker processes
+        # started meanwhile inherited
+        _shutdown(sock)
+        return
+    finally:
+        sock.close()
+        pending.release()
+    worker = multiprocessing.Process(target=_work, args=(connection,))
+    worker.daemon = True
+    worker.start()
+    # The worker has its own handle on the connection
+    connection.close()
+
+
+def _listen(address):
+    host, port = parse_address(address)
+    family, type_, proto, _, sockaddr = socket.getaddrinfo(
+        host or None, port, 0, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
+    listener = socket.socket(family, type_, proto)
+    try:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(sockaddr)
+        listener.listen(socket.SOMAXCONN)
+    except Exception:
+        listener.close()
+        raise
+    return listener
+
+
+def serve(address, authkey, verbose=0):
+    """Accept connections on the address, authenticated with the given
+    key, and start a worker process for each of them, until
+    interrupted"""
+    authkey = _as_bytes(authkey)
+    listener = _listen(address)
+    if verbose:
+        print('[joblib] Waiting for connections on %s:%d'
+              % listener.getsockname()[:2])
+    # The clients are authenticated by threads, so that a slow client
+    # does not hold the connections of the others, and a worker process
+    # is only started for the authenticated clients
+    pending = threading.BoundedSemaphore(MAX_PENDING_HANDSHAKES)
+    try:
+        while True:
+            pending.acquire()
+            try:
+                sock, _ = listener.accept()
+            except socket.error as e:
+                pending.release()
+                if verbose:
+                    print('[joblib] Refused a connection: %r' % e)
+                continue
+            thread = threading.Thread(target=_accept_client,
+                                      args=(sock, authkey, pending, verbose))
+            thread.daemon = True
+            thread.start()
+            # Collect the workers that have exited
+            multiprocessing.active_children()
+    finally:
+        listener.close()
+
+
+###############################################################################
+# Client side
+
+class TCPResult(object):
+    """The result of a task submitted to a TCPPool, with the interface of
+    the results of multiprocessing.pool.Pool.apply_async"""
+
+    def __init__(self, callback=None, error_callback=None):
+        self._callback = callback
+        self._error_callback = error_callback
+        self._event = threading.Event()
+
+    def ready(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        self.wait(timeout)
+        if not self.ready():
+            raise multiprocessing.TimeoutError
+        if self._success:
+            return self._value
+        raise self._value
+
+    def _set(self, success, value):
+        self._success = success
+        self._value = value
+        try:
+            if success and self._callback is not None:
+                self._callback(value)
+            elif not success and self._error_callback is not None:
+                self._error_callback(value)
+        finally:
+            self._event.set()
+
+
+class TCPPool(object):
+    """Pool of worker processes on other hosts, reached over TCP.
+
+    `processes` connections are opened, spread over the addresses of the
+    worker servers given, as 'host:port' strings or (host, port) pairs,
+    each connection being served by a worker process. The worker
+    servers are started with `serve`, or with::
+
+        JOBLIB_TCP_AUTHKEY=secret python -m joblib.tcp_pool host:port
+
+    The tasks are submitted with apply_async, which has the interface of
+    multiprocessing.pool.Pool.apply_async, and are pickled to be sent to
+    the workers: their functions must be importable on the other hosts,
+    or pickled by value, for instance with cloudpickle. The callbacks
+    are called from a single thread of the pool.
+
+    If given, initializer is called with the arguments initargs by each
+    worker process before its first task. It is pickled, as the tasks,
+    and its errors are ignored.
+
+    A task whose worker or connection is lost fails with a
+    WorkerLostError. Terminating the pool closes the connections, but
+    the tasks running in the workers are not interrupted.
+    """
+
+    # Seconds during which the connection to a worker server is retried,
+    # while it starts
+    connect_timeout = 10
+
+    def __init__(self, processes, addresses, authkey, initializer=None,
+                 initargs=()):
+        if not addresses:
+            raise ValueError('No address of worker server given')
+        authkey = _as_bytes(authkey)
+        self._initializer = initializer
+        self._initargs = initargs
+        self._state = RUN
+        self._tasks = queue.Queue()
+        self._results = queue.Queue()
+        self._lock = threading.Lock()
+        self._connections = list()
+        # The sockets of the connections, to shut them down
+        self._sockets = list()
+        try:
+            for address in itertools.islice(itertools.cycle(addresses),
+                                            processes):
+                connection, sock = self._connect(parse_address(address),
+                                                 authkey)
+                self._connections.append(connection)
+                self._sockets.append(sock)
+        except Exception:
+            self._close_connections()
+            raise
+        self._n_alive = len(self._connections)
+        self._threads = list()
+        for connection in self._connections:
+            thread = threading.Thread(target=self._handle_connection,
+                                      args=(connection,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._result_handler = threading.Thread(target=self._handle_results)
+        self._result_handler.daemon = True
+        self._result_handler.start()
+
+    def _connect(self, address, authkey):
+        """Return the authenticated connection to the worker server, and
+        its socket"""
+        deadline = time.time() + self.connect_timeout
+        while True:
+            try:
+                # Of the address family of the host
+                sock = socket.create_connection(
+                    address, max(deadline - time.time(), .1))
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(.1)
+        # The connection reads and writes on a duplicate of the socket,
+        # which is to stay blocking
+        sock.settimeout(None)
+        try:
+            connection = _authenticate(sock, authkey, server=False)
+        except Exception:
+            sock.close()
+            raise
+        return connection, sock
+
+    def _close_connections(self):
+        for connection in self._connections:
+            connection.close()
+        for sock in self._sockets:
+            sock.close()
+
+    def apply_async(self, func, args=(), kwds={}, callback=None,
+                    error_callback=None):
+        if self._state != RUN:
+            raise ValueError('Pool not running')
+        job = TCPResult(callback, error_callback)
+        with self._lock:
+            if self._n_alive:
+                self._tasks.put((job, func, args, kwds))
+                return job
+        self._results.put((job, False, WorkerLostError(
+            'All the connections to the workers are lost')))
+        return job
+
+    def _handle_connection(self, connection):
+        """Send the tasks to the worker of the connection, one at a time,
+        and hand their results to the result handler"""
+        if self._initializer is not None:
+            try:
+                connection.send_bytes(dumps(
+                    (self._initializer, self._initargs, {}),
+                    HIGHEST_PROTOCOL))
+                connection.recv_bytes()
+            except Exception as e:
+                # Also when the initializer cannot be pickled
+                self._lose_connection(None, e)
+                return
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            job, func, args, kwds = task
+            start_time = time.time()
+            try:
+                data = dumps((func, args, kwds), HIGHEST_PROTOCOL)
+            except Exception as e:
+                self._results.put((job, False, e))
+                continue
+            job._transfer_stats = dict(
+                args_nbytes=len(data),
+                args_pickle_time=time.time() - start_time)
+            try:
+                connection.send_bytes(data)
+                data = connection.recv_bytes()
+            except (EOFError, IOError, OSError) as e:
+                self._lose_connection(job, e)
+                return
+            start_time = time.time()
+            try:
+                success, value = loads(data)
+            except Exception as e:
+                success, value = False, e
+            now = time.time()
+            job._transfer_stats.update(result_nbytes=len(data),
+                                       result_unpickle_time=now - start_time,
+                                       received_time=now)
+            self._results.put((job, success, value))
+
+    def _lose_connection(self, job, exception):
+        """Fail the task of a lost connection, and, if it was the last
+        one, the tasks left"""
+        if self._state == TERMINATE:
+            return
+        if job is not None:
+            self._results.put((job, False, WorkerLostError(
+                'The connection to the worker running this task was lost: '
+                '%r. The worker process may have been killed, or its host '
+                'may be unreachable.' % (exception,))))
+        with self._lock:
+            self._n_alive -= 1
+            if self._n_alive:
+                return
+        while True:
+            try:
+                task = self._tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is not None:
+                self._results.put((task[0], False, WorkerLostError(
+                    'All the connections to the workers are lost, the '
+                    'last one with: %r' % (exception,))))
+
+    def _handle_results(self):
+        while True:
+            result = self._results.get()
+            if result is None:
+                break
+            job, success, value = result
+            job._set(success, value)
+
+    def close(self):
+        """Let the workers finish the tasks submitted, and disconnect"""
+        if self._state == RUN:
+            self._state = CLOSE
+            for _ in self._threads:
+                self._tasks.put(None)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+        self._results.put(None)
+        self._result_handler.join()
+        self._close_connections()
+
+    def terminate(self):
+        """Disconnect from the workers right away"""
+        if self._state == TERMINATE:
+            return
+        self._state = TERMINATE
+        for sock in self._sockets:
+            # Unblocks the threads waiting for results
+            _shutdown(sock)
+        for _ in self._threads:
+            self._tasks.put(None)
+        self._results.put(None)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Start a joblib worker server, which starts a worker '
+                    'process for each connection of a TCPPool. The '
+                    'authentication key is read from the JOBLIB_TCP_AUTHKEY '
+                    'environment variable.')
+    parser.add_argument('address', help="the address to listen on, as "
+                        "'host:port'")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    options = parser.parse_args(argv)
+    authkey = os.environ.get('JOBLIB_TCP_AUTHKEY')
+    if not authkey:
+        parser.error('The JOBLIB_TCP_AUTHKEY environment variable must be '
+                     'set')
+    try:
+        serve(options.address, authkey, verbose=options.verbose)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -10,6 +10,9 @@ import time
 import sys
 import io
 import os
+import shutil
+import warnings
+import tempfile
 try:
     import cPickle as pickle
     PickleError = TypeError
@@ -29,8 +32,14 @@ except NameError:
 
 
 from ..parallel import Parallel, delayed, SafeFunction, WorkerInterrupt, \
-        multiprocessing, cpu_count
-from ..my_exceptions import JoblibException
+        multiprocessing, cpu_count, cloudpickle, BACKENDS, \
+        register_parallel_backend, parallel_backend, get_worker_state, \
+        run_worker_initializers, DiskOutputs, ParallelBackendBase, \
+        _temporary_folders
+from .._parallel_backends import ThreadingBackend, MultiprocessingBackend
+from ..my_exceptions import JoblibException, WorkerLostError, \
+    JobTimeoutError
+from .common import np, with_numpy
 
 import nose
 
@@ -127,14 +136,26 @@ def test_parallel_kwargs():
 
 def test_parallel_pickling():
     """ Check that pmap captures the errors when it is passed an object
-        that cannot be pickled.
+        that cannot be pickled, or, with cloudpickle, that it can run
+        closures and lambdas.
     """
     def g(x):
         return x ** 2
-    nose.tools.assert_raises(PickleError,
-                             Parallel(),
-                             (delayed(g)(x) for x in range(10))
-                            )
+    if cloudpickle is None:
+        nose.tools.assert_raises(PickleError,
+                                 Parallel(),
+                                 (delayed(g)(x) for x in range(10))
+                                )
+        return
+    offset = 3
+    for n_jobs in (1, 2):
+        nose.tools.assert_equal(
+            Parallel(n_jobs=n_jobs)(delayed(g)(x) for x in range(10)),
+            [g(x) for x in range(10)])
+        nose.tools.assert_equal(
+            Parallel(n_jobs=n_jobs)(delayed(lambda x: x + offset)(x)
+                                    for x in range(10)),
+            [x + offset for x in range(10)])
 
 
 def test_error_capture():
@@ -272,3 +293,1136 @@ def test_joblib_exception():
 def test_safe_function():
     safe_division = SafeFunction(division)
     nose.tools.assert_raises(JoblibException, safe_division, 1, 0)
+
+
+###############################################################################
+# Test batching
+def test_batching():
+    X = range(20)
+    for n_jobs in (1, 2):
+        for batch_size in (1, 3, 7, 50, 'auto'):
+            yield (nose.tools.assert_equal, [square(x) for x in X],
+                   Parallel(n_jobs=n_jobs, batch_size=batch_size)(
+                       delayed(square)(x) for x in X))
+            yield (nose.tools.assert_equal, [square(x) for x in X],
+                   Parallel(n_jobs=n_jobs, batch_size=batch_size,
+                            pre_dispatch=4)(
+                       delayed(square)(x) for x in X))
+
+
+def test_batching_auto_grows_batch_size():
+    if multiprocessing is None:
+        raise nose.SkipTest()
+    parallel = Parallel(n_jobs=2, batch_size='auto')
+    out = parallel(delayed(square)(x) for x in range(5000))
+    nose.tools.assert_equal(out, [square(x) for x in range(5000)])
+    # Tasks this fast should have been grouped in large batches
+    nose.tools.assert_true(parallel._effective_batch_size > 1)
+    nose.tools.assert_true(parallel.n_dispatched_batches < 5000)
+    nose.tools.assert_equal(parallel.n_dispatched_tasks, 5000)
+    nose.tools.assert_equal(parallel.n_completed_tasks, 5000)
+
+
+def test_invalid_batch_size():
+    for batch_size in (0, -1, 'foo', 1.5):
+        nose.tools.assert_raises(ValueError, Parallel, batch_size=batch_size)
+
+
+###############################################################################
+# Test the threading backend
+def identity(x):
+    return x
+
+
+def test_threading_backend():
+    if multiprocessing is None:
+        raise nose.SkipTest()
+    X = range(10)
+    for n_jobs in (1, 2, -1):
+        yield (nose.tools.assert_equal, [square(x) for x in X],
+               Parallel(n_jobs=n_jobs, backend='threading')(
+                   delayed(square)(x) for x in X))
+    # The arguments and results are not copied
+    data = [list(range(3)) for _ in range(5)]
+    out = Parallel(n_jobs=2, backend='threading')(
+        delayed(identity)(d) for d in data)
+    for d, o in zip(data, out):
+        nose.tools.assert_true(d is o)
+
+
+def test_threading_backend_error_capture():
+    if multiprocessing is None:
+        raise nose.SkipTest()
+    nose.tools.assert_raises(JoblibException,
+            Parallel(n_jobs=2, backend='threading'),
+            [delayed(division)(x, y) for x, y in zip((0, 1), (1, 0))])
+    nose.tools.assert_raises(ZeroDivisionError,
+            Parallel(n_jobs=2, backend='threading'),
+            [delayed(division)(x, y) for x, y in zip((0, 1), (1, 0))])
+
+
+def test_threading_backend_pre_dispatch():
+    if multiprocessing is None:
+        raise nose.SkipTest()
+    queue = list()
+
+    def producer():
+        for i in range(6):
+            queue.append('Produced %i' % i)
+            yield i
+
+    Parallel(n_jobs=2, backend='threading', pre_dispatch=3)(
+        delayed(consumer)(queue, i) for i in producer())
+    nose.tools.assert_equal(len(queue), 12)
+    # The producer and the worker threads interleave in any order: only
+    # check that the input is consumed lazily
+    first_consumed = min(i for i, item in enumerate(queue)
+                         if item.startswith('Consumed'))
+    nose.tools.assert_true(first_consumed <= 3 + 2)
+    for i in range(6):
+        nose.tools.assert_true(queue.index('Produced %i' % i)
+                               < queue.index('Consumed %i' % i))
+
+
+def threaded_nested_loop():
+    return Parallel(n_jobs=2, backend='threading')(
+        delayed(square)(x) for x in range(3))
+
+
+def test_threading_backend_nested_in_processes():
+    nose.tools.assert_equal(
+        Parallel(n_jobs=2)(delayed(threaded_nested_loop)() for _ in range(2)),
+        [[0, 1, 4], [0, 1, 4]])
+
+
+def test_invalid_backend():
+    nose.tools.assert_raises(ValueError, Parallel, backend='foo')
+    nose.tools.assert_raises(ValueError, parallel_backend('foo').__enter__)
+
+
+###############################################################################
+# Test the custom backends
+class CountingBackend(ThreadingBackend):
+    """ A threading backend counting the batches submitted
+    """
+    def __init__(self, n_calls=None):
+        self.n_calls = n_calls if n_calls is not None else [0]
+
+    def submit(self, func, callback=None, error_callback=None,
+               timeout=None):
+        self.n_calls[0] += 1
+        return super(CountingBackend, self).submit(
+            func, callback=callback, error_callback=error_callback)
+
+
+def test_register_parallel_backend():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    # The base class of the backends is public
+    nose.tools.assert_true(issubclass(CountingBackend, ParallelBackendBase))
+    register_parallel_backend('counting', CountingBackend)
+    try:
+        parallel = Parallel(n_jobs=2, backend='counting', batch_size=2)
+        nose.tools.assert_equal(parallel(delayed(square)(x)
+                                         for x in range(10)),
+                                [x ** 2 for x in range(10)])
+        nose.tools.assert_equal(parallel._backend.n_calls, [5])
+        # The jobs are run by threads
+        nose.tools.assert_equal(set(parallel(delayed(get_pid)(x)
+                                             for x in range(4))),
+                                set([os.getpid()]))
+        # The backend objects can also be given directly
+        backend = CountingBackend()
+        Parallel(n_jobs=2, backend=backend)(delayed(square)(x)
+                                            for x in range(3))
+        nose.tools.assert_equal(backend.n_calls, [3])
+        # Without timeout support
+        nose.tools.assert_raises(ValueError, Parallel, n_jobs=2,
+                                 backend=backend, timeout=1)
+    finally:
+        del BACKENDS['counting']
+
+
+def test_parallel_backend():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    register_parallel_backend('counting', CountingBackend)
+    try:
+        n_calls = [0]
+        with parallel_backend('counting', n_calls=n_calls):
+            Parallel(n_jobs=2)(delayed(square)(x) for x in range(3))
+            # An explicit backend has precedence
+            pids = Parallel(n_jobs=2, backend='multiprocessing')(
+                delayed(get_pid)(x) for x in range(4))
+            nose.tools.assert_false(os.getpid() in pids)
+            with parallel_backend('threading'):
+                Parallel(n_jobs=2)(delayed(square)(x) for x in range(3))
+            Parallel(n_jobs=2)(delayed(square)(x) for x in range(3))
+        nose.tools.assert_equal(n_calls, [6])
+        nose.tools.assert_true(isinstance(Parallel()._backend,
+                                          MultiprocessingBackend))
+        nose.tools.assert_raises(ValueError, parallel_backend(
+            CountingBackend(), n_calls=n_calls).__enter__)
+    finally:
+        del BACKENDS['counting']
+
+
+###############################################################################
+# Test the reuse of the pool with the context manager
+def get_pid(x):
+    time.sleep(.01)
+    return os.getpid()
+
+
+def test_parallel_context_manager():
+    for backend in ('multiprocessing', 'threading'):
+        for n_jobs in (1, 2):
+            with Parallel(n_jobs=n_jobs, backend=backend) as parallel:
+                pool = parallel._pool
+                for n in range(4):
+                    nose.tools.assert_equal(
+                        parallel(delayed(square)(x) for x in range(n)),
+                        [square(x) for x in range(n)])
+                    # The same pool is used by all the calls
+                    nose.tools.assert_true(parallel._pool is pool)
+            nose.tools.assert_true(parallel._pool is None)
+
+
+def test_parallel_context_manager_reuses_workers():
+    if multiprocessing is None:
+        raise nose.SkipTest()
+    with Parallel(n_jobs=2, batch_size=1) as parallel:
+        pids = set(parallel(delayed(get_pid)(i) for i in range(10)))
+        pids.update(parallel(delayed(get_pid)(i) for i in range(10)))
+    nose.tools.assert_true(len(pids) <= 2)
+
+
+def test_parallel_context_manager_nested_calls():
+    # Another Parallel call can be made while a pool is kept alive: the
+    # guard against recursive spawning only applies in the workers
+    with Parallel(n_jobs=2) as parallel:
+        nose.tools.assert_equal(Parallel(n_jobs=2)(
+                                    delayed(square)(x) for x in range(3)),
+                                [0, 1, 4])
+        nose.tools.assert_equal(parallel(
+                                    delayed(square)(x) for x in range(3)),
+                                [0, 1, 4])
+    nose.tools.assert_false('__JOBLIB_SPAWNED_PARALLEL__' in os.environ)
+
+
+def test_parallel_context_manager_error():
+    if multiprocessing is None:
+        raise nose.SkipTest()
+    with Parallel(n_jobs=2) as parallel:
+        nose.tools.assert_raises(ZeroDivisionError, parallel,
+                [delayed(division)(x, y) for x, y in zip((0, 1), (1, 0))])
+        # The pool can still be used after an error
+        nose.tools.assert_equal(parallel(
+                                    delayed(square)(x) for x in range(3)),
+                                [0, 1, 4])
+
+
+###############################################################################
+# Test the generator output
+def test_return_as_generator():
+    import types
+    X = range(10)
+    for n_jobs in (1, 2):
+        for backend in ('multiprocessing', 'threading'):
+            for pre_dispatch in ('all', '2*n_jobs'):
+                output = Parallel(n_jobs=n_jobs, backend=backend,
+                                  pre_dispatch=pre_dispatch,
+                                  return_as='generator')(
+                    delayed(square)(x) for x in X)
+                nose.tools.assert_true(isinstance(output,
+                                                  types.GeneratorType))
+                nose.tools.assert_equal(list(output), [square(x) for x in X])
+
+
+def test_retrieve_deprecated():
+    parallel = Parallel(n_jobs=2)
+    n_jobs = parallel._initialize_call()
+    try:
+        parallel._start([delayed(square)(x) for x in range(3)], n_jobs)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            parallel.retrieve()
+    finally:
+        parallel._finish_call()
+    nose.tools.assert_equal(parallel._output, [0, 1, 4])
+    nose.tools.assert_equal([w.category for w in caught],
+                            [DeprecationWarning])
+
+
+def test_return_as_generator_is_lazy():
+    # In sequential mode, the jobs are run as the outputs are consumed
+    queue = list()
+
+    def producer():
+        for i in range(3):
+            queue.append('Produced %i' % i)
+            yield i
+
+    output = Parallel(n_jobs=1, return_as='generator')(
+        delayed(identity)(i) for i in producer())
+    nose.tools.assert_equal(queue, [])
+    for i in output:
+        queue.append('Consumed %i' % i)
+    nose.tools.assert_equal(queue, ['Produced 0', 'Consumed 0',
+                                    'Produced 1', 'Consumed 1',
+                                    'Produced 2', 'Consumed 2'])
+
+
+def test_return_as_generator_error():
+    for n_jobs in (1, 2):
+        # Not batched with the failing job, the outputs before it are
+        # yielded
+        output = Parallel(n_jobs=n_jobs, return_as='generator',
+                          batch_size=1)(
+            delayed(exception_raiser)(i) for i in range(10))
+        nose.tools.assert_equal([next(output) for _ in range(7)],
+                                list(range(7)))
+        nose.tools.assert_raises(ValueError, next, output)
+
+
+def test_return_as_generator_early_close():
+    parallel = Parallel(n_jobs=2, pre_dispatch=4, return_as='generator')
+    output = parallel(delayed(square)(x) for x in range(100))
+    nose.tools.assert_equal(next(output), 0)
+    output.close()
+    nose.tools.assert_true(parallel._pool is None)
+    # The Parallel object can be used again
+    nose.tools.assert_equal(list(parallel(delayed(square)(x)
+                                          for x in range(3))),
+                            [0, 1, 4])
+
+
+def test_invalid_return_as():
+    nose.tools.assert_raises(ValueError, Parallel, return_as='foo')
+
+
+###############################################################################
+# Test the unordered output
+def sleep_and_return(x, duration):
+    time.sleep(duration)
+    return x
+
+
+def test_unordered_output():
+    X = range(20)
+    for n_jobs in (1, 2):
+        for backend in ('multiprocessing', 'threading'):
+            for return_as in ('list', 'generator'):
+                for batch_size in (1, 3, 'auto'):
+                    out = Parallel(n_jobs=n_jobs, backend=backend,
+                                   return_as=return_as, ordered=False,
+                                   batch_size=batch_size,
+                                   pre_dispatch='2*n_jobs')(
+                        delayed(square)(x) for x in X)
+                    out = list(out)
+                    nose.tools.assert_equal(sorted(out),
+                                            [(x, square(x)) for x in X])
+
+
+def test_unordered_output_slow_first_job():
+    # A slow first job does not hold back the outputs of the others
+    durations = [1.] + [0.] * 5
+    out = list(Parallel(n_jobs=2, backend='threading', ordered=False,
+                        return_as='generator')(
+        delayed(sleep_and_return)(i, d) for i, d in enumerate(durations)))
+    nose.tools.assert_equal(out[-1], (0, 0))
+    nose.tools.assert_equal(sorted(out), [(i, i) for i in range(6)])
+
+
+def test_unordered_output_error():
+    for backend in ('multiprocessing', 'threading'):
+        nose.tools.assert_raises(ValueError,
+            list, Parallel(n_jobs=2, ordered=False, backend=backend,
+                           return_as='generator')(
+                delayed(exception_raiser)(i) for i in range(30)))
+        with Parallel(n_jobs=2, ordered=False, backend=backend) as parallel:
+            nose.tools.assert_raises(ValueError, parallel,
+                (delayed(exception_raiser)(i) for i in range(30)))
+            nose.tools.assert_equal(
+                sorted(parallel(delayed(square)(x) for x in range(3))),
+                [(0, 0), (1, 1), (2, 4)])
+
+
+###############################################################################
+# Test the asyncio integration
+def check_asyncio():
+    if sys.version_info < (3, 7):
+        raise nose.SkipTest('Requires Python 3.7')
+
+
+def collect_async_iterator(async_iterator):
+    # Iterate without the 'async for' syntax, unavailable in Python 2
+    import asyncio
+    loop = asyncio.new_event_loop()
+    out = list()
+    try:
+        while True:
+            try:
+                out.append(loop.run_until_complete(
+                    async_iterator.__anext__()))
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.close()
+    return out
+
+
+def test_as_async():
+    check_asyncio()
+    import asyncio
+    X = range(10)
+    for n_jobs in (1, 2):
+        for backend in ('multiprocessing', 'threading'):
+            parallel = Parallel(n_jobs=n_jobs, backend=backend,
+                                pre_dispatch='2*n_jobs')
+            out = asyncio.run(parallel.as_async(
+                delayed(square)(x) for x in X))
+            nose.tools.assert_equal(out, [square(x) for x in X])
+            parallel = Parallel(n_jobs=n_jobs, backend=backend,
+                                ordered=False)
+            out = asyncio.run(parallel.as_async(
+                delayed(square)(x) for x in X))
+            nose.tools.assert_equal(sorted(out), [(x, square(x)) for x in X])
+
+
+def test_as_async_generator():
+    check_asyncio()
+    for n_jobs in (1, 2):
+        parallel = Parallel(n_jobs=n_jobs, return_as='generator')
+        out = collect_async_iterator(parallel.as_async(
+            delayed(square)(x) for x in range(10)))
+        nose.tools.assert_equal(out, [square(x) for x in range(10)])
+
+
+def test_as_async_error():
+    check_asyncio()
+    import asyncio
+    for backend in ('multiprocessing', 'threading'):
+        with Parallel(n_jobs=2, backend=backend) as parallel:
+            try:
+                asyncio.run(parallel.as_async(
+                    delayed(exception_raiser)(i) for i in range(30)))
+            except ValueError as exception:
+                error = exception
+            nose.tools.assert_true(isinstance(error, JoblibException))
+            # The pool can be used again
+            nose.tools.assert_equal(asyncio.run(parallel.as_async(
+                delayed(square)(x) for x in range(3))), [0, 1, 4])
+
+
+def test_as_async_does_not_block_the_event_loop():
+    check_asyncio()
+    import asyncio
+    loop = asyncio.new_event_loop()
+    ticks = list()
+
+    def tick():
+        ticks.append(time.time())
+        loop.call_later(.02, tick)
+
+    try:
+        loop.call_soon(tick)
+        out = loop.run_until_complete(
+            Parallel(n_jobs=2, backend='threading').as_async(
+                delayed(sleep_and_return)(i, .2) for i in range(4)))
+    finally:
+        loop.close()
+    nose.tools.assert_equal(out, list(range(4)))
+    # The event loop kept running while the jobs were computed
+    nose.tools.assert_true(len(ticks) > 5)
+
+
+###############################################################################
+# Test the death of the workers
+def exit_worker(exitcode):
+    os._exit(exitcode)
+
+
+def test_worker_death():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    with Parallel(n_jobs=2) as parallel:
+        nose.tools.assert_raises(
+            WorkerLostError, parallel,
+            (delayed(exit_worker)(1) if i == 3 else delayed(square)(i)
+             for i in range(10)))
+        # The pool is repaired for the next calls
+        nose.tools.assert_equal(parallel(delayed(square)(i) for i in range(5)),
+                                [square(i) for i in range(5)])
+
+
+###############################################################################
+# Test the cost-aware scheduling
+def append_and_return(x, started):
+    started.append(x)
+    time.sleep(.01)
+    return x
+
+
+def test_cost_scheduling():
+    costs = [1, 5, 2, 5, 0, 3]
+    started = list()
+    # The threading backend shares the list with the jobs
+    out = Parallel(n_jobs=2, backend='threading',
+                   cost=lambda x, started: costs[x])(
+        delayed(append_and_return)(i, started) for i in range(6))
+    nose.tools.assert_equal(out, list(range(6)))
+    # The most costly jobs are started first
+    nose.tools.assert_equal(sorted(started[:2]), [1, 3])
+    nose.tools.assert_equal(sorted(started[-2:]), [0, 4])
+
+    for n_jobs in (1, 2):
+        for ordered in (True, False):
+            parallel = Parallel(n_jobs=n_jobs, cost=abs, ordered=ordered,
+                                return_as='generator')
+            out = list(parallel(delayed(square)(x) for x in range(-5, 5)))
+            if ordered:
+                nose.tools.assert_equal(out, [square(x)
+                                              for x in range(-5, 5)])
+            else:
+                nose.tools.assert_equal(
+                    sorted(out), list(enumerate(square(x)
+                                                for x in range(-5, 5))))
+
+
+###############################################################################
+# Test the limits on the number of threads of the native libraries
+def get_environ(name):
+    return os.environ.get(name)
+
+
+def test_inner_max_num_threads():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    if 'OMP_NUM_THREADS' in os.environ:
+        raise nose.SkipTest('OMP_NUM_THREADS is set')
+    expected = str(max(multiprocessing.cpu_count() // 2, 1))
+    for inner_max_num_threads, value in [('auto', expected), (3, '3'),
+                                         (None, None)]:
+        out = Parallel(n_jobs=2, inner_max_num_threads=inner_max_num_threads)(
+            delayed(get_environ)(name) for name in ['OMP_NUM_THREADS',
+                                                    'MKL_NUM_THREADS'])
+        nose.tools.assert_equal(out, [value, value])
+        # The environment of the parent process is not modified
+        nose.tools.assert_false('OMP_NUM_THREADS' in os.environ)
+
+    # The limits chosen by the user are respected
+    os.environ['OMP_NUM_THREADS'] = '5'
+    try:
+        out = Parallel(n_jobs=2)(delayed(get_environ)(name)
+                                 for name in ['OMP_NUM_THREADS',
+                                              'MKL_NUM_THREADS'])
+        nose.tools.assert_equal(out, ['5', None])
+    finally:
+        del os.environ['OMP_NUM_THREADS']
+
+    for value in (0, 'all', 1.5):
+        nose.tools.assert_raises(ValueError, Parallel,
+                                 inner_max_num_threads=value)
+
+
+###############################################################################
+# Test the timeouts
+def test_timeout():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    durations = [0, 0, 10, 0, 0]
+    with Parallel(n_jobs=2, timeout=1, batch_size=1) as parallel:
+        start = time.time()
+        nose.tools.assert_raises(
+            JobTimeoutError, parallel,
+            (delayed(sleep_and_return)(i, d) for i, d in enumerate(durations)))
+        nose.tools.assert_true(time.time() - start < 5)
+        # The stuck worker was replaced
+        nose.tools.assert_equal(parallel(delayed(square)(i) for i in range(5)),
+                                [square(i) for i in range(5)])
+
+    out = Parallel(n_jobs=2, timeout=1, batch_size=1, on_timeout='return',
+                   pre_dispatch='n_jobs')(
+        delayed(sleep_and_return)(i, d) for i, d in enumerate(durations))
+    nose.tools.assert_true(isinstance(out[2], JobTimeoutError))
+    nose.tools.assert_equal(out[:2] + out[3:], [0, 1, 3, 4])
+
+    # With batch_size='auto', the fast jobs are not batched with the slow
+    # one, which does not get a longer timeout
+    durations = [0] * 300 + [3]
+    parallel = Parallel(n_jobs=2, timeout=.5, on_timeout='return')
+    start = time.time()
+    out = parallel(delayed(sleep_and_return)(i, d)
+                   for i, d in enumerate(durations))
+    nose.tools.assert_true(time.time() - start < 3)
+    nose.tools.assert_true(isinstance(out[-1], JobTimeoutError))
+    nose.tools.assert_equal(out[:-1], list(range(300)))
+    nose.tools.assert_equal(set(batch['n_tasks']
+                                for batch in parallel.stats_.batches),
+                            set([1]))
+
+    nose.tools.assert_raises(ValueError, Parallel, backend='threading',
+                             timeout=1)
+    nose.tools.assert_raises(ValueError, Parallel, on_timeout='ignore')
+    for timeout in [0, -1]:
+        nose.tools.assert_raises(ValueError, Parallel, timeout=timeout)
+
+
+###############################################################################
+# Test the cancellation of the jobs after an error
+def raise_or_sleep(x):
+    if x == 0:
+        raise ValueError
+    time.sleep(.5)
+
+
+def test_cancellation_after_error():
+    for backend in ('multiprocessing', 'threading'):
+        if backend == 'multiprocessing' and multiprocessing is None:
+            continue
+        with Parallel(n_jobs=2, backend=backend, batch_size=1) as parallel:
+            for _ in range(2):
+                # The 20 queued jobs would take 5s to complete
+                start = time.time()
+                nose.tools.assert_raises(
+                    ValueError, parallel,
+                    (delayed(raise_or_sleep)(i) for i in range(21)))
+                nose.tools.assert_true(time.time() - start < 2)
+            # The pool is still usable after the cancellation
+            nose.tools.assert_equal(
+                parallel(delayed(square)(i) for i in range(5)),
+                [square(i) for i in range(5)])
+
+
+def raise_late_or_sleep(x):
+    if x == 0:
+        time.sleep(.2)
+        raise ValueError
+    time.sleep(8)
+
+
+def test_cancellation_terminates_running_jobs():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    with Parallel(n_jobs=3, batch_size=1) as parallel:
+        pool = parallel._pool._pool
+        for _ in range(2):
+            start = time.time()
+            nose.tools.assert_raises(
+                ValueError, parallel,
+                (delayed(raise_late_or_sleep)(i) for i in range(3)))
+            # Without waiting for the jobs running next to the error
+            nose.tools.assert_true(time.time() - start < 4)
+        # Their workers were terminated, and replaced
+        nose.tools.assert_true(parallel._pool._pool is pool)
+        nose.tools.assert_equal(
+            parallel(delayed(square)(i) for i in range(5)),
+            [square(i) for i in range(5)])
+    start = time.time()
+    nose.tools.assert_raises(
+        ValueError, Parallel(n_jobs=3, batch_size=1),
+        (delayed(raise_late_or_sleep)(i) for i in range(3)))
+    nose.tools.assert_true(time.time() - start < 4)
+    # Many aborted calls in a row do not hang
+    for _ in range(20):
+        nose.tools.assert_raises(
+            ValueError, Parallel(n_jobs=2),
+            (delayed(exception_raiser)(7) for _ in range(4)))
+
+
+def test_interruption_terminates_pool():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    with Parallel(n_jobs=2) as parallel:
+        pool = parallel._pool._pool
+        nose.tools.assert_raises(
+            WorkerInterrupt, parallel,
+            (delayed(interrupt_raiser)(x) for x in (1, 0)))
+        nose.tools.assert_true(parallel._pool is None)
+        nose.tools.assert_false(any(worker.is_alive()
+                                    for worker in pool._pool))
+        # The next call starts a new pool
+        nose.tools.assert_equal(
+            parallel(delayed(square)(i) for i in range(5)),
+            [square(i) for i in range(5)])
+
+
+def test_cancellation_on_generator_close():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    start = time.time()
+    out = Parallel(n_jobs=2, batch_size=1, return_as='generator')(
+        delayed(sleep_and_return)(i, .5) for i in range(20))
+    nose.tools.assert_equal(next(out), 0)
+    out.close()
+    nose.tools.assert_true(time.time() - start < 2)
+
+
+class LargeModel(object):
+    """ A callable with a large state, counting its unpickling in the
+        current process
+    """
+    n_loads = 0
+
+    def __init__(self, size):
+        self.weights = list(range(size))
+
+    def __setstate__(self, state):
+        LargeModel.n_loads += 1
+        self.__dict__.update(state)
+
+    def predict(self, x):
+        return os.getpid(), LargeModel.n_loads, self.weights[x]
+
+
+def test_function_sent_once():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    temp_folder = tempfile.mkdtemp(prefix='joblib_test_parallel_')
+    try:
+        model = LargeModel(10000)
+        with Parallel(n_jobs=2, batch_size=1,
+                      temp_folder=temp_folder) as parallel:
+            for _ in range(2):
+                out = parallel(delayed(model.predict)(x) for x in range(20))
+                nose.tools.assert_equal([weight for _, _, weight in out],
+                                        list(range(20)))
+                # The model is unpickled once by each worker, for all the
+                # batches and calls
+                nose.tools.assert_equal(set(n_loads for _, n_loads, _ in out),
+                                        set([1]))
+        # The pickled model is deleted with the pool, and its folder is
+        # not left to the exit of the process
+        nose.tools.assert_equal(os.listdir(temp_folder), [])
+        nose.tools.assert_false(any(
+            folder.startswith(temp_folder)
+            for folder in _temporary_folders))
+    finally:
+        shutil.rmtree(temp_folder)
+
+
+def test_stats():
+    backends = [('threading', 2)]
+    if multiprocessing is not None:
+        backends.append(('multiprocessing', 2))
+    backends.append(('multiprocessing', 1))
+    for backend, n_jobs in backends:
+        parallel = Parallel(n_jobs=n_jobs, backend=backend, batch_size=2)
+        nose.tools.assert_true(parallel.stats_ is None)
+        parallel(delayed(sleep_and_return)(i, .05) for i in range(6))
+        stats = parallel.stats_
+        nose.tools.assert_equal(stats.n_tasks, 6)
+        nose.tools.assert_equal(len(stats.batches), 3)
+        for batch in stats.batches:
+            nose.tools.assert_equal(batch['n_tasks'], 2)
+            nose.tools.assert_true(batch['compute_time'] >= .09)
+            nose.tools.assert_true(batch['queue_wait'] >= 0)
+            nose.tools.assert_true(batch['total_time']
+                                   >= batch['compute_time'])
+            if backend == 'multiprocessing' and n_jobs > 1:
+                nose.tools.assert_true(batch['args_nbytes'] > 0)
+                nose.tools.assert_true(batch['result_nbytes'] > 0)
+                nose.tools.assert_true(batch['result_dump_time'] >= 0)
+            else:
+                nose.tools.assert_true(batch['args_nbytes'] is None)
+                nose.tools.assert_true(batch['result_dump_time'] is None)
+        nose.tools.assert_equal(sorted(task['index'] for task in stats.tasks),
+                                list(range(6)))
+        for task in stats.tasks:
+            nose.tools.assert_true(task['compute_time'] >= .045)
+            nose.tools.assert_true(task['queue_wait'] >= 0)
+            if backend == 'multiprocessing' and n_jobs > 1:
+                nose.tools.assert_true(task['result_nbytes'] > 0)
+                nose.tools.assert_true(task['result_dump_time'] >= 0)
+            else:
+                nose.tools.assert_true(task['result_nbytes'] is None)
+        # The second task of each batch waits for the first one
+        for first, second in zip(stats.tasks[::2], stats.tasks[1::2]):
+            nose.tools.assert_true(second['queue_wait']
+                                   >= first['queue_wait'] + .045)
+        workers = stats.workers
+        nose.tools.assert_true(1 <= len(workers) <= n_jobs)
+        nose.tools.assert_equal(
+            sum(worker['n_tasks'] for worker in workers.values()), 6)
+        nose.tools.assert_true(0 < stats.utilization <= 1)
+        nose.tools.assert_true(stats.throughput > 0)
+        nose.tools.assert_true('n_tasks=6' in repr(stats))
+
+
+def test_progress_callback():
+    for n_jobs in (1, 2):
+        calls = list()
+
+        def progress_callback(*args):
+            calls.append(args)
+
+        Parallel(n_jobs=n_jobs, batch_size=1,
+                 progress_callback=progress_callback)(
+            delayed(sleep_and_return)(i, .05) for i in range(10))
+        # The calls are rate-limited, but the last one always comes
+        nose.tools.assert_true(1 < len(calls) < 10)
+        n_completed, n_total, elapsed, remaining = calls[-1]
+        nose.tools.assert_equal((n_completed, n_total, remaining),
+                                (10, 10, 0))
+        nose.tools.assert_true(elapsed >= .5 / n_jobs)
+        completed = [call[0] for call in calls]
+        nose.tools.assert_equal(completed, sorted(completed))
+
+
+def test_progress_callback_error():
+    def progress_callback(*args):
+        raise ValueError('broken')
+
+    for n_jobs in (1, 2):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            out = Parallel(n_jobs=n_jobs,
+                           progress_callback=progress_callback)(
+                delayed(square)(i) for i in range(5))
+        nose.tools.assert_equal(out, [square(i) for i in range(5)])
+        nose.tools.assert_true(len(caught) > 0)
+
+
+def make_bytes(size):
+    return b'x' * size
+
+
+def test_pre_dispatch_nbytes():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    size = int(1e6)
+    for large_arguments in (True, False):
+        produced = list()
+
+        def producer():
+            for i in range(20):
+                produced.append(i)
+                if large_arguments:
+                    yield delayed(len)(make_bytes(size))
+                else:
+                    yield delayed(make_bytes)(size)
+
+        parallel = Parallel(n_jobs=2, batch_size=1, return_as='generator',
+                            pre_dispatch_nbytes='2.5M')
+        for i, output in enumerate(parallel(producer())):
+            if large_arguments:
+                nose.tools.assert_equal(output, size)
+            else:
+                nose.tools.assert_equal(len(output), size)
+            # The input is consumed lazily, and the jobs pending take at
+            # most 3 MB, the last one dispatched exceeding the budget, or
+            # 4 MB for the 2 * n_jobs first batches, dispatched before the
+            # size of the outputs is known
+            if i == 0:
+                nose.tools.assert_true(len(produced) < 10)
+            nose.tools.assert_true(parallel._pending_nbytes < 4.1e6)
+        nose.tools.assert_equal(len(produced), 20)
+
+
+###############################################################################
+# Test the initializer of the workers
+def set_worker_state(value):
+    state = get_worker_state()
+    state['value'] = value
+    state['token'] = os.urandom(8)
+
+
+def read_worker_state(x):
+    state = get_worker_state()
+    return state['value'] + x, state['token']
+
+
+def failing_initializer():
+    raise ZeroDivisionError('Failing initializer')
+
+
+def test_initializer():
+    for backend in ['multiprocessing', 'threading']:
+        for n_jobs in [1, 2]:
+            with Parallel(n_jobs=n_jobs, backend=backend, batch_size=1,
+                          initializer=set_worker_state,
+                          initargs=(10,)) as parallel:
+                tokens = set()
+                for _ in range(2):
+                    out = parallel(delayed(read_worker_state)(x)
+                                   for x in range(10))
+                    nose.tools.assert_equal([value for value, _ in out],
+                                            list(range(10, 20)))
+                    tokens.update(token for _, token in out)
+            # Once for each worker, also across the calls
+            nose.tools.assert_true(1 <= len(tokens) <= n_jobs)
+
+    # The state of the calling thread is not reset by the workers
+    get_worker_state()['value'] = 3
+    Parallel(n_jobs=2, backend='threading', initializer=set_worker_state,
+             initargs=(1,))(delayed(read_worker_state)(x) for x in range(4))
+    nose.tools.assert_equal(get_worker_state()['value'], 3)
+
+    nose.tools.assert_raises(ValueError, Parallel, initializer=1)
+
+
+class PublicThreadingBackend(ThreadingBackend):
+    """ A threading backend starting its workers with the public API of
+        the initializers only, as a third-party backend would
+    """
+    def start(self, n_jobs, parallel):
+        from multiprocessing.pool import ThreadPool
+        self._pool = ThreadPool(n_jobs, initializer=run_worker_initializers,
+                                initargs=(parallel.get_initializers(),))
+        return n_jobs
+
+
+def test_initializer_custom_backend():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    parallel = Parallel(n_jobs=2, backend=PublicThreadingBackend(),
+                        initializer=set_worker_state, initargs=(10,))
+    nose.tools.assert_equal(parallel.get_initializers(),
+                            [(set_worker_state, (10,))])
+    out = parallel(delayed(read_worker_state)(x) for x in range(4))
+    nose.tools.assert_equal([value for value, _ in out], list(range(10, 14)))
+    nose.tools.assert_equal(Parallel().get_initializers(), [])
+
+
+def test_initializer_error():
+    for backend in ['multiprocessing', 'threading']:
+        for n_jobs in [1, 2]:
+            nose.tools.assert_raises(
+                ZeroDivisionError,
+                Parallel(n_jobs=n_jobs, backend=backend,
+                         initializer=failing_initializer),
+                [delayed(square)(x) for x in range(4)])
+
+
+###############################################################################
+# Test the retries of the failed jobs
+def first_attempts(folder, x, n_attempts):
+    """ Whether the call for x is one of its first n_attempts, counted
+        with files, to be shared by the worker processes
+    """
+    for attempt in range(n_attempts):
+        try:
+            fd = os.open(os.path.join(folder, '%s_%d' % (x, attempt)),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            continue
+        os.close(fd)
+        return True
+    return False
+
+
+def flaky_square(folder, x, n_failures):
+    if first_attempts(folder, x, n_failures):
+        raise IOError('Transient failure')
+    return x ** 2
+
+
+def flaky_exit(folder, x):
+    if first_attempts(folder, x, 1):
+        os._exit(1)
+    return x ** 2
+
+
+def test_retries():
+    backends = ['threading']
+    if multiprocessing is not None:
+        backends.append('multiprocessing')
+    for backend in backends:
+        for n_jobs in [1, 2]:
+            for ordered in [True, False]:
+                folder = tempfile.mkdtemp()
+                try:
+                    out = Parallel(n_jobs=n_jobs, backend=backend,
+                                   ordered=ordered, retries=2,
+                                   retry_delay=.01)(
+                        delayed(flaky_square)(folder, x, 2)
+                        for x in range(10))
+                finally:
+                    shutil.rmtree(folder)
+                if not ordered:
+                    out = [output for _, output in sorted(out)]
+                nose.tools.assert_equal(out, [x ** 2 for x in range(10)])
+
+
+def get_spawning_guard(x):
+    time.sleep(.01)
+    return os.environ.get('__JOBLIB_SPAWNED_PARALLEL__')
+
+
+def test_retries_worker_death_spawning_guard():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    folder = tempfile.mkdtemp()
+    try:
+        out = Parallel(n_jobs=2, batch_size=1, retries=1, retry_delay=.01)(
+            delayed(flaky_exit)(folder, x) if x == 0
+            else delayed(get_spawning_guard)(x) for x in range(20))
+    finally:
+        shutil.rmtree(folder)
+    # The worker replacing the dead one is guarded against recursive
+    # spawning too
+    nose.tools.assert_equal(out, [0] + ['1'] * 19)
+    nose.tools.assert_false('__JOBLIB_SPAWNED_PARALLEL__' in os.environ)
+
+
+def test_retries_exhausted():
+    for n_jobs in [1, 2]:
+        folder = tempfile.mkdtemp()
+        try:
+            try:
+                Parallel(n_jobs=n_jobs, retries=1, retry_delay=.01)(
+                    delayed(flaky_square)(folder, x, 2) for x in range(4))
+                raise AssertionError('Expected an IOError')
+            except IOError as exception:
+                if n_jobs > 1:
+                    # With the traceback of the last failure in the worker
+                    nose.tools.assert_true('flaky_square' in str(exception))
+            # The errors not matching retry_on are not retried
+            nose.tools.assert_raises(
+                IOError, Parallel(n_jobs=n_jobs, retries=3,
+                                  retry_on=ValueError),
+                (delayed(flaky_square)(folder, x, 1) for x in range(10, 14)))
+        finally:
+            shutil.rmtree(folder)
+    nose.tools.assert_raises(ValueError, Parallel, retries=-1)
+
+
+def test_retries_backoff():
+    folder = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        Parallel(retries=2, retry_delay=.2, retry_backoff=2)(
+            [delayed(flaky_square)(folder, 1, 2)])
+        nose.tools.assert_true(time.time() - start >= .6)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_retries_worker_death():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    folder = tempfile.mkdtemp()
+    try:
+        out = Parallel(n_jobs=2, retries=1, retry_delay=.01)(
+            delayed(flaky_exit)(folder, x) if x == 3 else delayed(square)(x)
+            for x in range(10))
+    finally:
+        shutil.rmtree(folder)
+    nose.tools.assert_equal(out, [x ** 2 for x in range(10)])
+
+
+###############################################################################
+# Test the reductions
+def add(a, b):
+    return a + b
+
+
+def test_reduce():
+    backends = ['threading']
+    if multiprocessing is not None:
+        backends.append('multiprocessing')
+    for backend in backends:
+        for n_jobs in [1, 2]:
+            for batch_size in [1, 3]:
+                parallel = Parallel(n_jobs=n_jobs, backend=backend,
+                                    batch_size=batch_size)
+                nose.tools.assert_equal(
+                    parallel.reduce(add, (delayed(square)(x)
+                                          for x in range(10))),
+                    sum(x ** 2 for x in range(10)))
+                # The outputs are combined in the order of the input
+                nose.tools.assert_equal(
+                    parallel.reduce(add, [delayed(list)([x])
+                                          for x in range(10)], initial=[]),
+                    list(range(10)))
+                parallel = Parallel(n_jobs=n_jobs, backend=backend,
+                                    batch_size=batch_size, ordered=False)
+                nose.tools.assert_equal(
+                    parallel.reduce(add, (delayed(square)(x)
+                                          for x in range(10)), initial=1),
+                    1 + sum(x ** 2 for x in range(10)))
+
+    nose.tools.assert_raises(TypeError, Parallel(n_jobs=2).reduce, add, [])
+    nose.tools.assert_equal(Parallel(n_jobs=2).reduce(add, [], initial=0), 0)
+
+
+def test_reduce_in_workers():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+    parallel = Parallel(n_jobs=2, batch_size=5)
+    out = parallel.reduce(max, (delayed(make_bytes)(10000 + x)
+                                for x in range(10)))
+    nose.tools.assert_equal(len(out), 10009)
+    # Each batch sends back the result of its tasks only
+    for batch in parallel.stats_.batches:
+        nose.tools.assert_true(batch['result_nbytes'] < 20000)
+
+
+def test_reduce_error():
+    with Parallel(n_jobs=2, backend='threading') as parallel:
+        nose.tools.assert_raises(
+            ZeroDivisionError, parallel.reduce, add,
+            (delayed(division)(1, x) for x in range(-3, 3)))
+        # The combine errors are raised too
+        nose.tools.assert_raises(
+            TypeError, parallel.reduce, add,
+            [delayed(str)(1), delayed(int)(2)])
+        nose.tools.assert_equal(
+            parallel.reduce(add, (delayed(square)(x) for x in range(4))), 14)
+
+
+###############################################################################
+# Test the outputs dumped to disk
+def test_return_as_disk():
+    backends = ['threading']
+    if multiprocessing is not None:
+        backends.append('multiprocessing')
+    for backend in backends:
+        for n_jobs in [1, 2]:
+            for ordered in [True, False]:
+                out = Parallel(n_jobs=n_jobs, backend=backend,
+                               ordered=ordered, return_as='disk')(
+                    delayed(square)(x) for x in range(10))
+                with out:
+                    nose.tools.assert_true(isinstance(out, DiskOutputs))
+                    nose.tools.assert_true(out.folder in _temporary_folders)
+                    nose.tools.assert_equal(len(out), 10)
+                    nose.tools.assert_equal(list(out),
+                                            [x ** 2 for x in range(10)])
+                    nose.tools.assert_equal(out[-1], 81)
+                    nose.tools.assert_equal(out[2:4], [4, 9])
+                    nose.tools.assert_equal(len(os.listdir(out.folder)), 10)
+                nose.tools.assert_false(os.path.exists(out.folder))
+                # No longer left to the exit of the process
+                nose.tools.assert_false(out.folder in _temporary_folders)
+
+
+@with_numpy
+def test_return_as_disk_memmap():
+    temp_folder = tempfile.mkdtemp()
+    try:
+        out = Parallel(n_jobs=2, return_as='disk', temp_folder=temp_folder)(
+            delayed(np.arange)(x) for x in range(5))
+        nose.tools.assert_equal(os.path.dirname(out.folder), temp_folder)
+        # Loaded as memory maps, with mmap_mode
+        nose.tools.assert_true(isinstance(out[3], np.memmap))
+        np.testing.assert_array_equal(out[3], np.arange(3))
+        out.delete()
+        out = Parallel(n_jobs=2, return_as='disk', mmap_mode=None,
+                       temp_folder=temp_folder)(
+            delayed(np.arange)(x) for x in range(5))
+        nose.tools.assert_false(isinstance(out[3], np.memmap))
+        out.delete()
+
+        # The folder is deleted on errors
+        nose.tools.assert_raises(
+            ZeroDivisionError, Parallel(n_jobs=2, return_as='disk',
+                                        temp_folder=temp_folder),
+            (delayed(division)(1, x) for x in range(-3, 3)))
+        nose.tools.assert_equal(os.listdir(temp_folder), [])
+        nose.tools.assert_false(any(
+            folder.startswith(temp_folder)
+            for folder in _temporary_folders))
+    finally:
+        shutil.rmtree(temp_folder)
@@ -0,0 +1,319 @@
+"""
+Test the pool with automated memory mapping of large numpy arrays.
+"""
+import gc
+import os
+import shutil
+import tempfile
+import time
+import weakref
+from io import BytesIO
+from pickle import loads
+
+import nose
+
+from .common import np, with_numpy
+from ..parallel import Parallel, delayed, multiprocessing
+
+from ..my_exceptions import WorkerLostError
+from ..disk import _temporary_folders
+
+if multiprocessing is not None:
+    from ..pool import MemmapingPool, CustomizablePickler, reduce_memmap, \
+        has_shareable_memory, ResilientPool
+
+
+TEMP_FOLDER = None
+
+
+def setup_temp_folder():
+    global TEMP_FOLDER
+    TEMP_FOLDER = tempfile.mkdtemp(prefix='joblib_test_pool_')
+
+
+def teardown_temp_folder():
+    global TEMP_FOLDER
+    if TEMP_FOLDER is not None:
+        shutil.rmtree(TEMP_FOLDER)
+        TEMP_FOLDER = None
+
+
+with_temp_folder = nose.tools.with_setup(setup_temp_folder,
+                                         teardown_temp_folder)
+
+
+def check_multiprocessing():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+
+
+def memmap_info(a):
+    """ Return the type of a, and the file backing it, if any"""
+    return type(a).__name__, getattr(a, 'filename', None)
+
+
+def double(a):
+    return a * 2
+
+
+def exit_worker(exitcode):
+    os._exit(exitcode)
+
+
+def make_array(size):
+    return np.arange(size)
+
+
+def reducer_roundtrip(a):
+    buffer = BytesIO()
+    pickler = CustomizablePickler(buffer, {np.memmap: reduce_memmap})
+    pickler.dump(a)
+    return loads(buffer.getvalue())
+
+
+###############################################################################
+@with_numpy
+@with_temp_folder
+def test_memmap_based_array_reducing():
+    """Check that it is possible to reduce a memmap backed array"""
+    check_multiprocessing()
+    filename = os.path.join(TEMP_FOLDER, 'test.mmap')
+
+    # Create a file larger than what will be used by a
+    buffer = np.memmap(filename, dtype=np.float64, shape=500, mode='w+')
+
+    # Fill the original buffer with negative markers to detect over of
+    # underflow in case of test failures
+    buffer[:] = - 1.0 * np.arange(buffer.shape[0], dtype=buffer.dtype)
+    buffer.flush()
+
+    # Memmap a 3D fortran array on a offseted subsection of the previous
+    # buffer
+    a = np.memmap(filename, dtype=np.float64, shape=(3, 5, 4),
+                  mode='r+', order='F', offset=4)
+    a[:] = np.arange(60).reshape(a.shape)
+
+    # Build various views that share the buffer with the original memmap
+    views = [a, a[1:-1, 2:-1, 2:4], a[::2, ::3, ::2], a.T]
+    for view in views:
+        reconstructed = reducer_roundtrip(view)
+        nose.tools.assert_true(has_shareable_memory(reconstructed))
+        np.testing.assert_array_equal(reconstructed, view)
+
+    # Views with negative strides are copied
+    b = reducer_roundtrip(a[::-1])
+    np.testing.assert_array_equal(b, a[::-1])
+
+
+@with_numpy
+@with_temp_folder
+def test_pool_with_memmap():
+    """Check that large arrays are sent to the workers as memory maps"""
+    check_multiprocessing()
+    p = MemmapingPool(2, temp_folder=TEMP_FOLDER, max_nbytes=40)
+    try:
+        small = np.ones(2)
+        large = np.ones(10)
+        pool_folder = p._temp_folder
+
+        kind, filename = p.apply(memmap_info, (small,))
+        nose.tools.assert_equal((kind, filename), ('ndarray', None))
+        nose.tools.assert_false(os.path.exists(pool_folder))
+
+        kind, filename = p.apply(memmap_info, (large,))
+        nose.tools.assert_equal(kind, 'memmap')
+        nose.tools.assert_true(filename.startswith(pool_folder))
+
+        # Identical arrays are dumped in the same file
+        _, other_filename = p.apply(memmap_info, (large.copy(),))
+        nose.tools.assert_equal(filename, other_filename)
+        _, other_filename = p.apply(memmap_info, (2 * large,))
+        nose.tools.assert_not_equal(filename, other_filename)
+
+        # The results are correct, and read-only arrays are not modified
+        np.testing.assert_array_equal(p.apply(double, (large,)), 2 * large)
+
+        # The large results are dumped by the workers
+        result = p.apply(make_array, (2,))
+        nose.tools.assert_equal(memmap_info(result), ('ndarray', None))
+        result = p.apply(make_array, (10,))
+        kind, filename = memmap_info(result)
+        nose.tools.assert_equal(kind, 'memmap')
+        nose.tools.assert_true(filename.startswith(pool_folder))
+        np.testing.assert_array_equal(result, np.arange(10))
+        # They can be modified by the caller
+        result[0] = 42
+        np.testing.assert_array_equal(p.apply(double, (result,))[:2],
+                                      [84, 2])
+    finally:
+        p.terminate()
+    # The temporary folder is collected with the pool
+    nose.tools.assert_false(os.path.exists(pool_folder))
+
+
+@with_numpy
+@with_temp_folder
+def test_parallel_max_nbytes():
+    check_multiprocessing()
+    large = np.arange(1000)
+    out = Parallel(n_jobs=2, max_nbytes='1K', temp_folder=TEMP_FOLDER)(
+        delayed(memmap_info)(large) for _ in range(5))
+    kinds, filenames = zip(*out)
+    nose.tools.assert_equal(set(kinds), set(['memmap']))
+    # The array was dumped only once for all the jobs
+    nose.tools.assert_equal(len(set(filenames)), 1)
+    # and the temporary files are deleted at the end of the call
+    nose.tools.assert_equal(os.listdir(TEMP_FOLDER), [])
+
+    out = Parallel(n_jobs=2, max_nbytes=None, temp_folder=TEMP_FOLDER)(
+        delayed(memmap_info)(large) for _ in range(2))
+    nose.tools.assert_equal(out, [('ndarray', None)] * 2)
+
+    nose.tools.assert_equal(
+        Parallel(n_jobs=2, max_nbytes=100, temp_folder=TEMP_FOLDER)(
+            delayed(double)(large) for _ in range(2))[1].tolist(),
+        (2 * large).tolist())
+
+
+@with_numpy
+@with_temp_folder
+def test_parallel_mmap_mode_w_plus():
+    """Check that 'w+' does not truncate the arrays sent to the workers"""
+    check_multiprocessing()
+    large = np.arange(1000)
+    out = Parallel(n_jobs=2, max_nbytes=100, mmap_mode='w+',
+                   temp_folder=TEMP_FOLDER)(
+        delayed(double)(large) for _ in range(2))
+    for a in out:
+        np.testing.assert_array_equal(a, 2 * large)
+
+
+@with_numpy
+@with_temp_folder
+def test_parallel_max_nbytes_context_manager():
+    check_multiprocessing()
+    large = np.arange(1000)
+    with Parallel(n_jobs=2, max_nbytes=100,
+                  temp_folder=TEMP_FOLDER) as parallel:
+        for i in range(3):
+            out = parallel(delayed(memmap_info)(large + i) for _ in range(3))
+            nose.tools.assert_equal(len(set(out)), 1)
+            nose.tools.assert_equal(out[0][0], 'memmap')
+            # The files are deleted at the end of each call, while the
+            # pool is kept alive
+            nose.tools.assert_equal(os.listdir(TEMP_FOLDER), [])
+
+
+@with_numpy
+@with_temp_folder
+def test_parallel_max_nbytes_no_leak():
+    """Check that the pools of the calls are neither kept alive nor
+    left to the exit of the process"""
+    check_multiprocessing()
+    pools = list()
+    for _ in range(5):
+        with Parallel(n_jobs=2, max_nbytes='1M',
+                      temp_folder=TEMP_FOLDER) as parallel:
+            pools.append(weakref.ref(parallel._backend._pool))
+            parallel(delayed(double)(np.ones(10)) for _ in range(2))
+    del parallel
+    # The monitor thread of a pool holds it until its next period
+    deadline = time.time() + 5
+    gc.collect()
+    while any(pool() is not None for pool in pools):
+        if time.time() > deadline:
+            break
+        time.sleep(.1)
+        gc.collect()
+    nose.tools.assert_equal([pool() for pool in pools], [None] * 5)
+    nose.tools.assert_false(any(folder.startswith(TEMP_FOLDER)
+                                for folder in _temporary_folders))
+
+
+class SlowPickle(object):
+    """Result taking longer to pickle than the timeout of its task"""
+
+    def __reduce__(self):
+        time.sleep(.5)
+        return SlowPickle, ()
+
+
+def make_slow_pickle():
+    return SlowPickle()
+
+
+def test_pool_timeout_result_in_flight():
+    """Check that a worker whose task returned within its timeout is not
+    terminated while it sends the result"""
+    check_multiprocessing()
+    p = ResilientPool(2)
+    try:
+        jobs = [p.apply_async(make_slow_pickle, timeout=.2)
+                for _ in range(4)]
+        for job in jobs:
+            nose.tools.assert_true(isinstance(job.get(30), SlowPickle))
+        # The pool is still usable
+        nose.tools.assert_equal(p.apply_async(abs, (-1,)).get(10), 1)
+        nose.tools.assert_raises(ValueError, p.apply_async, abs, (-1,),
+                                 timeout=0)
+    finally:
+        p.terminate()
+
+
+def test_pool_worker_death():
+    """Check that the death of a worker fails its task, without hanging"""
+    check_multiprocessing()
+    p = ResilientPool(2)
+    try:
+        pids = set(worker.pid for worker in p._pool)
+        job = p.apply_async(exit_worker, (1,))
+        nose.tools.assert_raises(WorkerLostError, job.get, 10)
+        # The dead worker is replaced, and the pool is still usable
+        nose.tools.assert_equal(p.map(abs, range(-5, 5)),
+                                [abs(i) for i in range(-5, 5)])
+        nose.tools.assert_equal(len(p._pool), 2)
+        nose.tools.assert_not_equal(set(worker.pid for worker in p._pool),
+                                    pids)
+    finally:
+        p.terminate()
+
+
+def test_pool_error_callback():
+    """Check that the error callback is called, also under Python 2"""
+    check_multiprocessing()
+    p = ResilientPool(2)
+    try:
+        for func, args, exception_type in [(exit_worker, (1,),
+                                             WorkerLostError),
+                                            (int, ('a',), ValueError)]:
+            errors = list()
+            job = p.apply_async(func, args, error_callback=errors.append)
+            nose.tools.assert_raises(exception_type, job.get, 10)
+            nose.tools.assert_equal(len(errors), 1)
+            nose.tools.assert_true(isinstance(errors[0], exception_type))
+        errors = list()
+        nose.tools.assert_equal(
+            p.apply_async(abs, (-1,), error_callback=errors.append).get(10),
+            1)
+        nose.tools.assert_equal(errors, [])
+    finally:
+        p.terminate()
+
+
+@with_numpy
+@with_temp_folder
+def test_parallel_max_nbytes_results():
+    check_multiprocessing()
+    out = Parallel(n_jobs=2, max_nbytes=100, temp_folder=TEMP_FOLDER)(
+        delayed(make_array)(size) for size in [5, 1000, 2000])
+    nose.tools.assert_equal([type(a).__name__ for a in out],
+                            ['ndarray', 'memmap', 'memmap'])
+    # The files are deleted at the end of the call, but the arrays can
+    # still be used, and sent to the workers
+    nose.tools.assert_equal(os.listdir(TEMP_FOLDER), [])
+    for size, a in zip([5, 1000, 2000], out):
+        np.testing.assert_array_equal(a, np.arange(size))
+    out = Parallel(n_jobs=2, max_nbytes=100, temp_folder=TEMP_FOLDER)(
+        delayed(double)(a) for a in out)
+    for size, a in zip([5, 1000, 2000], out):
+        np.testing.assert_array_equal(a, 2 * np.arange(size))
@@ -0,0 +1,243 @@
+"""
+Test the pool of workers reached over TCP, with worker servers on
+localhost.
+"""
+import os
+import time
+import socket
+import threading
+
+import nose
+
+from ..parallel import Parallel, delayed, multiprocessing, get_worker_state
+from ..my_exceptions import JoblibException, WorkerLostError
+
+if multiprocessing is not None:
+    from .. import tcp_pool
+    from ..tcp_pool import TCPPool, serve
+
+
+AUTHKEY = b'joblib test key'
+SERVERS = list()
+ADDRESSES = list()
+OLD_ENVIRON = dict()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def setup_module():
+    if multiprocessing is None:
+        return
+    for _ in range(2):
+        address = ('localhost', free_port())
+        server = multiprocessing.Process(target=serve,
+                                         args=(address, AUTHKEY))
+        server.start()
+        SERVERS.append(server)
+        ADDRESSES.append('%s:%d' % address)
+    for name, value in [('JOBLIB_TCP_WORKERS', ','.join(ADDRESSES)),
+                        ('JOBLIB_TCP_AUTHKEY', AUTHKEY.decode())]:
+        OLD_ENVIRON[name] = os.environ.get(name)
+        os.environ[name] = value
+
+
+def teardown_module():
+    for server in SERVERS:
+        server.terminate()
+        server.join()
+    del SERVERS[:], ADDRESSES[:]
+    for name, value in OLD_ENVIRON.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+
+def check_multiprocessing():
+    if multiprocessing is None:
+        raise nose.SkipTest('Need multiprocessing to run')
+
+
+def get_pid(x):
+    return os.getpid()
+
+
+def exit_worker(exitcode):
+    os._exit(exitcode)
+
+
+def division(x, y):
+    return x / y
+
+
+def set_worker_state(value):
+    get_worker_state()['value'] = value
+
+
+def read_worker_state(x):
+    return get_worker_state()['value'] + x, os.getpid()
+
+
+###############################################################################
+def test_tcp_pool():
+    check_multiprocessing()
+    pool = TCPPool(4, ADDRESSES, AUTHKEY)
+    try:
+        jobs = [pool.apply_async(abs, (-i,)) for i in range(10)]
+        nose.tools.assert_equal([job.get(10) for job in jobs], list(range(10)))
+        pids = set(pool.apply_async(get_pid, (i,)).get(10)
+                   for i in range(20))
+        nose.tools.assert_true(os.getpid() not in pids)
+        nose.tools.assert_true(1 <= len(pids) <= 4)
+        # The error of a task is raised by its result
+        job = pool.apply_async(division, (1, 0))
+        nose.tools.assert_raises(ZeroDivisionError, job.get, 10)
+        # The death of a worker fails its task only
+        job = pool.apply_async(exit_worker, (1,))
+        nose.tools.assert_raises(WorkerLostError, job.get, 10)
+        nose.tools.assert_equal(pool.apply_async(abs, (-1,)).get(10), 1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def test_tcp_pool_authentication():
+    check_multiprocessing()
+    nose.tools.assert_raises(multiprocessing.AuthenticationError,
+                             TCPPool, 1, ADDRESSES, b'wrong key')
+    nose.tools.assert_raises(ValueError, TCPPool, 1, ADDRESSES, None)
+
+
+def test_tcp_pool_stalled_client():
+    check_multiprocessing()
+    # A client that does not authenticate does not hold the connections
+    # of the others
+    host, port = ADDRESSES[0].rsplit(':', 1)
+    stalled = socket.create_connection((host, int(port)))
+    try:
+        pool = TCPPool(2, ADDRESSES[:1], AUTHKEY)
+        try:
+            nose.tools.assert_equal(pool.apply_async(abs, (-1,)).get(10), 1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        stalled.close()
+
+
+def test_tcp_server_handshake_timeout():
+    check_multiprocessing()
+    # A client that does not authenticate is disconnected, without a
+    # worker process started for it
+    server_sock, client_sock = socket.socketpair()
+    pending = threading.BoundedSemaphore(1)
+    pending.acquire()
+    old_timeout = tcp_pool.HANDSHAKE_TIMEOUT
+    tcp_pool.HANDSHAKE_TIMEOUT = .5
+    try:
+        n_children = len(multiprocessing.active_children())
+        start = time.time()
+        tcp_pool._accept_client(server_sock, AUTHKEY, pending)
+        nose.tools.assert_true(time.time() - start < 5)
+        nose.tools.assert_equal(len(multiprocessing.active_children()),
+                                n_children)
+        # The client is no longer pending
+        nose.tools.assert_true(pending.acquire(False))
+    finally:
+        tcp_pool.HANDSHAKE_TIMEOUT = old_timeout
+        client_sock.close()
+
+
+def test_tcp_pool_handshake_timeout():
+    check_multiprocessing()
+    # A server that does not authenticate does not block the client
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(1)
+    old_timeout = tcp_pool.HANDSHAKE_TIMEOUT
+    tcp_pool.HANDSHAKE_TIMEOUT = .5
+    try:
+        start = time.time()
+        nose.tools.assert_raises(
+            socket.error, TCPPool, 1,
+            ['localhost:%d' % listener.getsockname()[1]], AUTHKEY)
+        nose.tools.assert_true(time.time() - start < 5)
+    finally:
+        tcp_pool.HANDSHAKE_TIMEOUT = old_timeout
+        listener.close()
+
+
+def test_tcp_pool_ipv6():
+    check_multiprocessing()
+    if not socket.has_ipv6:
+        raise nose.SkipTest('Need IPv6 to run')
+    sock = socket.socket(socket.AF_INET6)
+    try:
+        sock.bind(('::1', 0))
+        port = sock.getsockname()[1]
+    except socket.error:
+        raise nose.SkipTest('Need IPv6 on localhost to run')
+    finally:
+        sock.close()
+    server = multiprocessing.Process(target=serve,
+                                     args=('::1:%d' % port, AUTHKEY))
+    server.start()
+    try:
+        pool = TCPPool(1, ['::1:%d' % port], AUTHKEY)
+        nose.tools.assert_equal(pool.apply_async(abs, (-1,)).get(10), 1)
+        job = pool.apply_async(time.sleep, (30,))
+        # Terminating shuts the IPv6 connections down, which unblocks
+        # the threads waiting for the results
+        pool.terminate()
+        for thread in pool._threads:
+            thread.join(10)
+            nose.tools.assert_false(thread.is_alive())
+        nose.tools.assert_false(job.ready())
+    finally:
+        server.terminate()
+        server.join()
+
+
+def test_parallel_tcp_backend():
+    check_multiprocessing()
+    out = Parallel(n_jobs=3, backend='tcp')(
+        delayed(division)(i, 2.) for i in range(10))
+    nose.tools.assert_equal(out, [i / 2. for i in range(10)])
+    with Parallel(n_jobs=-1, backend='tcp') as parallel:
+        # One worker for each worker server
+        nose.tools.assert_equal(parallel._pool_n_jobs, 2)
+        pids = parallel(delayed(get_pid)(i) for i in range(10))
+        nose.tools.assert_true(os.getpid() not in pids)
+        # The remote traceback is reported
+        try:
+            parallel(delayed(division)(1, y) for y in (1, 0))
+            raise AssertionError('Expected a ZeroDivisionError')
+        except ZeroDivisionError as exception:
+            nose.tools.assert_true(isinstance(exception, JoblibException))
+            nose.tools.assert_true('division' in str(exception))
+    nose.tools.assert_raises(ValueError, Parallel, n_jobs=2,
+                             backend='tcp', timeout=1)
+
+
+def test_parallel_tcp_initializer():
+    check_multiprocessing()
+    out = Parallel(n_jobs=2, backend='tcp', initializer=set_worker_state,
+                   initargs=(10,))(delayed(read_worker_state)(x)
+                                   for x in range(10))
+    nose.tools.assert_equal([value for value, _ in out], list(range(10, 20)))
+    nose.tools.assert_true(os.getpid() not in set(pid for _, pid in out))
+
+
+def test_parallel_tcp_return_as_disk():
+    check_multiprocessing()
+    # The outputs are dumped by the parent process
+    out = Parallel(n_jobs=2, backend='tcp', return_as='disk')(
+        delayed(division)(i, 2.) for i in range(10))
+    with out:
+        nose.tools.assert_equal(list(out), [i / 2. for i in range(10)])